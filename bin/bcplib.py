@@ -0,0 +1,383 @@
+##########################################################################
+#
+# Purpose: Write and load the bcp files of the load (RNASeqSet,
+#	RNASeqSetMember, RNASeqCombined, RNASeq)
+#
+#   BcpWriter : one tab-delimited bcp file
+#	the constant columns at the end of every row (created by/modified by,
+#	creation/modification date) are rendered once, when the writer is
+#	created; each row is rendered with one pre-built format, kept in a
+#	buffer and written BCP_BUFFER_ROWS rows at a time
+#
+#	rows, bytes : the rows and bytes written; reported by close()
+#
+#   BCP_MODE - how the bcp files are loaded
+#	bcpin (default) : the scripts run PG_DBUTILS/bin/bcpin.csh for each
+#	    file (copyEnabled() is False)
+#	copy : BcpWriter.load() loads the rows with COPY ... FROM STDIN over
+#	    a psycopg2 connection to the server/database of the db module,
+#	    with its login; falls back to bcpin if psycopg2 is missing
+#
+#	the COPY runs on a connection of its own (connect()), not on the
+#	db module's: a streamed COPY is fed by a thread while the load keeps
+#	running db.sql() (the key blocks of keylib.py, the deletes of
+#	BASELINE_DELTA), and a connection cannot run other statements while
+#	a COPY is in progress; a commit of the db connection (keylib) would
+#	also commit a half-done COPY. the tables are copied into mgd (no temp
+#	tables of the load are used). the login is the one the db module
+#	was set up with (db.get_sqlUser()/db.get_sqlPassword(), from
+#	PG_DBUSER/PG_1LINE_PASSFILE), so no other credentials are configured
+#
+#	a writer created with stream=True (the large RNASeqCombined table)
+#	starts its COPY when it is created and sends each buffer of rows as it
+#	is written, so the load runs while the rows are still being
+#	generated; the rows are committed by load(). a streamed writer must
+#	be created after the rows it refers to (RNASeqSet) are committed.
+#	BCP_STREAM_CHUNKS buffers at most are waiting to be sent.
+#
+#	the other writers write their bcp file, which load() copies
+#
+#   BCP_TEE - true (default) : a streamed writer also writes its bcp file
+#	(audit); false : the streamed rows are not written to disk
+#
+#   BcpShards : a table written as BCP_COMBINED_SHARDS bcp files (shards)
+#	xxx.bcp if there is one shard, else xxx.0.bcp, xxx.1.bcp, etc.
+#	the rows of an experiment go to one shard (writer(), the shard with
+#	the fewest rows so far); load() copies all the shards in one
+#	transaction: streamed shards share one COPY, otherwise the shard
+#	files are copied one after the other on one connection. (bcpin mode
+#	loads the shard files concurrently, see rnaseqBaseline.py)
+#
+#   transaction() : run statements (the delete of the previous rows of an
+#	experiment) and copy bcp files in one transaction, on one psycopg2
+#	connection (BASELINE_DELTA, see rnaseqBaseline.py)
+#
+# Usage:
+#	import bcplib
+#	fpSet = bcplib.BcpWriter(path, 3, (createdByKey, createdByKey, loaddate, loaddate), table)
+#	fpSet.addRow(setKey, expKey, groupSet)
+#	fpSet.addRows(rows)
+#	fpSet.close()
+#	if bcplib.copyEnabled():
+#	    fpSet.load()
+#
+#	fpCombined = bcplib.BcpShards(path, bcplib.combinedShards, 6, suffix, table, stream=True)
+#	fp = fpCombined.writer()
+#
+#	bcplib.transaction(['delete from ...'], [fpSet, fpMember])
+#
+###########################################################################
+
+import os
+import queue
+import threading
+import db
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+bufferRows = int(os.getenv('BCP_BUFFER_ROWS', '10000'))
+mode = os.getenv('BCP_MODE', 'bcpin')
+tee = os.getenv('BCP_TEE', 'true') == 'true'
+streamChunks = int(os.getenv('BCP_STREAM_CHUNKS', '8'))
+combinedShards = max(1, int(os.getenv('BCP_COMBINED_SHARDS', '1')))
+
+TAB = '\t'
+CRT = '\n'
+
+# as bcpin.csh : tab delimited, an empty column is null
+COPY_SQL = '''copy %s.%s from stdin with null as '' '''
+
+#
+# True if the bcp files are loaded with COPY (BCP_MODE=copy)
+#
+def copyEnabled():
+
+    return mode == 'copy' and psycopg2 != None
+
+# end copyEnabled()
+
+#
+# a new psycopg2 connection to the server/database of db, with its login
+#
+def connect():
+
+    return psycopg2.connect(host=db.get_sqlServer(), dbname=db.get_sqlDatabase(), \
+        user=db.get_sqlUser(), password=db.get_sqlPassword())
+
+# end connect()
+
+#
+# run the sql statements, then copy the bcp file of each writer (after
+# close()) into its table, in one transaction on one connection
+# returns None if the transaction is committed, else the error (rolled back)
+#
+def copyFiles(statements, writers):
+
+    error = None
+    connection = connect()
+    try:
+        cursor = connection.cursor()
+        for sql in statements:
+            cursor.execute(sql)
+        for w in writers:
+            with open(w.path, 'rb') as fp:
+                cursor.copy_expert(COPY_SQL % ('mgd', w.table), fp, size=1 << 20)
+        cursor.close()
+        connection.commit()
+    except Exception as e:
+        error = e
+        connection.rollback()
+    finally:
+        connection.close()
+
+    return error
+
+# end copyFiles()
+
+#
+# copyFiles(), reported
+# returns 0 if the transaction is committed, else 1 (rolled back)
+#
+def transaction(statements, writers):
+
+    error = copyFiles(statements, writers)
+
+    if error != None:
+        print('transaction failed: %s' % (error))
+        return 1
+    print('transaction: %s statement(s), %s' % \
+        (len(statements), ', '.join(['%s %s rows' % (w.table, w.rows) for w in writers])))
+
+    return 0
+
+# end transaction()
+
+#
+# a COPY ... FROM STDIN run by a thread on its own connection
+#   write() queues a chunk of rows (bytes); the thread reads the queue as
+#   the file of copy_expert(); the writers sharing a stream (BcpShards)
+#   each write whole rows
+#   finish() ends the data and waits for the COPY; commit() commits it
+#
+class CopyStream:
+
+    def __init__(self, sql):
+
+        self.sql = sql
+        self.queue = queue.Queue(maxsize=streamChunks)
+        self.data = b''
+        self.ended = False
+        self.error = None
+        self.connection = connect()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+
+        try:
+            cursor = self.connection.cursor()
+            cursor.copy_expert(self.sql, self, size=1 << 20)
+            cursor.close()
+        except Exception as e:
+            self.error = e
+            # let the writer finish
+            while not self.ended:
+                self.ended = self.queue.get() == None
+
+    #
+    # copy_expert() : the next size bytes, b'' at the end
+    #
+    def read(self, size=-1):
+
+        while not self.data:
+            chunk = self.queue.get()
+            if chunk == None:
+                self.ended = True
+                return b''
+            self.data = chunk
+
+        if size < 0 or size >= len(self.data):
+            data = self.data
+            self.data = b''
+        else:
+            data = self.data[:size]
+            self.data = self.data[size:]
+
+        return data
+
+    def write(self, data):
+
+        if self.error == None:
+            self.queue.put(data)
+
+    def finish(self):
+
+        self.queue.put(None)
+        self.thread.join()
+        return self.error
+
+    def commit(self):
+
+        try:
+            if self.error == None:
+                self.connection.commit()
+            else:
+                self.connection.rollback()
+        finally:
+            self.connection.close()
+
+# end class CopyStream
+
+class BcpWriter:
+
+    #
+    # path : the bcp file
+    # nColumns : the number of columns passed to addRow()
+    # suffix : the constant columns that end every row
+    # table : the table the file is loaded into (load())
+    # stream : copy the rows while they are written (BCP_MODE=copy)
+    # copyStream : the CopyStream of the rows, shared with other writers
+    #	(BcpShards, which loads it); default: a stream of its own
+    #
+    def __init__(self, path, nColumns, suffix=(), table=None, stream=False, copyStream=None):
+
+        self.path = path
+        self.table = table
+        self.stream = None
+        self.fp = None
+
+        if stream and copyEnabled():
+            self.stream = copyStream or CopyStream(COPY_SQL % ('mgd', table))
+        if self.stream == None or tee:
+            self.fp = open(path, 'wb')
+
+        columns = ['%s'] * nColumns
+        for s in suffix:
+            columns.append(str.replace(str(s), '%', '%%'))
+        self.format = TAB.join(columns) + CRT
+
+        self.buffer = []
+        self.rows = 0
+        self.bytes = 0
+
+    #
+    # add a row; columns are written with %s
+    #
+    def addRow(self, *columns):
+
+        self.buffer.append(self.format % columns)
+        if len(self.buffer) >= bufferRows:
+            self.flush()
+
+    #
+    # add rows (sequences of columns), rendered in one call
+    #
+    def addRows(self, rows):
+
+        self.buffer.extend(map(self.format.__mod__, rows))
+        if len(self.buffer) >= bufferRows:
+            self.flush()
+
+    #
+    # write (and stream) the buffered rows
+    #
+    def flush(self):
+
+        if not self.buffer:
+            return
+
+        data = str.encode(''.join(self.buffer), 'utf-8')
+        if self.fp != None:
+            self.fp.write(data)
+        if self.stream != None:
+            self.stream.write(data)
+        self.rows += len(self.buffer)
+        self.bytes += len(data)
+        self.buffer = []
+
+    def close(self):
+
+        self.flush()
+        if self.fp != None:
+            self.fp.close()
+        print('%s: %s rows, %s bytes' % (self.path, self.rows, self.bytes))
+
+    #
+    # load the rows into table with COPY (after close())
+    #   a streamed writer commits its COPY; otherwise the bcp file is copied
+    # returns 0 if the rows are loaded, else 1
+    #
+    def load(self):
+
+        if self.stream != None:
+            error = self.stream.finish()
+            self.stream.commit()
+        else:
+            error = copyFiles([], [self])
+
+        if error != None:
+            print('copy failed: %s, %s, %s' % (self.table, self.path, error))
+            return 1
+        print('copy %s: %s, %s rows' % (self.table, self.path, self.rows))
+
+        return 0
+
+# end class BcpWriter
+
+class BcpShards:
+
+    #
+    # path : the bcp file; the shards are named after it
+    # nShards : the number of shards
+    # the other arguments are those of BcpWriter
+    #
+    def __init__(self, path, nShards, nColumns, suffix=(), table=None, stream=False):
+
+        if nShards == 1:
+            paths = [path]
+        else:
+            base, ext = os.path.splitext(path)
+            paths = ['%s.%s%s' % (base, i, ext) for i in range(nShards)]
+
+        self.table = table
+        self.stream = None
+        if stream and copyEnabled():
+            self.stream = CopyStream(COPY_SQL % ('mgd', table))
+        self.writers = [BcpWriter(p, nColumns, suffix, table, stream, self.stream) for p in paths]
+
+    #
+    # the writer of the next experiment: the shard with the fewest rows
+    #
+    def writer(self):
+
+        return min(self.writers, key=lambda w: w.rows + len(w.buffer))
+
+    def close(self):
+
+        for w in self.writers:
+            w.close()
+
+    #
+    # load the shards with COPY, in one transaction
+    # returns 0 if the shards are loaded, else 1 (none is)
+    #
+    def load(self):
+
+        if self.stream != None:
+            error = self.stream.finish()
+            self.stream.commit()
+        else:
+            error = copyFiles([], self.writers)
+
+        paths = ', '.join([w.path for w in self.writers])
+        if error != None:
+            print('copy failed: %s, %s, %s' % (self.table, paths, error))
+            return 1
+        print('copy %s: %s, %s rows' % (self.table, paths, sum([w.rows for w in self.writers])))
+
+        return 0
+
+# end class BcpShards
@@ -0,0 +1,146 @@
+##########################################################################
+#
+# Purpose: Transparent compressed storage of the expression matrices
+#
+#   the raw -tpms.tsv/-raw-counts.tsv files and the pre-processed
+#   xxx.tpms.txt/xxx.raw-counts.txt files are written through openWrite()
+#   and read through openRead(); the codec is chosen by config
+#
+#   COMPRESS_CODEC - none, gzip or zstd (zstd needs the zstandard module)
+#   COMPRESS_LEVEL - compression level (default: 3 gzip, 3 zstd)
+#
+#   the codec suffix (.gz, .zst) is added to the file name, so
+#   openWrite('xxx.tpms.txt') writes xxx.tpms.txt.gz; openRead('xxx.tpms.txt')
+#   reads whichever of xxx.tpms.txt.gz, xxx.tpms.txt.zst, xxx.tpms.txt
+#   exists (the configured codec first), so files written before a
+#   codec change can still be read
+#
+#   all files are streamed, nothing is decompressed to disk or memory
+#
+# Usage:
+#	import compresslib
+#	fp = compresslib.openWrite(path)	# text, 'w'
+#	fp = compresslib.openRead(path)		# text, 'r'
+#	fp = compresslib.openWrite(path, binary=True)
+#
+###########################################################################
+
+import os
+import io
+import gzip
+
+codec = os.getenv('COMPRESS_CODEC', 'none')
+level = int(os.getenv('COMPRESS_LEVEL', '3'))
+
+suffixes = {
+    'none' : '',
+    'gzip' : '.gz',
+    'zstd' : '.zst',
+}
+
+if codec not in suffixes:
+    raise ValueError('unknown COMPRESS_CODEC: %s' % (codec))
+
+#
+# the name of path as written with the configured codec
+#
+def compressedName(path, useCodec=None):
+
+    return path + suffixes[useCodec or codec]
+
+# end compressedName()
+
+#
+# the codec of a file, by suffix
+#
+def codecOf(path):
+
+    for c in ('gzip', 'zstd'):
+        if path.endswith(suffixes[c]):
+            return c
+    return 'none'
+
+# end codecOf()
+
+#
+# the existing file for path, with the configured codec first
+# returns None if there is none
+#
+def findFile(path):
+
+    order = [codec] + [c for c in ('gzip', 'zstd', 'none') if c != codec]
+    for c in order:
+        if os.path.exists(path + suffixes[c]):
+            return path + suffixes[c]
+    return None
+
+# end findFile()
+
+#
+# the other (stale) copies of path written with a codec other than useCodec
+#
+def otherNames(path, useCodec=None):
+
+    return [path + suffixes[c] for c in suffixes if c != (useCodec or codec)]
+
+# end otherNames()
+
+#
+# open path with the given codec
+#   mode : 'rt', 'wt', 'rb' or 'wb'
+#
+def openCodec(path, mode, useCodec):
+
+    if useCodec == 'gzip':
+        return gzip.open(path, mode, compresslevel=level)
+    if useCodec == 'zstd':
+        import zstandard
+        fp = zstandard.open(path, str.replace(mode, 't', 'b'), cctx=zstandard.ZstdCompressor(level=level))
+        if 'b' in mode:
+            return fp
+        return io.TextIOWrapper(fp)
+    return open(path, mode)
+
+# end openCodec()
+
+#
+# open path + codec suffix for writing
+# a stale copy with another codec suffix is removed
+#
+def openWrite(path, binary=False):
+
+    for other in otherNames(path):
+        if os.path.exists(other):
+            os.remove(other)
+    return openCodec(compressedName(path), 'wb' if binary else 'wt', codec)
+
+# end openWrite()
+
+#
+# open whichever compressed/uncompressed copy of path exists for reading
+# raises FileNotFoundError if there is none
+#
+def openRead(path, binary=False):
+
+    found = findFile(path)
+    if found == None:
+        raise FileNotFoundError(path)
+    return openCodec(found, 'rb' if binary else 'rt', codecOf(found))
+
+# end openRead()
+
+#
+# compress (or copy) src into dst + codec suffix, streamed
+# returns the name of the file written
+#
+def compressFile(src, dst, useCodec=None):
+
+    useCodec = useCodec or codec
+    name = compressedName(dst, useCodec)
+    with open(src, 'rb') as fpIn:
+        with openCodec(name, 'wb', useCodec) as fpOut:
+            for chunk in iter(lambda: fpIn.read(1048576), b''):
+                fpOut.write(chunk)
+    return name
+
+# end compressFile()
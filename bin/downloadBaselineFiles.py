@@ -11,14 +11,21 @@
 #	 3b. EAE_GROUP_URL_TEMPLATE - url template for Expression Atlas
 #	 3c. AES_SDRF_URL_TEMPLATE - url template for Expression Atlas
 #	 4. DOWNLOAD_OK - if exists then error-free download
+#	 5. RAWSTORE_DIR - store shared with the other download, the files
+#	    in BASELINERAW_INPUTDIR are links to it (see downloadlib.py)
+#	 6. DOWNLOAD_MAX_WORKERS, DOWNLOAD_HOST_LIMIT, DOWNLOAD_HOST_LIMITS -
+#	    concurrency of the downloads (see downloadlib.py)
+#	 7. DOWNLOAD_SCHEME - scheme for url templates without one (http)
 #
 # Inputs:
 #	1. Database - the experiments in the 'Baseline RNASeq Load Experiment' Set
 #		and the experiments loaded 
+#		(the experiments in the 'RNASeq Load Experiments' Set are kept in the store)
 #	2. Configuration (see rnaseqload.config)
 #
 # Outputs:
 #	 1.  Expression Atlas file for each experiment
+#	 2.  RAWSTORE_DIR/download.manifest
 # 
 # Exit Codes:
 #
@@ -32,17 +39,19 @@
 ###########################################################################
 import os
 import sys
-import subprocess
 import mgi_utils
 import db
+import downloadlib
 
 # paths to logs, input
 rawInputDir = os.getenv('BASELINERAW_INPUTDIR')
 
 # Expression Atlas Experiment file URL Templage
+# (configuration and sdrf templates: see downloadlib.experimentJobs())
 eatTemplate  = os.getenv('EAE_TPMS_URL_TEMPLATE')
-eagTemplate  = os.getenv('EAE_GROUP_URL_TEMPLATE')
-aesTemplate  = os.getenv('AES_SDRF_URL_TEMPLATE')
+
+# content-addressed store of the raw files and its manifest
+storeDir = os.getenv('RAWSTORE_DIR')
 
 # number of files unable to be downloaded
 errorCt = 0
@@ -51,13 +60,10 @@ errorCt = 0
 failedList = []
 
 def init():
-    global rnaSeqSetResults
+    global rnaSeqSetResults, otherSetExperiments, store
 
-    cmd = 'rm %s/*.eae.*' % rawInputDir
-    rc = os.system(cmd)
-    if rc != 0:
-        msg = 'rm cmd did not succeed: %s\n' % (cmd)
-        print(msg)
+    # files from previous runs are kept; only changed files are fetched again
+    store = downloadlib.RawStore(storeDir)
 
     # create the result set of ids to load
     rnaSeqSetResults = db.sql('''
@@ -71,105 +77,56 @@ def init():
         and a.preferred = 1
         ''', 'auto')
 
+    # the experiments of the other set share the store; their files are
+    # kept when the store is pruned
+    results = db.sql('''
+        select a.accid
+        from MGI_Set s, MGI_SetMember m , ACC_Accession a
+        where s.name = 'RNASeq Load Experiments'
+        and s._set_key = m._set_key
+        and s._mgitype_key = a._mgitype_key
+        and m._object_key = a._object_key
+        and a._logicaldb_key = 189
+        and a.preferred = 1
+        ''', 'auto')
+    otherSetExperiments = set([str.strip(r['accid']) for r in results])
+
     return 0
 
 # end init() -------------------------------------------------------------
 
-def downloadTPMS(expID):
-
-    eaeURL = eatTemplate % (expID, expID)
-    outputFile = rawInputDir + '/' + expID + '-tpms.tsv'
-    cmd = ['wget', eaeURL]
-    cmd.extend(['-O', outputFile])
-    result = subprocess.run(cmd, check=True)
-    stdout = result.stdout
-    stderr = result.stderr
-    statusCode = result.returncode
-
-    if statusCode != 0:
-        print('%s statusCode: %s stderr: %s\n' % (eaeURL, statusCode, stderr))
-
-    return statusCode
-
-# end downloadTPMS -------------------------------------------------------------
-
-def downloadGROUP(expID):
-
-    eaeURL = eagTemplate % (expID, expID)
-    outputFile = rawInputDir + '/' + expID + '-configuration.xml'
-    cmd = ['wget', eaeURL]
-    cmd.extend(['-O', outputFile])
-    result = subprocess.run(cmd, check=True)
-    stdout = result.stdout
-    stderr = result.stderr
-    statusCode = result.returncode
-
-    if statusCode != 0:
-        print('%s statusCode: %s stderr: %s\n' % (eaeURL, statusCode, stderr))
-
-    return statusCode
-
-# end downloadGROUP -------------------------------------------------------------
-
-def downloadAES(expID):
-
-    # E-GEOD-22131 = E, GEOD, 22131 -> 131 last 3 characters
-    tokens = expID.split('-')
-    print(tokens)
-    a = tokens[0] + '-' + tokens[1] + '-'
-    b = tokens[2][-3:]
-    eaeURL = aesTemplate % (a, b, expID, expID)
-    outputFile = rawInputDir + '/' + expID + '.sdrf.txt'
-    cmd = ['wget', eaeURL]
-    cmd.extend(['-O', outputFile])
-    print(cmd)
-    result = subprocess.run(cmd, check=True)
-    stdout = result.stdout
-    stderr = result.stderr
-    statusCode = result.returncode
-
-    if statusCode != 0:
-        print('%s statusCode: %s stderr: %s\n' % (eaeURL, statusCode, stderr))
-
-    return statusCode
-
-# end downloadAES -------------------------------------------------------------
-
+#
+# download the files of all experiments concurrently (see downloadlib.py)
+# an experiment is counted as an error if any of its files did not download
+#
 def downloadFiles():
-    global totalCt, successCt, errorCt, failed
+    global totalCt, successCt, errorCt, failedList
 
     totalCt = 0
     successCt = 0
     errorCt = 0
 
+    jobs = []
     for r in rnaSeqSetResults:
         totalCt += 1
         expID = str.strip(r['accid'])
+        jobs.extend(downloadlib.experimentJobs(expID, 'tpms', eatTemplate, rawInputDir))
 
-        print('Download files for experiment ID: %s\n' % (expID))
-
-        e_rc = downloadTPMS(expID)
-        if e_rc != 0:
-            errorCt += 1
-            print('skipping EAE file for %s with wget return code %s\n' % (expID, e_rc))
-            failedList.append(expID)
-            continue
-
-        e_rc = downloadGROUP(expID)
-        if e_rc != 0:
-            errorCt += 1
-            print('skipping EAE file for %s with wget return code %s\n' % (expID, e_rc))
-            failedList.append(expID)
-            continue
+    print('Download %s files for %s experiments\n' % (len(jobs), totalCt))
+    # one download process at a time uses the store (see RawStore.lock())
+    store.lock()
+    results = downloadlib.downloadAll(jobs, store)
+    print('Total old files removed from the store: %s\n' % (store.prune(otherSetExperiments)))
+    store.save()
+    store.unlock()
 
-        e_rc = downloadAES(expID)
-        if e_rc != 0:
-            errorCt += 1
-            print('skipping EAE file for %s with wget return code %s' % (expID, e_rc))
-            failedList.append(expID)
-            continue
+    for expID, failedJobs in downloadlib.failedExperiments(jobs, results):
+        errorCt += 1
+        for job in failedJobs:
+            print('skipping %s file for %s: %s\n' % (job.kind, expID, results.get(job)))
+        failedList.append(expID)
 
-        successCt += 1
+    successCt = totalCt - errorCt
 
     if errorCt > 0:
         return 1
@@ -190,6 +147,10 @@ rc = downloadFiles()
 print('Total experiments in input file: %s\n' % (totalCt))
 print('Total files unable to be downloaded: %s\n' % (errorCt))
 print('Total files successfully downloaded:  %s\n' % (successCt))
+changed = store.manifest.changedExperiments()
+print('Total experiments changed upstream: %s\n' % (len(changed)))
+for e in changed:
+    print('changed: %s' % (e))
 if rc > 0:
     print("Download did not succeed on one or more experiments\n")
     if failedList:
@@ -0,0 +1,159 @@
+##########################################################################
+# 
+# Purpose:
+#       Download ArrayExpress and Expression Atlas files by experiment
+#       for both the Baseline and the Differential RNASeq sets in one pass
+#
+#       an experiment that is in both sets has its -configuration.xml and
+#       .sdrf.txt fetched and stored once (see downloadlib.RawStore)
+#
+# Usage: downloadFiles.py
+# Env Vars:
+#	 1. LOGDIR 
+#	 2. BASELINERAW_INPUTDIR, DIFFRAW_INPUTDIR - links to the downloaded
+#	    files are created in these directories
+#	 3a. EAE_TPMS_URL_TEMPLATE - url template for Expression Atlas
+#	 3b. EAE_RAWCOUNTS_URL_TEMPLATE - url template for Expression Atlas
+#	 3c. EAE_GROUP_URL_TEMPLATE - url template for Expression Atlas
+#	 3d. AES_SDRF_URL_TEMPLATE - url template for Expression Atlas
+#	 4. RAWSTORE_DIR - content-addressed store of the downloaded files
+#	 5. DOWNLOAD_MAX_WORKERS, DOWNLOAD_HOST_LIMIT, DOWNLOAD_HOST_LIMITS -
+#	    concurrency of the downloads (see downloadlib.py)
+#	 6. DOWNLOAD_SCHEME - scheme for url templates without one (http)
+#
+# Inputs:
+#	1. Database - the experiments in the 'Baseline RNASeq Load Experiments'
+#		and the 'RNASeq Load Experiments' Sets
+#	2. Configuration (see rnaseqload.config)
+#
+# Outputs:
+#	 1.  Expression Atlas file for each experiment
+#	 2.  RAWSTORE_DIR/download.manifest
+# 
+# Exit Codes:
+#
+#      0:  Successful completion
+#      1:  An exception occurred
+#
+#  Assumes:  Nothing
+#
+#  Notes:  None
+#
+###########################################################################
+import os
+import sys
+import mgi_utils
+import db
+import downloadlib
+
+# set name -> (matrix kind, matrix url template, raw input directory)
+sets = [
+    ('Baseline RNASeq Load Experiments', 'tpms', os.getenv('EAE_TPMS_URL_TEMPLATE'), os.getenv('BASELINERAW_INPUTDIR')),
+    ('RNASeq Load Experiments', 'raw-counts', os.getenv('EAE_RAWCOUNTS_URL_TEMPLATE'), os.getenv('DIFFRAW_INPUTDIR')),
+]
+
+# content-addressed store of the raw files and its manifest
+storeDir = os.getenv('RAWSTORE_DIR')
+
+# experiments unable to be downloaded, by set
+failedList = {}
+
+def init():
+    global rnaSeqSetResults, store
+
+    # files from previous runs are kept; only changed files are fetched again
+    store = downloadlib.RawStore(storeDir)
+
+    # create the result set of ids to load, by set
+    rnaSeqSetResults = {}
+    for setName, kind, template, rawInputDir in sets:
+        rnaSeqSetResults[setName] = db.sql('''
+            select a.accid
+            from MGI_Set s, MGI_SetMember m , ACC_Accession a
+            where s.name = '%s'
+            and s._set_key = m._set_key
+            and s._mgitype_key = a._mgitype_key
+            and m._object_key = a._object_key
+            and a._logicaldb_key = 189
+            and a.preferred = 1
+            ''' % (setName), 'auto')
+
+    return 0
+
+# end init() -------------------------------------------------------------
+
+#
+# download the files of all experiments of both sets concurrently
+# (see downloadlib.py)
+# an experiment is counted as an error if any of its files did not download
+#
+def downloadFiles():
+    global totalCt, errorCt
+
+    totalCt = {}
+    errorCt = {}
+
+    jobs = []
+    jobsBySet = {}
+    for setName, kind, template, rawInputDir in sets:
+        totalCt[setName] = 0
+        errorCt[setName] = 0
+        failedList[setName] = []
+        jobsBySet[setName] = []
+        for r in rnaSeqSetResults[setName]:
+            totalCt[setName] += 1
+            expID = str.strip(r['accid'])
+            jobsBySet[setName].extend(downloadlib.experimentJobs(expID, kind, template, rawInputDir))
+        jobs.extend(jobsBySet[setName])
+
+    print('Download %s files for %s experiments\n' % (len(jobs), sum(totalCt.values())))
+    # one download process at a time uses the store (see RawStore.lock())
+    store.lock()
+    results = downloadlib.downloadAll(jobs, store)
+    # both sets were requested: the urls not requested are no longer needed
+    print('Total old files removed from the store: %s\n' % (store.prune()))
+    store.save()
+    store.unlock()
+
+    for setName in jobsBySet:
+        for expID, failedJobs in downloadlib.failedExperiments(jobsBySet[setName], results):
+            errorCt[setName] += 1
+            for job in failedJobs:
+                print('skipping %s file for %s: %s\n' % (job.kind, expID, results.get(job)))
+            failedList[setName].append(expID)
+
+    if sum(errorCt.values()) > 0:
+        return 1
+
+    return 0
+
+# end downloadFiles -----------------------------------------------------------
+
+#
+# Main
+#
+
+print(mgi_utils.date())
+init()
+
+rc = downloadFiles()
+
+for setName, kind, template, rawInputDir in sets:
+    print('%s\n' % (setName))
+    print('Total experiments in input file: %s\n' % (totalCt[setName]))
+    print('Total files unable to be downloaded: %s\n' % (errorCt[setName]))
+    print('Total files successfully downloaded:  %s\n' % (totalCt[setName] - errorCt[setName]))
+changed = store.manifest.changedExperiments()
+print('Total experiments changed upstream: %s\n' % (len(changed)))
+for e in changed:
+    print('changed: %s' % (e))
+if rc > 0:
+    print("Download did not succeed on one or more experiments\n")
+    for setName in failedList:
+        if failedList[setName]:
+            print('EAE files not downloaded (%s):\n' % (setName))
+            for e in failedList[setName]:
+                print('%s\n' % (e))
+            print('Total: %s\n' % (len(failedList[setName])))
+
+print(mgi_utils.date())
@@ -0,0 +1,1051 @@
+##########################################################################
+#
+# Purpose: Download engine shared by downloadFiles.py,
+#	downloadBaselineFiles.py and downloadDiffFiles.py
+#
+#   every file of every experiment is fetched by a bounded pool of
+#   worker threads instead of one experiment/file at a time
+#
+#   DOWNLOAD_MAX_WORKERS - total number of concurrent transfers
+#   DOWNLOAD_HOST_LIMIT - default number of concurrent transfers per host
+#   DOWNLOAD_HOST_LIMITS - per host overrides, "prefix=n prefix=n ..."
+#	the prefix is matched against the url without the scheme, so
+#	"ftp.ebi.ac.uk/pub=6 ftp.ebi.ac.uk/biostudies=4" gives the
+#	Expression Atlas and the ArrayExpress (biostudies) trees their
+#	own limit although they are served by the same host
+#
+#   files are scheduled largest first (see sizeHint()) so that the long
+#   tpms/raw-counts transfers do not end up running alone at the end
+#
+#   transfers are done in-process by TransferClient, which keeps one
+#   connection per host open in each worker thread and returns a
+#   TransferStatus per file
+#
+#   files are staged as xxx.part and renamed when complete; a .part left
+#   by a dropped connection is resumed, and failed transfers are retried
+#   with exponential backoff (RetryPolicy)
+#   DOWNLOAD_RETRIES - retries per file
+#   DOWNLOAD_BACKOFF - seconds before the first retry, doubled each time
+#   DOWNLOAD_FAILURE_BUDGET - retries allowed for the whole run
+#
+#   files are kept in a content-addressed store (class RawStore,
+#   RAWSTORE_DIR) shared by the baseline and differential downloads;
+#   the input directories hold hard links to the store
+#   the tpms/raw-counts files are stored compressed with COMPRESS_CODEC
+#   (see compresslib.py), e.g. BASELINERAW_INPUTDIR/xxx-tpms.tsv.gz
+#
+#   a persistent manifest (class Manifest) records the upstream size,
+#   upstream modification time and the sha256 checksum of every url;
+#   a file is only fetched again if the upstream size or modification
+#   time has changed or its object is missing from the store
+#
+# Usage:
+#	import downloadlib
+#	store = downloadlib.RawStore(storeDir)
+#	store.lock()
+#	jobs = downloadlib.experimentJobs(expID, 'tpms', template, rawInputDir)
+#	results = downloadlib.downloadAll(jobs, store)
+#	failed = downloadlib.failedExperiments(jobs, results)
+#	store.prune(otherSetExperiments)
+#	store.save()
+#	store.unlock()
+#
+#	downloadlib.py changed RAWSTORE_DIR/download.manifest
+#	    prints the experiments that changed during the last download
+#
+###########################################################################
+
+import os
+import sys
+import json
+import datetime
+import hashlib
+import shutil
+import time
+import calendar
+import random
+import heapq
+import bisect
+import threading
+import fcntl
+import ftplib
+import http.client
+import urllib.parse
+import email.utils
+import concurrent.futures
+import compresslib
+
+maxWorkers = int(os.getenv('DOWNLOAD_MAX_WORKERS', '8'))
+hostLimit = int(os.getenv('DOWNLOAD_HOST_LIMIT', '4'))
+hostLimitsConfig = os.getenv('DOWNLOAD_HOST_LIMITS', '')
+retries = int(os.getenv('DOWNLOAD_RETRIES', '4'))
+backoff = float(os.getenv('DOWNLOAD_BACKOFF', '5'))
+failureBudget = int(os.getenv('DOWNLOAD_FAILURE_BUDGET', '50'))
+
+# size estimate by kind of file when nothing better is known
+# used only to order the transfers
+defaultSizes = {
+    'tpms' : 50000000,
+    'raw-counts' : 50000000,
+    'sdrf' : 100000,
+    'configuration' : 10000,
+}
+
+# Expression Atlas / ArrayExpress url templates (see experimentJobs())
+eagTemplate = os.getenv('EAE_GROUP_URL_TEMPLATE')
+aesTemplate = os.getenv('AES_SDRF_URL_TEMPLATE')
+
+# scheme used for the url templates that do not specify one (as wget does)
+defaultScheme = os.getenv('DOWNLOAD_SCHEME', 'http')
+
+#
+# one file to fetch for one experiment
+#
+class DownloadJob:
+
+    def __init__(self, expID, kind, url, outputFile):
+        self.expID = expID
+        self.kind = kind
+        self.url = url
+        self.outputFile = outputFile
+        self.sizeHint = sizeHint(kind, outputFile)
+
+    def __repr__(self):
+        return 'DownloadJob(%s, %s)' % (self.expID, self.kind)
+
+# end class DownloadJob
+
+#
+# estimated size of a file, used to schedule the largest files first
+#   the size of the copy from the previous run if there is one
+#   else the default size for this kind of file
+#
+def sizeHint(kind, outputFile):
+
+    try:
+        return os.path.getsize(compresslib.findFile(outputFile))
+    except (OSError, TypeError):
+        return defaultSizes.get(kind, 0)
+
+# end sizeHint()
+
+#
+# persistent record of the downloaded files
+#
+#   files : url -> {expID, kind, size, mtime, checksum, downloaded}
+#	size, mtime : upstream Content-Length, Last-Modified (epoch)
+#	checksum : sha256 of the file, names the object in the RawStore
+#   experiments : expID -> {checked, changed}
+#	checked : date of the last download run that included the experiment
+#	changed : date of the last download run that fetched any of its files
+#   requested : the urls of this run (not saved); see forget()
+#
+class Manifest:
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.runDate = datetime.datetime.now().isoformat(sep=' ')
+        self.files = {}
+        self.experiments = {}
+        self.requested = set()
+        try:
+            with open(path, 'r') as fp:
+                contents = json.load(fp)
+            self.files = contents.get('files', {})
+            self.experiments = contents.get('experiments', {})
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            print('ignoring unreadable download manifest: %s' % (path))
+
+    #
+    # the manifest entry of url or None
+    #
+    def lookup(self, url):
+
+        with self.lock:
+            return self.files.get(url)
+
+    #
+    # True if the file recorded for url is the same as the upstream file
+    #
+    def isCurrent(self, url, remote):
+
+        entry = self.lookup(url)
+        if entry == None or remote == None:
+            return False
+        return entry['size'] == remote['size'] and entry['mtime'] == remote['mtime']
+
+    #
+    # record the file of job as just downloaded
+    #
+    def record(self, job, remote, checksum, size):
+
+        mtime = None
+        if remote != None:
+            mtime = remote['mtime']
+        with self.lock:
+            self.files[job.url] = {
+                'expID' : job.expID,
+                'kind' : job.kind,
+                'size' : size,
+                'mtime' : mtime,
+                'checksum' : checksum,
+                'downloaded' : self.runDate,
+            }
+            self.experiment(job.expID)['changed'] = self.runDate
+
+    #
+    # note that the experiment of job was part of this run
+    #
+    def checked(self, job):
+
+        with self.lock:
+            self.requested.add(job.url)
+            self.experiment(job.expID)['checked'] = self.runDate
+
+    #
+    # drop the entries of the urls that were not requested in this run,
+    # and of the experiments that no longer have a url, so that the store
+    # does not keep the files of experiments that left the MGI_Sets
+    #
+    # keepExperiments : the experiments whose entries are kept all the same
+    #	(those of the set not downloaded in this run)
+    #
+    # returns the number of entries dropped
+    #
+    def forget(self, keepExperiments=()):
+
+        with self.lock:
+            dropped = [url for url, e in self.files.items() \
+                if url not in self.requested and e['expID'] not in keepExperiments]
+            for url in dropped:
+                del self.files[url]
+            expIDs = set([e['expID'] for e in self.files.values()])
+            for expID in list(self.experiments):
+                if expID not in expIDs and expID not in keepExperiments:
+                    del self.experiments[expID]
+        return len(dropped)
+
+    # caller holds the lock
+    def experiment(self, expID):
+
+        if expID not in self.experiments:
+            self.experiments[expID] = {'checked' : None, 'changed' : None}
+        return self.experiments[expID]
+
+    #
+    # the experiments with at least one file fetched since the date "since"
+    # (default: during the last run)
+    #
+    def changedExperiments(self, since=None):
+
+        if since == None:
+            since = max([e['checked'] for e in self.experiments.values() if e['checked']] or [''])
+        return sorted([expID for expID, e in self.experiments.items() \
+            if e['changed'] != None and e['changed'] >= since])
+
+    #
+    # {kind : checksum} of the files of an experiment
+    #
+    def checksums(self, expID):
+
+        with self.lock:
+            return dict([(e['kind'], e['checksum']) for e in self.files.values() if e['expID'] == expID])
+
+    #
+    # write the manifest; the previous copy is replaced atomically
+    #
+    def save(self):
+
+        tmpFile = self.path + '.tmp'
+        with self.lock:
+            with open(tmpFile, 'w') as fp:
+                json.dump({'files' : self.files, 'experiments' : self.experiments}, fp, indent=1, sort_keys=True)
+        os.replace(tmpFile, self.path)
+
+# end class Manifest
+
+#
+# content-addressed store of the raw files, shared by the baseline and
+# the differential downloads
+#
+#   storeDir/download.manifest : Manifest, url -> checksum
+#   storeDir/objects/ab/abcd... : one file per distinct content (sha256)
+#   storeDir/tmp : files being downloaded, named by url and process id
+#   storeDir/download.lock : see lock()
+#
+#   a url is fetched once per run however many jobs ask for it; every
+#   job's outputFile (BASELINERAW_INPUTDIR/..., DIFFRAW_INPUTDIR/...) is a
+#   hard link to the object, so experiments in both MGI_Sets share one
+#   -configuration.xml and one .sdrf.txt on disk
+#
+class RawStore:
+
+    def __init__(self, storeDir):
+        self.storeDir = storeDir
+        self.objectDir = os.path.join(storeDir, 'objects')
+        self.tmpDir = os.path.join(storeDir, 'tmp')
+        os.makedirs(self.objectDir, exist_ok=True)
+        os.makedirs(self.tmpDir, exist_ok=True)
+        self.manifest = Manifest(os.path.join(storeDir, 'download.manifest'))
+
+    #
+    # lock the store against the other download processes
+    # (downloadFiles.py, downloadBaselineFiles.py, downloadDiffFiles.py)
+    # until unlock(): the download, prune() and save() of one process are
+    # done before the next one starts, so a prune never removes an object
+    # another process has just added and a save never drops its entries
+    #
+    # the manifest is read again under the lock, with the entries the
+    # other processes saved meanwhile
+    #
+    def lock(self):
+
+        self.lockFile = open(os.path.join(self.storeDir, 'download.lock'), 'a')
+        try:
+            fcntl.flock(self.lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print('waiting for another download to release %s\n' % (self.lockFile.name))
+            fcntl.flock(self.lockFile, fcntl.LOCK_EX)
+        self.manifest = Manifest(self.manifest.path)
+
+    def unlock(self):
+
+        fcntl.flock(self.lockFile, fcntl.LOCK_UN)
+        self.lockFile.close()
+
+    #
+    # the object for checksum, stored with the codec for kind
+    #
+    def objectPath(self, checksum, kind):
+
+        return compresslib.compressedName(os.path.join(self.objectDir, checksum[:2], checksum), kindCodec(kind))
+
+    #
+    # where url is downloaded to before it is added to the store
+    # the name is unique to the process, so two processes never write the
+    # same file (e.g. the shared -configuration.xml and .sdrf.txt)
+    #
+    def stagingPath(self, url):
+
+        return os.path.join(self.tmpDir, '%s.%s' % (hashlib.sha1(url.encode()).hexdigest(), os.getpid()))
+
+    #
+    # the object of url if it is in the store and still current upstream
+    #
+    def current(self, url, remote):
+
+        if not self.manifest.isCurrent(url, remote):
+            return None
+        entry = self.manifest.lookup(url)
+        path = self.objectPath(entry['checksum'], entry['kind'])
+        if not os.path.exists(path):
+            return None
+        return path
+
+    #
+    # move a downloaded file into the store
+    # tpms/raw-counts files are compressed on the way (see compresslib.py)
+    # the checksum is that of the file as downloaded
+    # returns (checksum, object path)
+    #
+    def add(self, stagingFile, kind):
+
+        checksum = sha256sum(stagingFile)
+        path = self.objectPath(checksum, kind)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(stagingFile)
+        elif kindCodec(kind) == 'none':
+            os.replace(stagingFile, path)
+        else:
+            tmpFile = compresslib.compressFile(stagingFile, stagingFile + '.tmp', kindCodec(kind))
+            os.replace(tmpFile, path)
+            os.remove(stagingFile)
+        return checksum, path
+
+    #
+    # make outputFile (plus the codec suffix of the object) a hard link to
+    # the object (a copy if the store is on another file system); an
+    # existing outputFile is replaced atomically, copies of outputFile
+    # with another codec suffix are removed
+    #
+    def link(self, path, outputFile):
+
+        useCodec = compresslib.codecOf(path)
+        for other in compresslib.otherNames(outputFile, useCodec):
+            if os.path.lexists(other):
+                os.remove(other)
+        outputFile = compresslib.compressedName(outputFile, useCodec)
+        try:
+            if os.path.samefile(path, outputFile):
+                return
+        except OSError:
+            pass
+        tmpFile = outputFile + '.link'
+        if os.path.lexists(tmpFile):
+            os.remove(tmpFile)
+        try:
+            os.link(path, tmpFile)
+        except OSError:
+            shutil.copyfile(path, tmpFile)
+        os.replace(tmpFile, outputFile)
+
+    #
+    # forget the urls not requested in this run (see Manifest.forget()),
+    # then remove the objects no longer referenced by the manifest
+    # (files already linked into the input directories are not affected)
+    # and the files staged by earlier processes
+    #
+    # the caller holds the lock (see lock())
+    #
+    # returns the number of objects removed
+    #
+    def prune(self, keepExperiments=()):
+
+        print('Total urls no longer requested: %s\n' % (self.manifest.forget(keepExperiments)))
+        referenced = set([self.objectPath(e['checksum'], e['kind']) for e in self.manifest.files.values()])
+        removed = 0
+        for subDir in os.listdir(self.objectDir):
+            for name in os.listdir(os.path.join(self.objectDir, subDir)):
+                path = os.path.join(self.objectDir, subDir, name)
+                if path not in referenced:
+                    os.remove(path)
+                    removed += 1
+
+        # sha1.pid, sha1.pid.part, sha1.pid.tmp
+        for name in os.listdir(self.tmpDir):
+            if str.split(name, '.')[1:2] != [str(os.getpid())]:
+                os.remove(os.path.join(self.tmpDir, name))
+
+        return removed
+
+    def save(self):
+
+        self.manifest.save()
+
+# end class RawStore
+
+#
+# the codec the files of a kind are stored with
+# only the expression matrices are compressed
+#
+def kindCodec(kind):
+
+    if kind in ('tpms', 'raw-counts'):
+        return compresslib.codec
+    return 'none'
+
+# end kindCodec()
+
+#
+# sha256 of a local file
+#
+def sha256sum(path):
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1048576), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+# end sha256sum()
+
+#
+# the jobs to fetch the files of one experiment
+#   matrixKind : 'tpms' (baseline) or 'raw-counts' (differential)
+#   matrixTemplate : EAE_TPMS_URL_TEMPLATE or EAE_RAWCOUNTS_URL_TEMPLATE
+#   rawInputDir : BASELINERAW_INPUTDIR or DIFFRAW_INPUTDIR
+#
+def experimentJobs(expID, matrixKind, matrixTemplate, rawInputDir):
+
+    jobs = []
+
+    eaeURL = matrixTemplate % (expID, expID)
+    jobs.append(DownloadJob(expID, matrixKind, eaeURL, rawInputDir + '/' + expID + '-' + matrixKind + '.tsv'))
+
+    eaeURL = eagTemplate % (expID, expID)
+    jobs.append(DownloadJob(expID, 'configuration', eaeURL, rawInputDir + '/' + expID + '-configuration.xml'))
+
+    # E-GEOD-22131 = E, GEOD, 22131 -> 131 last 3 characters
+    tokens = expID.split('-')
+    a = tokens[0] + '-' + tokens[1] + '-'
+    b = tokens[2][-3:]
+    aesURL = aesTemplate % (a, b, expID, expID)
+    jobs.append(DownloadJob(expID, 'sdrf', aesURL, rawInputDir + '/' + expID + '.sdrf.txt'))
+
+    return jobs
+
+# end experimentJobs()
+
+#
+# parse DOWNLOAD_HOST_LIMITS into {prefix : limit}
+#
+def parseHostLimits(config):
+
+    limits = {}
+    for token in str.split(config):
+        if str.find(token, '=') == -1:
+            print('ignoring DOWNLOAD_HOST_LIMITS entry: %s' % (token))
+            continue
+        prefix, limit = str.split(token, '=', 1)
+        limits[prefix] = int(limit)
+    return limits
+
+# end parseHostLimits()
+
+#
+# the url without scheme
+#
+def stripScheme(url):
+
+    if str.find(url, '://') != -1:
+        return str.split(url, '://', 1)[1]
+    return url
+
+# end stripScheme()
+
+#
+# the key that a url is throttled under:
+#   the longest DOWNLOAD_HOST_LIMITS prefix that matches the url
+#   else the host name
+#
+def hostKey(url, limits):
+
+    path = stripScheme(url)
+    best = None
+    for prefix in limits:
+        if path.startswith(prefix) and (best == None or len(prefix) > len(best)):
+            best = prefix
+    if best != None:
+        return best
+    return str.split(path, '/', 1)[0]
+
+# end hostKey()
+
+#
+# result of one transfer (or of a stat)
+#   ok : True if the transfer succeeded
+#   code : HTTP status or FTP reply code, None if no reply was received
+#   nbytes : bytes written to disk
+#   seconds : elapsed time
+#   skipped : True if the file had not changed upstream and was not fetched
+#   resumed : offset at which a partial file was resumed
+#   attempts : number of attempts made by downloadAll()
+#   error : reason for the failure
+#
+class TransferStatus:
+
+    def __init__(self, url, path=None):
+        self.url = url
+        self.path = path
+        self.ok = False
+        self.code = None
+        self.nbytes = 0
+        self.seconds = 0.0
+        self.skipped = False
+        self.resumed = 0
+        self.attempts = 0
+        self.error = None
+
+    def __repr__(self):
+        if self.ok and self.skipped:
+            return '%s unchanged' % (self.url)
+        if self.ok and self.resumed:
+            return '%s %s bytes in %.1fs (resumed at %s)' % (self.url, self.nbytes, self.seconds, self.resumed)
+        if self.ok:
+            return '%s %s bytes in %.1fs' % (self.url, self.nbytes, self.seconds)
+        return '%s failed (code %s): %s' % (self.url, self.code, self.error)
+
+    #
+    # True if trying again may succeed
+    # (not for "404 not found" and other permanent client errors)
+    #
+    def retryable(self):
+
+        if self.ok:
+            return False
+        if self.code in (408, 416, 429):
+            return True
+        # HTTP 4xx or FTP 550 (file unavailable)
+        if self.code != None and (400 <= self.code < 500 or self.code == 550):
+            return False
+        return True
+
+# end class TransferStatus
+
+#
+# in-process HTTP/HTTPS/FTP client
+#
+#   each worker thread keeps one open connection per host (threading.local)
+#   and reuses it for every file it fetches from that host, so the
+#   TCP connect, TLS handshake and FTP login are paid once per thread
+#   instead of once per file
+#
+#   files are streamed to disk in chunkSize pieces
+#
+#   urls without a scheme use DOWNLOAD_SCHEME (default http, as wget);
+#   a template such as http://localhost:8000/%s/%s-tpms.tsv points the
+#   download at a local stand-in server
+#
+class TransferClient:
+
+    def __init__(self, timeout=60, chunkSize=1048576):
+        self.timeout = timeout
+        self.chunkSize = chunkSize
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.opened = []
+
+    #
+    # scheme, host, port, path of a url
+    #
+    def split(self, url):
+
+        if str.find(url, '://') == -1:
+            url = defaultScheme + '://' + url
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path
+        if parts.query:
+            path = path + '?' + parts.query
+        return parts.scheme, parts.hostname, parts.port, path
+
+    #
+    # the open connection of this thread for (scheme, host, port)
+    #
+    def connection(self, scheme, host, port):
+
+        if not hasattr(self.local, 'connections'):
+            self.local.connections = {}
+        key = (scheme, host, port)
+        conn = self.local.connections.get(key)
+        if conn != None:
+            return conn
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=self.timeout)
+        elif scheme == 'http':
+            conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        elif scheme == 'ftp':
+            conn = ftplib.FTP(timeout=self.timeout)
+            conn.connect(host, port or 21)
+            conn.login()
+            conn.voidcmd('TYPE I')
+        else:
+            raise ValueError('unsupported scheme: %s' % (scheme))
+        self.local.connections[key] = conn
+        with self.lock:
+            self.opened.append(conn)
+        return conn
+
+    #
+    # drop a connection that failed, the next request opens a new one
+    #
+    def discard(self, scheme, host, port):
+
+        conn = self.local.connections.pop((scheme, host, port), None)
+        if conn == None:
+            return
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    #
+    # close all connections opened by any thread
+    # only once the worker threads are done with the client
+    #
+    def close(self):
+
+        with self.lock:
+            for conn in self.opened:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self.opened = []
+
+    #
+    # send an HTTP request, following redirects
+    # a kept-alive connection that the server has closed is reopened once
+    # returns (response, final url); the caller reads the response
+    #
+    def httpRequest(self, method, url, headers={}, redirects=5):
+
+        requestHeaders = {'Connection' : 'keep-alive'}
+        requestHeaders.update(headers)
+        for i in range(redirects + 1):
+            scheme, host, port, path = self.split(url)
+            for attempt in (1, 2):
+                conn = self.connection(scheme, host, port)
+                try:
+                    conn.request(method, path, headers=requestHeaders)
+                    response = conn.getresponse()
+                    break
+                except (http.client.HTTPException, ConnectionError) as e:
+                    self.discard(scheme, host, port)
+                    if attempt == 2:
+                        raise
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader('Location')
+                response.read()
+                url = urllib.parse.urljoin('%s://%s%s' % (scheme, host, path), location)
+                continue
+            return response, url
+        raise IOError('too many redirects: %s' % (url))
+
+    #
+    # upstream size and modification time of a url
+    # returns {'size' : n, 'mtime' : epoch} or None if unknown
+    #
+    def stat(self, url):
+
+        scheme, host, port, path = self.split(url)
+        try:
+            if scheme == 'ftp':
+                conn = self.connection(scheme, host, port)
+                size = conn.size(path)
+                modified = conn.voidcmd('MDTM ' + path)[4:].strip()
+                mtime = calendar.timegm(time.strptime(modified[:14], '%Y%m%d%H%M%S'))
+                return {'size' : size, 'mtime' : mtime}
+            response, url = self.httpRequest('HEAD', url)
+            response.read()
+            size = response.getheader('Content-Length')
+            modified = response.getheader('Last-Modified')
+        except Exception as e:
+            self.discard(scheme, host, port)
+            print('%s unable to check upstream file: %s\n' % (url, e))
+            return None
+
+        if response.status != 200 or size == None or modified == None:
+            return None
+        return {'size' : int(size), 'mtime' : int(email.utils.parsedate_to_datetime(modified).timestamp())}
+
+    #
+    # stream url to outputFile
+    #
+    #   the data is staged in outputFile.part and renamed to outputFile
+    #   only once complete, so a half-written file never reaches the
+    #   preprocessing
+    #
+    #   if a .part file is left from an earlier attempt the
+    #   transfer resumes where it stopped (HTTP Range/If-Range, FTP REST);
+    #   remote (see stat()) is used to make sure the upstream file has not
+    #   changed in the meantime, and without it nothing is resumed
+    #
+    # returns a TransferStatus
+    #
+    def fetch(self, url, outputFile, remote=None):
+
+        status = TransferStatus(url, outputFile)
+        start = time.time()
+        scheme, host, port, path = self.split(url)
+        partFile = outputFile + '.part'
+
+        # a .part file is stamped with the upstream modification time
+        # it was started from; it is only resumed if that is still current.
+        # if the upstream file could not be checked (remote is None) there
+        # is nothing to validate the .part file against, so it is removed
+        # and the file is fetched from the start
+        offset = 0
+        if os.path.exists(partFile):
+            if remote == None:
+                os.remove(partFile)
+            elif os.path.getsize(partFile) <= remote['size'] and int(os.path.getmtime(partFile)) == remote['mtime']:
+                offset = os.path.getsize(partFile)
+
+        try:
+            with open(partFile, 'r+b' if offset > 0 else 'wb') as fp:
+                fp.seek(offset)
+                if scheme == 'ftp':
+                    self.ftpRetrieve(scheme, host, port, path, fp, offset, status)
+                else:
+                    self.httpRetrieve(url, fp, offset, remote, status)
+                fp.truncate()
+        except Exception as e:
+            self.discard(scheme, host, port)
+            status.ok = False
+            status.error = str(e)
+            if isinstance(e, ftplib.error_perm):
+                status.code = int(str(e)[:3])
+        status.seconds = time.time() - start
+
+        if remote != None:
+            os.utime(partFile, (remote['mtime'], remote['mtime']))
+
+        if status.ok and remote != None and os.path.getsize(partFile) != remote['size']:
+            status.ok = False
+            status.error = 'size mismatch: %s of %s bytes' % (os.path.getsize(partFile), remote['size'])
+
+        if status.ok:
+            os.replace(partFile, outputFile)
+        else:
+            if os.path.getsize(partFile) == 0:
+                os.remove(partFile)
+            print('%s\n' % (status))
+
+        return status
+
+    def httpRetrieve(self, url, fp, offset, remote, status):
+
+        headers = {}
+        if offset > 0:
+            # only resumed when remote is known (see fetch())
+            headers['Range'] = 'bytes=%s-' % (offset)
+            headers['If-Range'] = email.utils.formatdate(remote['mtime'], usegmt=True)
+
+        response, url = self.httpRequest('GET', url, headers)
+        status.code = response.status
+
+        if response.status == 206:
+            status.resumed = offset
+        elif response.status == 200:
+            # full content: the server ignored the range or the file changed
+            fp.seek(0)
+        else:
+            response.read()
+            if response.status == 416:
+                # the .part file is not a prefix of the upstream file
+                fp.seek(0)
+            status.error = response.reason
+            return
+
+        length = response.getheader('Content-Length')
+        while True:
+            chunk = response.read(self.chunkSize)
+            if not chunk:
+                break
+            fp.write(chunk)
+            status.nbytes += len(chunk)
+        if length != None and int(length) != status.nbytes:
+            status.error = 'short read: %s of %s bytes' % (status.nbytes, length)
+            return
+        status.ok = True
+
+    def ftpRetrieve(self, scheme, host, port, path, fp, offset, status):
+
+        def write(chunk):
+            fp.write(chunk)
+            status.nbytes += len(chunk)
+
+        conn = self.connection(scheme, host, port)
+        reply = conn.retrbinary('RETR ' + path, write, self.chunkSize, rest=offset or None)
+        status.code = int(reply[:3])
+        status.resumed = offset
+        status.ok = True
+
+# end class TransferClient
+
+#
+# decides if and when a failed transfer is tried again
+#
+#   retries : number of retries per file (DOWNLOAD_RETRIES)
+#   backoff : delay before the first retry in seconds, doubled for each
+#	further retry (DOWNLOAD_BACKOFF)
+#   budget : number of retries allowed for the whole run
+#	(DOWNLOAD_FAILURE_BUDGET); once used up, failures are final so
+#	that an unreachable host does not hold the run for hours
+#
+class RetryPolicy:
+
+    def __init__(self, retries, backoff, budget):
+        self.retries = retries
+        self.backoff = backoff
+        self.budget = budget
+        self.lock = threading.Lock()
+
+    #
+    # seconds to wait before retrying status, or None if not to retry
+    # a retry is charged to the budget
+    #
+    def delay(self, status):
+
+        if not status.retryable() or status.attempts > self.retries:
+            return None
+        with self.lock:
+            if self.budget <= 0:
+                return None
+            self.budget -= 1
+        wait = self.backoff * (2 ** (status.attempts - 1))
+        return wait + random.uniform(0, wait / 2.0)
+
+# end class RetryPolicy
+
+#
+# fetch all jobs concurrently
+#   at most maxWorkers transfers in total
+#   at most hostLimit (or the DOWNLOAD_HOST_LIMITS value) transfers per host
+#   largest files first
+#   files that have not changed upstream are not fetched again
+#   each url is fetched once, into the store, and linked to every job
+#   failed transfers are retried with exponential backoff (see RetryPolicy)
+#
+#   the transfers are scheduled here, not in the pool threads: a pool
+#   thread is only given a url whose host has a free slot (the largest
+#   such url first), so the urls of a busy host do not hold the threads
+#   that the other hosts could use. a url waiting for a retry holds
+#   neither a thread nor a host slot
+#
+# returns {job : TransferStatus}
+#
+def downloadAll(jobs, store):
+
+    limits = parseHostLimits(hostLimitsConfig)
+
+    client = TransferClient()
+    policy = RetryPolicy(retries, backoff, failureBudget)
+    manifest = store.manifest
+
+    # one transfer per url, whatever the number of jobs that want it
+    byURL = {}
+    for job in jobs:
+        if job.url not in byURL:
+            byURL[job.url] = []
+        byURL[job.url].append(job)
+
+    #
+    # one transfer of url
+    #
+    def attempt(url):
+        job = byURL[url][0]
+        try:
+            remote = client.stat(url)
+            path = store.current(url, remote)
+            if path != None:
+                status = TransferStatus(url, path)
+                status.ok = True
+                status.skipped = True
+                return status
+            status = client.fetch(url, store.stagingPath(url), remote)
+            if status.ok:
+                size = os.path.getsize(status.path)
+                checksum, status.path = store.add(status.path, job.kind)
+                manifest.record(job, remote, checksum, size)
+            return status
+        except Exception as e:
+            status = TransferStatus(url)
+            status.error = str(e)
+            print('%s\n' % (status))
+            return status
+
+    #
+    # link the stored file of url to every job
+    #
+    def link(url, status):
+        if status.ok:
+            try:
+                for job in byURL[url]:
+                    store.link(status.path, job.outputFile)
+            except OSError as e:
+                status.ok = False
+                status.error = 'unable to link %s: %s' % (status.path, e)
+
+    #
+    # the number of concurrent transfers allowed for the host key
+    #
+    def slots(key):
+        return max(1, limits.get(key, hostLimit))
+
+    ordered = sorted(byURL, key=lambda url: max([job.sizeHint for job in byURL[url]]), reverse=True)
+
+    # (rank, url, attempts so far) waiting for a thread and a host slot
+    pending = []
+    for rank, url in enumerate(ordered):
+        for job in byURL[url]:
+            manifest.checked(job)
+        pending.append((rank, url, 0))
+
+    retrying = []	# heap of (time, rank, url, attempts so far)
+    running = {}	# future : (rank, url, attempts)
+    active = {}		# host key : transfers running
+
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        while pending or retrying or running:
+
+            # the retries that are due go back to pending, in rank order
+            while retrying and retrying[0][0] <= time.time():
+                when, rank, url, attempts = heapq.heappop(retrying)
+                bisect.insort(pending, (rank, url, attempts))
+
+            # start the largest pending urls whose host has a free slot
+            for item in list(pending):
+                if len(running) >= maxWorkers:
+                    break
+                rank, url, attempts = item
+                key = hostKey(url, limits)
+                if active.get(key, 0) < slots(key):
+                    pending.remove(item)
+                    active[key] = active.get(key, 0) + 1
+                    running[executor.submit(attempt, url)] = (rank, url, attempts + 1)
+
+            if retrying:
+                timeout = max(0, retrying[0][0] - time.time())
+            else:
+                timeout = None
+
+            if not running:
+                time.sleep(timeout)
+                continue
+
+            done, notDone = concurrent.futures.wait(running, timeout=timeout,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for f in done:
+                rank, url, attempts = running.pop(f)
+                active[hostKey(url, limits)] -= 1
+                status = f.result()
+                status.attempts = attempts
+                wait = policy.delay(status)
+                if wait != None:
+                    print('%s retry %s in %.0fs\n' % (url, attempts, wait))
+                    heapq.heappush(retrying, (time.time() + wait, rank, url, attempts))
+                    continue
+                link(url, status)
+                for job in byURL[url]:
+                    results[job] = status
+    client.close()
+
+    return results
+
+# end downloadAll()
+
+#
+# the experiments that have at least one file that did not download
+# in the order the experiments appear in jobs
+#
+# returns [(expID, [failed job, ...]), ...]
+#
+def failedExperiments(jobs, results):
+
+    failed = []
+    byExperiment = {}
+    for job in jobs:
+        if job in results and results[job].ok:
+            continue
+        if job.expID not in byExperiment:
+            byExperiment[job.expID] = []
+            failed.append((job.expID, byExperiment[job.expID]))
+        byExperiment[job.expID].append(job)
+
+    return failed
+
+# end failedExperiments()
+
+#
+# Main
+#   downloadlib.py changed manifestFile [since]
+#
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 3 or sys.argv[1] != 'changed':
+        print('Usage: downloadlib.py changed manifestFile [since]')
+        sys.exit(1)
+
+    since = None
+    if len(sys.argv) > 3:
+        since = sys.argv[3]
+    for expID in Manifest(sys.argv[2]).changedExperiments(since):
+        print(expID)
@@ -0,0 +1,141 @@
+##########################################################################
+#
+# Purpose: Primary keys of the bcp rows, reserved in blocks from the
+#	table's sequence
+#
+#   KeyAllocator : the keys of one sequence
+#	a block of blockSize contiguous keys is reserved at a time; the
+#	next block is reserved when the block is used up
+#
+#	a block is reserved in one short transaction, under an advisory lock
+#	on the sequence: one nextval() gives the first key of the block and
+#	setval() moves the sequence to its last key. no DDL is run, so only
+#	the usage/update privilege on the sequence is needed and the other
+#	nextval() callers are not blocked. the loads (baseline, differential,
+#	their workers) take the same lock, so they never reserve the same keys
+#
+#	release() gives the unused tail of the block back to the sequence
+#	(setval() to the first unused key), unless keys were reserved after
+#	the block; the next key reserves a new block. close() releases the
+#	tail; the sequence then ends at the last key used, as the former
+#	setval(max(key)) after the load left it
+#
+#   SET_KEY_BLOCK, MEMBER_KEY_BLOCK, COMBINED_KEY_BLOCK - the block sizes
+#	(rnaseqBaseline.py, rnaseqDiff.py)
+#
+# Usage:
+#	import keylib
+#	setKeys = keylib.KeyAllocator('gxd_htsample_rnaseqset_seq', 1000)
+#	setKey = next(setKeys)
+#	keys = setKeys.take(n)
+#	setKeys.release()
+#	setKeys.close()
+#
+###########################################################################
+
+import db
+
+class KeyAllocator:
+
+    #
+    # sequence : the name of the sequence
+    # blockSize : the number of keys reserved at a time
+    #
+    def __init__(self, sequence, blockSize):
+
+        self.sequence = sequence
+        self.blockSize = blockSize
+        self.key = None
+        self.last = None
+        self.used = 0
+        self.givenBack = 0
+        self.blocks = []
+
+    #
+    # lock the sequence against the other loads until the commit
+    #
+    def lock(self):
+
+        db.sql('''select pg_advisory_xact_lock(hashtext('%s'))''' % (self.sequence), None)
+
+    #
+    # reserve the next block of keys
+    #
+    def reserve(self):
+
+        self.lock()
+        results = db.sql('''select nextval('%s') as firstKey''' % (self.sequence), 'auto')
+        self.key = results[0]['firstKey']
+        self.last = self.key + self.blockSize - 1
+        db.sql('''select setval('%s', %s)''' % (self.sequence, self.last), None)
+        db.commit()
+
+        self.blocks.append((self.key, self.last))
+
+    def __iter__(self):
+        return self
+
+    #
+    # the next key
+    #
+    def __next__(self):
+
+        if self.key == None or self.key > self.last:
+            self.reserve()
+
+        key = self.key
+        self.key += 1
+        self.used += 1
+
+        return key
+
+    #
+    # the next n keys, as a list
+    #
+    def take(self, n):
+
+        keys = []
+        while len(keys) < n:
+            if self.key == None or self.key > self.last:
+                self.reserve()
+            m = min(n - len(keys), self.last - self.key + 1)
+            keys.extend(range(self.key, self.key + m))
+            self.key += m
+            self.used += m
+
+        return keys
+
+    #
+    # give the unused tail of the block back to the sequence, unless keys
+    # were reserved after the block (the tail is then kept for next())
+    #
+    def release(self):
+
+        if self.key == None or self.key > self.last:
+            return
+
+        self.lock()
+        results = db.sql('''select last_value as lastValue from %s''' % (self.sequence), 'auto')
+        if results[0]['lastValue'] == self.last:
+            # the next nextval() returns self.key
+            db.sql('''select setval('%s', %s, false)''' % (self.sequence, self.key), None)
+            self.givenBack += self.last - self.key + 1
+            self.last = self.key - 1
+        db.commit()
+
+    #
+    # release the unused tail and report the keys used
+    #
+    def close(self):
+
+        self.release()
+
+        if self.key == None or self.key > self.last:
+            tail = 'none'
+        else:
+            tail = '%s-%s (keys were reserved after it)' % (self.key, self.last)
+
+        print('%s: %s keys used in %s block(s) of %s, given back: %s, unused: %s' % \
+            (self.sequence, self.used, len(self.blocks), self.blockSize, self.givenBack, tail))
+
+# end class KeyAllocator
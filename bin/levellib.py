@@ -0,0 +1,174 @@
+##########################################################################
+#
+# Purpose: Expression level of an avg QN TPM (GXD_HTSample_RNASeqCombined)
+#
+#   the level bins are declared once, in LEVELS, and shared by
+#   rnaseqBaseline.py and rnaseqDiff.py
+#
+#	Below Cutoff	avgQnTpm < 0.5
+#	Low		0.5 <= avgQnTpm <= 10
+#	Medium		10 < avgQnTpm <= 1000
+#	High		avgQnTpm > 1000
+#
+#   calcLevel() : the level key of one value
+#   calcLevels() : the level keys of a sequence (or array) of values in one
+#	call; vectorized with numpy if it can be imported
+#   calcLevelArray() : calcLevels() of an array, as an array (numpy)
+#
+#   a value that is not a number (nan) is Below Cutoff
+#
+# Usage:
+#	import levellib
+#	levelKey = levellib.calcLevel(avgQnTpm)
+#	levelKeys = levellib.calcLevels(avgQnTpms)
+#
+#	python levellib.py : micro-benchmark (see benchmark())
+#
+###########################################################################
+
+import sys
+import time
+import bisect
+import random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#
+# Level bins (vocabulary terms)
+#
+HIGH = 50430889
+MED = 50430890
+LOW = 50430891
+BELOW_CUTOFF = 50430892
+
+#
+# the bins, lowest first
+#   (level key, lower bound, lower bound included)
+# a value is in the last bin whose lower bound it passes
+#
+LEVELS = [
+    (BELOW_CUTOFF, None, None),
+    (LOW, 0.5, True),
+    (MED, 10, False),
+    (HIGH, 1000, False),
+    ]
+
+# the lower bounds of LEVELS[1:], and whether each is included
+bounds = [level[1] for level in LEVELS[1:]]
+boundIncluded = [level[2] for level in LEVELS[1:]]
+keys = [level[0] for level in LEVELS]
+
+if numpy != None:
+    levelKeys = numpy.array(keys, dtype=numpy.int64)
+
+#
+# the level key of avgQnTpm
+#
+def calcLevel(avgQnTpm):
+
+    # the number of lower bounds passed
+    i = bisect.bisect_left(bounds, avgQnTpm)
+    if i < len(bounds) and boundIncluded[i] and bounds[i] == avgQnTpm:
+        i += 1
+
+    return keys[i]
+
+# end calcLevel()
+
+#
+# the level keys of avgQnTpms, a sequence or float array
+# returns a list
+#
+def calcLevels(avgQnTpms):
+
+    if numpy == None:
+        return [calcLevel(v) for v in avgQnTpms]
+
+    return calcLevelArray(avgQnTpms).tolist()
+
+# end calcLevels()
+
+#
+# the level keys of avgQnTpms, an array of any shape (requires numpy)
+# returns an int64 array of the same shape
+#
+def calcLevelArray(avgQnTpms):
+
+    values = numpy.asarray(avgQnTpms, dtype=numpy.float64)
+
+    # the index of the bin of each value: the number of lower bounds passed
+    bins = numpy.zeros(values.shape, dtype=numpy.int64)
+    for key, bound, included in LEVELS[1:]:
+        if included:
+            bins += values >= bound
+        else:
+            bins += values > bound
+
+    return levelKeys[bins]
+
+# end calcLevelArray()
+
+#
+# micro-benchmark: the former per-cell calcLevel() of rnaseqBaseline.py,
+# calcLevel() and calcLevels() over n random avgQnTpm values
+#
+def benchmark(n):
+
+    # the former calcLevel(); 10 < avgQnTpm < 11 fell through to HIGH
+    def oldCalcLevel(avgQnTpm):
+        level = None
+        if avgQnTpm < 0.5:
+            level = BELOW_CUTOFF
+        elif avgQnTpm >= 0.5 and avgQnTpm <= 10:
+            level = LOW
+        elif avgQnTpm >= 11 and avgQnTpm <= 1000:
+            level = MED
+        else:  # avgQnTpm > 1000:
+            level = HIGH
+        return level
+
+    random.seed(1)
+    values = [round(10 ** random.uniform(-2, 4), 1) for i in range(n)]
+
+    start = time.perf_counter()
+    old = [oldCalcLevel(v) for v in values]
+    print('per-cell (former calcLevel): %.3f sec' % (time.perf_counter() - start))
+
+    start = time.perf_counter()
+    new = [calcLevel(v) for v in values]
+    print('per-cell (calcLevel): %.3f sec' % (time.perf_counter() - start))
+
+    start = time.perf_counter()
+    levels = calcLevels(values)
+    print('vectorized (calcLevels, numpy %s): %.3f sec' % (numpy != None, time.perf_counter() - start))
+
+    if new != levels:
+        print('error: calcLevel() and calcLevels() differ')
+        return 1
+
+    gap = [v for v, o, l in zip(values, old, levels) if o != l]
+    print('values: %s, changed level (10 < value < 11): %s' % (n, len(gap)))
+    if [v for v in gap if not (10 < v < 11)]:
+        print('error: level changed outside of 10 < value < 11')
+        return 1
+
+    return 0
+
+# end benchmark()
+
+#
+# Main
+#   python levellib.py [n] : benchmark() of n values (default 1000000)
+#
+
+if __name__ == '__main__':
+
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    else:
+        n = 1000000
+
+    sys.exit(benchmark(n))
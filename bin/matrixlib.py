@@ -0,0 +1,362 @@
+##########################################################################
+#
+# Purpose: Vectorized (NumPy) processing of the expression matrices
+#
+#   the -tpms.tsv/-raw-counts.tsv rows are read in chunks of
+#   MATRIX_CHUNK_ROWS rows; the numeric block of each chunk is parsed into
+#   a float array in one call and projected/reduced column-wise
+#
+#   MATRIX_ENGINE - numpy or python (default)
+#	numpy is used for the raw-counts group reductions (preprocessDiff.py)
+#	if the numpy module can be imported; otherwise (or if
+#	MATRIX_ENGINE=python) the scripts use their row-by-row code
+#   MATRIX_CHUNK_ROWS - rows per chunk (default 5000)
+#
+#   groupReduce() : per-group sum, mean, standard deviation and count of
+#	a chunk, the same floats as the row-by-row preprocessDiff.groupStats()
+#
+#   MatrixWriter/MatrixFile : the binary, column-oriented xxx.tpms.bin
+#	written by preprocessBaseline.py and memory-mapped by rnaseqBaseline.py
+#	(MATRIX_FORMAT=binary; requires numpy)
+#
+#	magic		8 bytes 'RNASEQM1'
+#	header length	uint64, little-endian
+#	header		json {"rows" : n, "groups" : [...],
+#			      "ensemblIds" : [...], "symbols" : [...]}
+#			padded with spaces to a multiple of 8 bytes
+#	marker keys	int64[rows], little-endian
+#	values		float64[groups][rows], little-endian; one
+#			contiguous column per group
+#
+#	the binary file is never compressed (it is memory-mapped)
+#	python matrixlib.py xxx.tpms.bin exports it as the xxx.tpms.txt tsv
+#
+#   a chunk whose numeric block does not parse (missing/extra values,
+#   NA, etc.) is returned as None so that the caller can handle that
+#   chunk row-by-row
+#
+# Usage:
+#	import matrixlib
+#	if matrixlib.enabled():
+#	    for chunk in matrixlib.chunks(rows):
+#	        matrix = matrixlib.cellValues(chunk, 2, nGroups, 5, 2)
+#
+#	sums, means, sds, counts = matrixlib.groupReduce(matrix, columnGroups, nGroups)
+#
+#	writer = matrixlib.MatrixWriter(path, groups)
+#	writer.add(ensemblIds, markerKeys, symbols, matrix)
+#	writer.close()
+#	for ensemblId, markerKey, symbol, values in matrixlib.MatrixFile(path).iterRows():
+#
+###########################################################################
+
+import os
+import sys
+import json
+import shutil
+import struct
+import warnings
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+engine = os.getenv('MATRIX_ENGINE', 'python')
+chunkRows = int(os.getenv('MATRIX_CHUNK_ROWS', '5000'))
+matrixFormat = os.getenv('MATRIX_FORMAT', 'tsv')
+
+MAGIC = b'RNASEQM1'
+
+#
+# True if the numpy engine is configured and available
+#
+def enabled():
+
+    return engine == 'numpy' and numpy != None
+
+# end enabled()
+
+#
+# True if the binary format is configured and numpy is available
+#
+def binaryEnabled():
+
+    return matrixFormat == 'binary' and numpy != None
+
+# end binaryEnabled()
+
+#
+# the rows (lists of tokens) in lists of at most size rows
+#
+def chunks(rows, size=None):
+
+    size = size or chunkRows
+    chunk = []
+    for tokens in rows:
+        chunk.append(tokens)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# end chunks()
+
+#
+# the comma separated numbers of text as a float array
+# None if text does not parse
+#
+def parse(text):
+
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', DeprecationWarning)
+            return numpy.fromstring(text, dtype=numpy.float64, sep=',')
+    except (ValueError, DeprecationWarning):
+        return None
+
+# end parse()
+
+#
+# the numeric block of a chunk as a (rows x nColumns) float array
+#   the columns tokens[first:first+nColumns] of each row hold one number
+# None if the block does not parse
+#
+def cellMatrix(chunk, first, nColumns):
+
+    text = ','.join([','.join(tokens[first:first+nColumns]) for tokens in chunk])
+    values = parse(text)
+    if values is None or values.size != len(chunk) * nColumns:
+        return None
+
+    return values.reshape(len(chunk), nColumns)
+
+# end cellMatrix()
+
+#
+# value 'stat' of each cell of the numeric block of a chunk
+# as a (rows x nColumns) float array
+#   the columns tokens[first:first+nColumns] of each row hold 'width'
+#   comma separated values (-tpms.tsv: min,q1,median,q3,max)
+# None if the block does not parse
+#
+def cellValues(chunk, first, nColumns, width, stat):
+
+    text = ','.join([','.join(tokens[first:first+nColumns]) for tokens in chunk])
+    values = parse(text)
+    if values is None or values.size != len(chunk) * nColumns * width:
+        return None
+
+    return values.reshape(len(chunk), nColumns, width)[:, :, stat]
+
+# end cellValues()
+
+#
+# per-group reductions of a (rows x nColumns) float array
+#   columnGroups : the group index of each column, -1 if the column
+#	is not in a group
+#   nGroups : the number of groups
+#
+# returns (sums, means, sds, counts), each (rows x nGroups)
+#   nan values are not counted
+#   sds is the sample standard deviation (nan if count < 2)
+#   means is nan if count = 0
+#
+# the values are added one column at a time, in column order, as
+# preprocessDiff.groupStats() adds them one value at a time, so both
+# give the same floats (a skipped nan adds 0.0, which changes nothing)
+#
+def groupReduce(matrix, columnGroups, nGroups):
+
+    rows = matrix.shape[0]
+    present = ~numpy.isnan(matrix)
+    values = numpy.where(present, matrix, 0.0)
+
+    sums = numpy.zeros((rows, nGroups), dtype=numpy.float64)
+    counts = numpy.zeros((rows, nGroups), dtype=numpy.float64)
+    for col, grp in enumerate(columnGroups):
+        if grp >= 0:
+            sums[:, grp] += values[:, col]
+            counts[:, grp] += present[:, col]
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+        squares = numpy.zeros((rows, nGroups), dtype=numpy.float64)
+        for col, grp in enumerate(columnGroups):
+            if grp >= 0:
+                deviations = numpy.where(present[:, col], values[:, col] - means[:, grp], 0.0)
+                squares[:, grp] += deviations * deviations
+        sds = numpy.where(counts > 1, numpy.sqrt(squares / (counts - 1)), numpy.nan)
+
+    return (sums, means, sds, counts)
+
+# end groupReduce()
+
+#
+# writes a MatrixFile
+#   the rows are added a chunk at a time and appended to spool files (the
+#   ensembl ids and symbols as json, the marker keys, the values row by
+#   row), so only the current chunk is in memory. close() writes the file
+#   from the spools under a temporary name and renames it; the values are
+#   turned column by column a tile (MATRIX_CHUNK_ROWS rows) at a time
+#
+class MatrixWriter:
+
+    def __init__(self, path, groups):
+
+        self.path = path
+        self.groups = list(groups)
+        self.rows = 0
+
+        self.spools = {}
+        for name, mode in (('ensemblIds', 'w'), ('symbols', 'w'), ('markerKeys', 'wb'), ('values', 'wb')):
+            self.spools[name] = open('%s.%s.tmp' % (path, name), mode)
+
+    #
+    # add a chunk of rows
+    #   matrix : (rows x groups) values
+    #
+    def add(self, ensemblIds, markerKeys, symbols, matrix):
+
+        if len(ensemblIds) == 0:
+            return
+
+        # json list items, as json.dumps() writes them
+        separator = ', ' if self.rows > 0 else ''
+        self.spools['ensemblIds'].write(separator + ', '.join(map(json.dumps, ensemblIds)))
+        self.spools['symbols'].write(separator + ', '.join(map(json.dumps, symbols)))
+
+        self.spools['markerKeys'].write(numpy.asarray(markerKeys, dtype='<i8').tobytes())
+        self.spools['values'].write(numpy.ascontiguousarray(matrix, dtype='<f8') \
+            .reshape(len(ensemblIds), len(self.groups)).tobytes())
+
+        self.rows += len(ensemblIds)
+
+    def close(self):
+
+        for fp in self.spools.values():
+            fp.close()
+
+        rows = self.rows
+        nGroups = len(self.groups)
+
+        # the header, with the ensembl ids and symbols copied from their spools
+        prefix = ('{"rows": %s, "groups": %s, "ensemblIds": [' % (rows, json.dumps(self.groups))).encode('utf-8')
+        middle = b'], "symbols": ['
+        suffix = b']}'
+        length = len(prefix) + os.path.getsize(self.spools['ensemblIds'].name) + len(middle) + \
+            os.path.getsize(self.spools['symbols'].name) + len(suffix)
+        padding = -length % 8
+
+        tmpFile = self.path + '.tmp'
+        with open(tmpFile, 'wb') as fp:
+            fp.write(MAGIC)
+            fp.write(struct.pack('<Q', length + padding))
+            fp.write(prefix)
+            with open(self.spools['ensemblIds'].name, 'rb') as spool:
+                shutil.copyfileobj(spool, fp)
+            fp.write(middle)
+            with open(self.spools['symbols'].name, 'rb') as spool:
+                shutil.copyfileobj(spool, fp)
+            fp.write(suffix + b' ' * padding)
+
+            with open(self.spools['markerKeys'].name, 'rb') as spool:
+                shutil.copyfileobj(spool, fp)
+
+            # values[g] is the column of group g: each tile of rows is
+            # written to its place in every column
+            offset = fp.tell()
+            if rows > 0 and nGroups > 0:
+                with open(self.spools['values'].name, 'rb') as spool:
+                    for start in range(0, rows, chunkRows):
+                        end = min(start + chunkRows, rows)
+                        tile = numpy.fromfile(spool, dtype='<f8', count=(end - start) * nGroups) \
+                            .reshape(end - start, nGroups)
+                        for g in range(nGroups):
+                            fp.seek(offset + 8 * (g * rows + start))
+                            fp.write(numpy.ascontiguousarray(tile[:, g]).tobytes())
+
+        os.replace(tmpFile, self.path)
+
+        for fp in self.spools.values():
+            os.remove(fp.name)
+
+# end class MatrixWriter
+
+#
+# a memory-mapped MatrixFile
+#   groups, ensemblIds, symbols : lists
+#   markerKeys : int64[rows]
+#   values : float64[groups][rows]; values[g] is the column of group g
+#
+# raises ValueError if path is not a MatrixFile
+#
+class MatrixFile:
+
+    def __init__(self, path):
+
+        with open(path, 'rb') as fp:
+            if fp.read(8) != MAGIC:
+                raise ValueError('not a matrix file: %s' % (path))
+            length = struct.unpack('<Q', fp.read(8))[0]
+            header = json.loads(fp.read(length).decode('utf-8'))
+
+        self.path = path
+        self.rows = header['rows']
+        self.groups = header['groups']
+        self.ensemblIds = header['ensemblIds']
+        self.symbols = header['symbols']
+
+        offset = 16 + length
+        nGroups = len(self.groups)
+        if self.rows > 0:
+            self.markerKeys = numpy.memmap(path, dtype='<i8', mode='r', offset=offset, shape=(self.rows,))
+        else:
+            self.markerKeys = numpy.zeros(0, dtype='<i8')
+        if self.rows > 0 and nGroups > 0:
+            self.values = numpy.memmap(path, dtype='<f8', mode='r', \
+                offset=offset + 8 * self.rows, shape=(nGroups, self.rows))
+        else:
+            self.values = numpy.zeros((nGroups, self.rows), dtype='<f8')
+
+    def __len__(self):
+        return self.rows
+
+    #
+    # (ensemblId, markerKey, symbol, values of each group) of each row
+    # read a chunk of rows at a time; values are python floats
+    #
+    def iterRows(self, size=None):
+
+        size = size or chunkRows
+        for start in range(0, self.rows, size):
+            end = min(start + size, self.rows)
+            markerKeys = self.markerKeys[start:end].tolist()
+            block = self.values[:, start:end].T.tolist()
+            for i in range(end - start):
+                yield (self.ensemblIds[start + i], markerKeys[i], self.symbols[start + i], block[i])
+
+    #
+    # write the matrix as the pre-processed tsv (xxx.tpms.txt)
+    #
+    def export(self, fp):
+
+        fp.write('ensembl_id\t_marker_key\tsymbol\t' + '\t'.join(self.groups) + '\n')
+        for ensemblId, markerKey, symbol, values in self.iterRows():
+            fp.write('\t'.join([ensemblId, str(markerKey), symbol] + list(map(repr, values))) + '\n')
+
+# end class MatrixFile
+
+#
+# Main
+#   python matrixlib.py xxx.tpms.bin : export xxx.tpms.bin as tsv on stdout
+#
+
+if __name__ == '__main__':
+
+    if len(sys.argv) != 2:
+        print('usage: matrixlib.py xxx.tpms.bin')
+        sys.exit(1)
+
+    MatrixFile(sys.argv[1]).export(sys.stdout)
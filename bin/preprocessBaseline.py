@@ -12,14 +12,28 @@
 #
 #   generated pre-processing files created in BASELINEINPUTDIR
 #	 BASELINE_TPMS_PP_FILE_TEMPLATE
+#	 or BASELINE_TPMS_BIN_FILE_TEMPLATE (MATRIX_FORMAT=binary)
 #    BASELINE_GROUP_PP_FILE_TEMPLATE
 #
+#   the tpms files (raw and pre-processed) are read and written
+#   compressed with COMPRESS_CODEC (see compresslib.py)
+#
+#   an experiment is only pre-processed again if its fingerprint changed
+#   (BASELINEINPUTDIR/preprocess.fingerprints, see fingerprint())
+#
+#   the input files are streamed one row at a time (read -> tokenize ->
+#   map -> write); the peak RSS of each experiment is printed
+#
+#   the tsv tpms values are projected row by row, as text; the binary
+#   matrix (MATRIX_FORMAT=binary) is parsed a chunk of rows at a time
+#   (see matrixlib.py)
+#
 # For each Experiment (xxx) from Baseline RNASeq MGI_Set
 #   for Experiment file in BASELINERAW_INPUTDIR
 #       process the tpms file (ppEAETpmsFile())
 #           -> BASELINEINPUTDIR/xxx.tpms.txt
 #       prcoess the sdrf file (ppAESSdrfFile())
-#           -> runToSampleDict
+#           -> runIndex (run -> sample)
 #       process the configuration (ppEAEGroupFile())
 #           -> BASELINEINPUTDIR/xxx.group.txt
 #
@@ -27,51 +41,172 @@
 
 import os
 import sys
-import xml.etree.ElementTree as ET
 import db
 import mgi_utils
+import compresslib
+import preprocesslib
+import rnaseqlib
+import matrixlib
 
 # Expression Atlas Experiment file Template - name of file stored locally
 tpmsTemplate = '%s' % os.getenv('BASELINE_TPMS_LOCAL_FILE_TEMPLATE')
 tpmsPPTemplate = '%s' % os.getenv('BASELINE_TPMS_PP_FILE_TEMPLATE')
+tpmsBinTemplate = '%s' % os.getenv('BASELINE_TPMS_BIN_FILE_TEMPLATE')
 groupTemplate = '%s' % os.getenv('BASELINE_GROUP_LOCAL_FILE_TEMPLATE')
 groupPPTemplate = '%s' % os.getenv('BASELINE_GROUP_PP_FILE_TEMPLATE')
 aesTemplate = '%s' % os.getenv('BASELINE_SDRF_LOCAL_FILE_TEMPLATE')
 
-# unique set of raw samples
-rawRunList = []
+# fingerprint of the inputs of each pre-processed experiment
+fingerprintFile = '%s/preprocess.fingerprints' % os.getenv('BASELINEINPUTDIR')
 
-# which samples to this run belong to
-# run -> sample
-runToSampleDict = {}
+# version of the pre-processed files; part of the fingerprint, so
+# changing it pre-processes every experiment again
+FORMAT_VERSION = 2
+
+# the experiments to pre-process
+setName = 'Baseline RNASeq Load Experiments'
+
+# which sample each run of the experiment belongs to
+# run -> sample (see preprocesslib.RunIndex)
+runIndex = None
 
 #
 # loads a lookup of samples in the db for the given experiment
+#   sampleInMGI : the samples of the experiment
+#   sampleExcluded : the samples that are J:DO or Relevance != Yes
+# the samples of all experiments in the set are read with one query per
+# run (see preprocesslib.sampleIndex())
 #
 def loadSamples(expID):
-    global sampleInMGI
-    sampleInMGI = []
+    global sampleInMGI, sampleExcluded
 
-    results = db.sql('''
-        select hts.name, hts._Sample_key
-        from GXD_HTSample hts, ACC_Accession a
-        where hts._Experiment_key = a._Object_key
-        and a._MGIType_key = 42 -- experiment
-        and a._LogicalDB_key = 189 --ArrayExpress
-        and a.preferred = 1
-        and a.accID = '%s' 
-        ''' % expID, 'auto')
-    for r in results:
-        key = str.strip(r['name'])
-        sampleInMGI.append(key)
+    samples = preprocesslib.sampleIndex(setName)
+    sampleInMGI = samples.inMGI(expID)
+    sampleExcluded = samples.excluded(expID)
 
     return 0
 
 # end loadSamples()
 
+#
+# the BASELINE_TPMS_PP_FILE_TEMPLATE line of each -tpms.tsv row
+#   rows : the tokens of each -tpms.tsv row (rnaseqlib.iterRows())
+#   nGroups : the number of group columns
+#
+def tpmsLines(rows, ensemblIndex, nGroups):
+
+    for tokens in rows:
+
+        ensemblID = str.strip(tokens[0])
+
+        # if ensemblID is not in MGI, then set markerKey = 0
+        # will handle this later during TPMS processing
+        markerKey, markerSymbol = ensemblIndex.lookup(ensemblID)
+
+        # each group value = min,q1,median,q3,max; keep the 3rd
+        values = [ensemblID, str(markerKey), markerSymbol]
+        for g in range(nGroups):
+            values.append(str.split(tokens[g+2], ',')[2])
+
+        yield '\t'.join(values) + '\n'
+
+# end tpmsLines()
+
+#
+# (ensemblIds, markerKeys, symbols, matrix) of each chunk of -tpms.tsv rows
+# for the binary BASELINE_TPMS_BIN_FILE_TEMPLATE (matrixlib.MatrixWriter)
+#   matrix : (rows x nGroups) float array, 3rd value of each cell
+#   the values of a chunk that does not parse are converted one at a
+#   time; a value that is not a number (NA) is stored as nan
+#
+def tpmsChunks(rows, ensemblIndex, nGroups):
+
+    for chunk in matrixlib.chunks(rows):
+
+        ensemblIDs = []
+        markerKeys = []
+        markerSymbols = []
+        for tokens in chunk:
+            ensemblID = str.strip(tokens[0])
+            markerKey, markerSymbol = ensemblIndex.lookup(ensemblID)
+            ensemblIDs.append(ensemblID)
+            markerKeys.append(markerKey)
+            markerSymbols.append(markerSymbol)
+
+        matrix = matrixlib.cellValues(chunk, 2, nGroups, 5, 2)
+        if matrix is None:
+            values = []
+            for tokens in chunk:
+                for g in range(nGroups):
+                    try:
+                        values.append(float(str.split(tokens[g+2], ',')[2]))
+                    except ValueError:
+                        values.append(float('nan'))
+            matrix = matrixlib.numpy.array(values, dtype=matrixlib.numpy.float64).reshape(len(chunk), nGroups)
+
+        yield (ensemblIDs, markerKeys, markerSymbols, matrix)
+
+# end tpmsChunks()
+
+#
+# the pre-processed tpms matrix of expID, without writing it
+# (rnaseqBaseline.py, BASELINE_FUSED)
+#
+# keepFile : also write the rows to keepFile as they are read, with the
+#	text ppEAETpmsFile() writes (tpmsLines(); BASELINE_FUSED_KEEP)
+#
+# returns (groupSet, rows)
+#   rows : (ensemblID, markerKey, markerSymbol, 3rd value of each group)
+#	the values are floats; a value that is not a number (NA) is nan
+# raises OSError if the -tpms.tsv file does not exist
+#
+def tpmsRows(expID, keepFile=None):
+
+    fpEae = compresslib.openRead(tpmsTemplate % expID)
+
+    headerList = str.split(fpEae.readline(), '\t')
+    groupSet = []
+    for h in headerList[2:]:
+        groupSet.append(str.strip(h))
+
+    ensemblIndex = preprocesslib.ensemblIndex()
+
+    def keep(tokenRows):
+        with compresslib.openWrite(keepFile) as fp:
+            fp.write('ensembl_id\t_marker_key\tsymbol\t' + '\t'.join(groupSet) + '\n')
+            for tokens in tokenRows:
+                fp.writelines(tpmsLines([tokens], ensemblIndex, len(groupSet)))
+                yield tokens
+
+    def rows():
+        tokenRows = rnaseqlib.iterRows(fpEae)
+        if keepFile != None:
+            tokenRows = keep(tokenRows)
+        if matrixlib.numpy != None:
+            for ensemblIDs, markerKeys, markerSymbols, matrix in tpmsChunks(tokenRows, ensemblIndex, len(groupSet)):
+                yield from zip(ensemblIDs, markerKeys, markerSymbols, matrix.tolist())
+        else:
+            for tokens in tokenRows:
+                ensemblID = str.strip(tokens[0])
+                markerKey, markerSymbol = ensemblIndex.lookup(ensemblID)
+                values = []
+                for g in range(len(groupSet)):
+                    try:
+                        values.append(float(str.split(tokens[g+2], ',')[2]))
+                    except ValueError:
+                        values.append(float('nan'))
+                yield (ensemblID, markerKey, markerSymbol, values)
+        fpEae.close()
+
+    return (groupSet, rows())
+
+# end tpmsRows()
+
 #
 # input  : BASELINE_TPMS_LOCAL_FILE_TEMPLATE
 # output : BASELINE_TPMS_PP_FILE_TEMPLATE
+#	or BASELINE_TPMS_BIN_FILE_TEMPLATE (MATRIX_FORMAT=binary, see matrixlib.py)
+#	the file of the other format is removed
 #
 # format:
 #   ensembm ID
@@ -87,66 +222,66 @@ def ppEAETpmsFile(expID):
     eaeFile = tpmsTemplate % expID
     print('eaeFile: %s' % eaeFile)
     try:
-        fpEae = open(eaeFile, 'r')
+        fpEae = compresslib.openRead(eaeFile)
     except:
         print('skipping: missing -tpms.tsv file: %s' % (expID))
         return 1 # file does not exist
 
-    #  create the output file
     ppFile = tpmsPPTemplate % expID
-    try:
-        fpPP = open(ppFile, 'w')
-    except:
-        return 1 # file does not exist
+    binFile = tpmsBinTemplate % expID
 
-    ensemblDict = {}
-    results = db.sql('''
-        select a.accid, a._object_key, m.symbol 
-        from acc_accession a, mrk_marker m 
-        where a._logicaldb_key = 60 
-        and a._mgitype_key = 2 
-        and a.preferred = 1
-        and a._object_key = m._marker_key
-        ''', 'auto')
-    for r in results:
-        key = r['accid']
-        value = r
-        if key not in ensemblDict:
-            ensemblDict[key] = []
-        ensemblDict[key].append(value)
+    # Ensembl id -> (marker key, symbol), loaded once per run
+    ensemblIndex = preprocesslib.ensemblIndex()
+    hits, misses = ensemblIndex.counts()
 
-    # read the header from fpEae and create header for fpPP
+    # read the header from fpEae
     headerList = str.split(fpEae.readline(), '\t')
     groupSet = []
     for h in headerList[2:]:
         groupSet.append(str.strip(h))
-    fpPP.write('ensembl_id\t_marker_key\tsymbol\t' + '\t'.join(groupSet) + '\n')
 
-    # iterate thru the fpEae input file
-    for line in fpEae.readlines():
+    rows = rnaseqlib.iterRows(fpEae)
 
-        tokens = str.split(line, '\t')
-        ensemblID = str.strip(tokens[0])
+    if matrixlib.binaryEnabled():
 
-        # if ensemblID is not in MGI, then set markerKey = 0
-        # will handle this later during TPMS processing
-        if ensemblID in ensemblDict:
-            markerKey = ensemblDict[ensemblID][0]['_object_key']
-            markerSymbol = ensemblDict[ensemblID][0]['symbol']
-        else:
-            markerKey = 0
-            markerSymbol = ''
+        # stream the fpEae input file into binFile
+        try:
+            writer = matrixlib.MatrixWriter(binFile, groupSet)
+            for chunk in tpmsChunks(rows, ensemblIndex, len(groupSet)):
+                writer.add(*chunk)
+            writer.close()
+        except OSError:
+            fpEae.close()
+            return 1
+
+        for codec in compresslib.suffixes:
+            if os.path.exists(compresslib.compressedName(ppFile, codec)):
+                os.remove(compresslib.compressedName(ppFile, codec))
+
+    else:
 
-        fpPP.write('%s\t%s\t%s' % (ensemblID, markerKey, markerSymbol))
+        #  create the output file
+        try:
+            fpPP = compresslib.openWrite(ppFile)
+        except:
+            fpEae.close()
+            return 1 # file does not exist
 
-        for g in range(len(groupSet)):
-            values = tokens[g+2].split(',')
-            fpPP.write('\t' + values[2])
+        fpPP.write('ensembl_id\t_marker_key\tsymbol\t' + '\t'.join(groupSet) + '\n')
 
-        fpPP.write('\n')
+        # stream the fpEae input file into fpPP
+        # (row by row: the text values are written as they are read)
+        fpPP.writelines(tpmsLines(rows, ensemblIndex, len(groupSet)))
+
+        fpPP.close();
+
+        if os.path.exists(binFile):
+            os.remove(binFile)
 
     fpEae.close();
-    fpPP.close();
+
+    print('ensembl ids in MGI: %s, not in MGI (markerKey = 0): %s' % \
+        (ensemblIndex.hits - hits, ensemblIndex.misses - misses))
 
     return 0
 
@@ -154,9 +289,10 @@ def ppEAETpmsFile(expID):
 
 #
 # input  : BASELINE_SDRF_LOCAL_FILE_TEMPLATE
-# output : runToSampleDict
-#   store all Source Name's per ENA_RUN
-#   E-ERAD-169.sdrf.txt : runToSampleDict['ERS223116'] = ['ERR323395', 'ERR323401']
+# output : runIndex
+#   store the Source Name of each ENA_RUN
+#   E-ERAD-169.sdrf.txt : runIndex.sample('ERR323395') = 'ERS223116'
+#   a run is stored once per experiment; the first sdrf row wins
 #
 # format:
 #   Source Name
@@ -165,7 +301,7 @@ def ppEAETpmsFile(expID):
 #
 def ppAESSdrfFile(expID, objectKey):
 
-    global rawRunList, runToSampleDict
+    global runIndex
 
     print('in ppAESSdrfFile(expID): %s' % expID)
 
@@ -177,6 +313,8 @@ def ppAESSdrfFile(expID, objectKey):
         print('skiping: missing .sdrf.txt file: %s' % (expID))
         return 1 # file does not exist
 
+    runIndex = preprocesslib.RunIndex(expID)
+
     # process the header line
     #
     headerList = str.split(fpAes.readline(), '\t')
@@ -207,9 +345,7 @@ def ppAESSdrfFile(expID, objectKey):
         return 1
 
     # iterate thru the fpEae input file
-    for line in fpAes.readlines():
-
-        tokens = str.split(line, '\t')
+    for tokens in rnaseqlib.iterRows(fpAes):
 
         sourceSample = None
         enaSample = None
@@ -226,7 +362,7 @@ def ppAESSdrfFile(expID, objectKey):
             enaRun = str.strip(tokens[enaRunIDX])
 
         # skip if this source is a duplicate; but don't report
-        if enaRun in rawRunList:
+        if enaRun in runIndex:
             #print('skipping: enaRun already processed: %s,%s' % (expID, enaRun))
             continue
 
@@ -240,28 +376,32 @@ def ppAESSdrfFile(expID, objectKey):
         # if sourceSample exists in MGI, is genotype = J:DO (_genotype_key = 90560), 
         #   or Relevance != Yes (_relevance_key != 20475450), 
         # then skip
-        ignoreResults = db.sql('''
-            select * from GXD_HTSample where (_genotype_key = 90560 or _relevance_key != 20475450)
-                and _experiment_key = %s and name = '%s' 
-            ''' % (objectKey, sourceSample), 'auto')
-        if len(ignoreResults) > 0:
+        if sourceSample in sampleExcluded:
             #print('skipping: sample is J:DO or Relevance != Yes')
             continue
 
-        rawRunList.append(enaRun)
-
-        key = enaRun
-        value = sourceSample
-        if key not in runToSampleDict:
-            runToSampleDict[key] = []
-        runToSampleDict[key].append(value)
+        runIndex.addRun(enaRun, sourceSample)
 
     fpAes.close();
 
+    print('runs: %s, duplicate runs: %s' % (len(runIndex), runIndex.duplicateRuns))
+
     return 0
 
 # end ppAESSdrfFile()
 
+#
+# the BASELINE_GROUP_PP_FILE_TEMPLATE rows of expID
+#   (group ID, label, run ID, sample ID) of each assay
+#   the runIndex of expID must be loaded (ppAESSdrfFile())
+#
+def groupRows(expID):
+
+    for id, label, runID in preprocesslib.iterAssayGroups(groupTemplate % expID):
+        yield (id, label, runID, runIndex.sample(runID, 'missing'))
+
+# end groupRows()
+
 #
 # input  : BASELINE_GROUP_LOCAL_FILE_TEMPLATE
 # output : BASELINE_GROUP_PP_FILE_TEMPLATE
@@ -299,21 +439,16 @@ def ppEAEGroupFile(expID):
     #            <assay>ERR4193654</assay>
     #            <assay>ERR4193655</assay>
     #        </assay_group>
+    #
+    # the file is streamed (see preprocesslib.iterAssayGroups())
 
-    tree = ET.parse(eaeFile)
-    root = tree.getroot()
-    assay_groups = root.findall('.//assay_group')
-    for ag in assay_groups:
-        id = ag.get('id')
-        label = ag.get('label')
-        runids = []
-        for child in ag:
-            #print(child.tag, child.text)
-            runID = child.text
-            sampleID = 'missing'
-            if runID in runToSampleDict:
-                sampleID = runToSampleDict[runID][0]
-            fpPP.write('%s\t%s\t%s\t%s\n' % (id, label, runID, sampleID))
+    try:
+        for row in groupRows(expID):
+            fpPP.write('%s\t%s\t%s\t%s\n' % row)
+    except Exception as e:
+        print('skipping: cannot read -configuration.xml: %s, %s' % (expID, e))
+        fpPP.close()
+        return 1
 
     fpPP.close();
 
@@ -321,11 +456,94 @@ def ppEAEGroupFile(expID):
 
 # end ppEAEGroupFile()
  
+#
+# the fingerprint of the inputs of expID
+#   the raw tpms, configuration and sdrf files, the Ensembl index,
+#   the samples of the experiment and the format of the output
+#
+def fingerprint(expID):
+
+    return preprocesslib.fingerprint({
+        'version' : FORMAT_VERSION,
+        'format' : 'binary' if matrixlib.binaryEnabled() else 'tsv',
+        'raw' : preprocesslib.rawChecksums(expID, {
+            'tpms' : tpmsTemplate % expID,
+            'configuration' : groupTemplate % expID,
+            'sdrf' : aesTemplate % expID,
+            }),
+        'ensembl' : preprocesslib.ensemblIndex().digest(),
+        'samples' : preprocesslib.sampleIndex(setName).digest(expID),
+        })
+
+# end fingerprint()
+
+#
+# True if the pre-processed files of expID exist
+#
+def outputsExist(expID):
+
+    if not os.path.exists(groupPPTemplate % expID):
+        return False
+    if matrixlib.binaryEnabled():
+        return os.path.exists(tpmsBinTemplate % expID)
+    return compresslib.findFile(tpmsPPTemplate % expID) != None
+
+# end outputsExist()
+
+#
+# remove the pre-processed files of expID
+#
+def removeOutputs(expID):
+
+    files = [groupPPTemplate % expID, tpmsBinTemplate % expID]
+    for codec in compresslib.suffixes:
+        files.append(compresslib.compressedName(tpmsPPTemplate % expID, codec))
+    for f in files:
+        if os.path.exists(f):
+            os.remove(f)
+
+# end removeOutputs()
+
+#
+# pre process one experiment
+#   read EAE tpms, group and AES sdrf files of expID
+#   generate tpms output file, group output file
+#
+# returns 0, or 1 if the experiment is skipped
+#
+def processExperiment(expID, objectKey):
+
+    # process the eae/tpms file for this expID
+    rc = ppEAETpmsFile(expID)
+    if rc != 0:
+        print('processing EAE tpms file returned rc %s, skipping file for %s' % (rc, expID))
+        return 1
+
+    # process the aes/sdrf file for this expID to create the runIndex
+    rc = ppAESSdrfFile(expID, objectKey)
+    if rc != 0:
+        print('processing AES sdrf file returned rc %s, skipping file for %s' % (rc, expID))
+        return 1
+
+    # process the eae/group file for this expID
+    rc = ppEAEGroupFile(expID)
+    if rc != 0:
+        print('processing EAE group file returned rc %s, skipping file for %s' % (rc, expID))
+        return 1
+
+    return 0
+
+# end processExperiment()
+
 #
 # pre processing
 #   read EAE tpms, group and AES sdrf files
 #   generate tpms output file, group output file
 #
+# the experiments are pre-processed by PREPROCESS_WORKERS worker
+# processes (see preprocesslib.runExperiments()); the log of each
+# experiment is printed in set order
+#
 # inputs:
 #	 BASELINE_TPMS_LOCAL_FILE_TEMPLATE
 #    BASELINE_GROUP_LOCAL_FILE_TEMPLATE
@@ -336,44 +554,66 @@ def ppEAEGroupFile(expID):
 #    BASELINE_GROUP_PP_FILE_TEMPLATE
 #
 def process():
-    global rawRunList
 
     results = db.sql('''
         select a.accid, a._object_key
         from MGI_Set s, MGI_SetMember m , ACC_Accession a
-        where s.name = 'Baseline RNASeq Load Experiments'
+        where s.name = '%s'
         and s._set_key = m._set_key
         and s._mgitype_key = a._mgitype_key
         and m._object_key = a._object_key
         and a._logicaldb_key = 189
         and a.preferred = 1
-        ''', 'auto')
+        ''' % (setName), 'auto')
 
-    #
-    # for each expID in the MGI_Set:
-    #
+    experiments = []
     for r in results:
+        experiments.append((str.strip(r['accid']), r['_object_key']))
 
-        expID = str.strip(r['accid'])
-        objectKey = r['_object_key']
+    #
+    # only the experiments whose inputs changed since they were last
+    # pre-processed (or whose output files are missing) are pre-processed
+    #
+    fingerprints = preprocesslib.Fingerprints(fingerprintFile)
+    digests = {}
+    changed = []
+    unchanged = []
+    for expID, objectKey in experiments:
+        digests[expID] = fingerprint(expID)
+        if fingerprints.current(expID, digests[expID]) and outputsExist(expID):
+            unchanged.append(expID)
+        else:
+            changed.append((expID, objectKey))
 
-        # process the eae/tpms file for this expID
-        rc = ppEAETpmsFile(expID)
+    #
+    # for each changed expID in the MGI_Set:
+    #
+    skipped = []
+    hits = 0
+    misses = 0
+    for expID, rc, log, counts in preprocesslib.runExperiments(processExperiment, changed):
+        print(log, end='')
         if rc != 0:
-            print('processing EAE tpms file returned rc %s, skipping file for %s' % (rc, expID))
-            continue
+            skipped.append(expID)
+            removeOutputs(expID)
+            fingerprints.drop(expID)
+        else:
+            fingerprints.record(expID, digests[expID])
+        hits += counts[0]
+        misses += counts[1]
 
-        # process the aes/sdrf file for this expID to create the runToSampleDict
-        rc = ppAESSdrfFile(expID, objectKey)
-        if rc != 0:
-            print('processing AES sdrf file returned rc %s, skipping file for %s' % (rc, expID))
-            continue
+    # experiments no longer in the MGI_Set
+    for expID in fingerprints.experiments():
+        if expID not in digests:
+            removeOutputs(expID)
+            fingerprints.drop(expID)
 
-        # process the eae/group file for this expID
-        rc = ppEAEGroupFile(expID)
-        if rc != 0:
-            print('processing EAE group file returned rc %s, skipping file for %s' % (rc, expID))
-            continue
+    fingerprints.save()
+
+    print('total ensembl ids in MGI: %s, not in MGI (markerKey = 0): %s' % (hits, misses))
+    print('experiments unchanged (not pre-processed): %s' % (len(unchanged)))
+    print('experiments pre-processed: %s, skipped: %s %s' % \
+        (len(changed) - len(skipped), len(skipped), ' '.join(skipped)))
 
     return 0
 
@@ -383,7 +623,8 @@ def process():
 # Main
 #
 
-print('start time: %s' %  mgi_utils.date())
-if process() != 0:
-     exit(1, 'Error in process()\n')
-print('end time: %s' %  mgi_utils.date())
+if __name__ == '__main__':
+    print('start time: %s' %  mgi_utils.date())
+    if process() != 0:
+         exit(1, 'Error in process()\n')
+    print('end time: %s' %  mgi_utils.date())
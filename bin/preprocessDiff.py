@@ -14,13 +14,25 @@
 #	 DIFF_RAWCOUNTS_PP_FILE_TEMPLATE
 #    DIFF_GROUP_PP_FILE_TEMPLATE
 #
+#   the raw-counts files (raw and pre-processed) are read and written
+#   compressed with COMPRESS_CODEC (see compresslib.py)
+#
+#   an experiment is only pre-processed again if its fingerprint changed
+#   (DIFFINPUTDIR/preprocess.fingerprints, see fingerprint())
+#
+#   the input files are streamed one row at a time (read -> tokenize ->
+#   map -> write); the peak RSS of each experiment is printed
+#
+#   the raw counts of each group are reduced to sum, mean, sd and count;
+#   with MATRIX_ENGINE=numpy a chunk of rows at a time (see matrixlib.py)
+#
 # For each Experiment (xxx) from RNASeq MGI_Set
 #   for Experiment file in DIFFRAW_INPUTDIR
 #       prcoess the sdrf file (ppAESSdrfFile())
-#           -> runToSampleDict
+#           -> runIndex (run -> sample)
 #       process the configuration (ppEAEGroupFile())
 #           -> DIFFINPUTDIR/xxx.group.txt
-#           -> runToGroupDict
+#           -> runIndex (run -> group)
 #       process the raw counts file (ppEAERawCountsFile())
 #           -> DIFFINPUTDIR/xxx.raw_counts.txt
 #
@@ -28,9 +40,13 @@
 
 import os
 import sys
-import xml.etree.ElementTree as ET
+import math
 import db
 import mgi_utils
+import compresslib
+import preprocesslib
+import rnaseqlib
+import matrixlib
 
 #db.setTrace(True)
 
@@ -41,40 +57,140 @@ groupTemplate = '%s' % os.getenv('DIFF_GROUP_LOCAL_FILE_TEMPLATE')
 groupPPTemplate = '%s' % os.getenv('DIFF_GROUP_PP_FILE_TEMPLATE')
 aesTemplate = '%s' % os.getenv('DIFF_SDRF_LOCAL_FILE_TEMPLATE')
 
-# unique set of raw samples
-rawRunList = []
+# fingerprint of the inputs of each pre-processed experiment
+fingerprintFile = '%s/preprocess.fingerprints' % os.getenv('DIFFINPUTDIR')
 
-# which samples belong to this run
-# run -> sample
-runToSampleDict = {}
-# which group belong to this run
-# run -> group
-runToGroupDict = {}
+# version of the pre-processed files; part of the fingerprint, so
+# changing it pre-processes every experiment again
+# 3 : the group sums are added in column order (see groupStats())
+FORMAT_VERSION = 3
+
+# the experiments to pre-process
+setName = 'RNASeq Load Experiments'
+
+# which sample/group each run of the experiment belongs to
+# run -> sample, run -> group (see preprocesslib.RunIndex)
+runIndex = None
 
 #
 # loads a lookup of samples in the db for the given experiment
+#   sampleInMGI : the samples of the experiment
+#   sampleExcluded : the samples that are J:DO or Relevance != Yes
+# the samples of all experiments in the set are read with one query per
+# run (see preprocesslib.sampleIndex())
 #
 def loadSamples(expID):
-    global sampleInMGI
-    sampleInMGI = []
+    global sampleInMGI, sampleExcluded
 
-    results = db.sql('''
-        select hts.name, hts._Sample_key
-        from GXD_HTSample hts, ACC_Accession a
-        where hts._Experiment_key = a._Object_key
-        and a._MGIType_key = 42 -- experiment
-        and a._LogicalDB_key = 189 --ArrayExpress
-        and a.preferred = 1
-        and a.accID = '%s' 
-        ''' % expID, 'auto')
-    for r in results:
-        key = str.strip(r['name'])
-        sampleInMGI.append(key)
+    samples = preprocesslib.sampleIndex(setName)
+    sampleInMGI = samples.inMGI(expID)
+    sampleExcluded = samples.excluded(expID)
 
     return 0
 
 # end loadSamples()
 
+#
+# sum, mean, sample standard deviation and count of a group's values
+# as DIFF_RAWCOUNTS_PP_FILE_TEMPLATE text; nan values are not counted
+#
+# the values are added one at a time, in order, as matrixlib.groupReduce()
+# adds them, so that MATRIX_ENGINE does not change the text
+#
+def groupStats(values):
+
+    values = [v for v in values if not math.isnan(v)]
+    n = len(values)
+    total = 0.0
+    for v in values:
+        total += v
+    mean = total / n if n > 0 else math.nan
+    squares = 0.0
+    for v in values:
+        squares += (v - mean) * (v - mean)
+    sd = math.sqrt(squares / (n - 1)) if n > 1 else math.nan
+
+    return '%r\t%r\t%r\t%s' % (total, mean, sd, n)
+
+# end groupStats()
+
+#
+# a raw count as a float, nan if it is missing (NA, '')
+#
+def countValue(value):
+
+    try:
+        return float(value)
+    except ValueError:
+        return math.nan
+
+# end countValue()
+
+#
+# the DIFF_RAWCOUNTS_PP_FILE_TEMPLATE line of each -raw-counts.tsv row
+#   rows : the tokens of each -raw-counts.tsv row (rnaseqlib.iterRows())
+#   columnGroups : the group index of each run column (tokens[2:]),
+#	-1 if the run is not in a group
+#   nGroups : the number of groups
+#
+def rawCountsLines(rows, ensemblIndex, columnGroups, nGroups):
+
+    for tokens in rows:
+
+        ensemblID = str.strip(tokens[0])
+
+        # if ensemblID is not in MGI, then set markerKey = 0
+        # will handle this later during RAWCOUNTS processing
+        markerKey, markerSymbol = ensemblIndex.lookup(ensemblID)
+
+        # for each column in this row
+        #   determine the "group" for the column (see columnGroups)
+        #   append the count to the "group" (groupCounts)
+        groupCounts = [[] for g in range(nGroups)]
+        for col, grp in enumerate(columnGroups):
+            if grp >= 0:
+                groupCounts[grp].append(countValue(tokens[col+2]))
+
+        values = [ensemblID, str(markerKey), markerSymbol]
+        for counts in groupCounts:
+            values.append(groupStats(counts))
+
+        yield '\t'.join(values) + '\n'
+
+# end rawCountsLines()
+
+#
+# rawCountsLines(), vectorized
+#   the counts of a chunk of rows are parsed into a float array at once
+#   and reduced per group with one matrix product per statistic
+#   (matrixlib.groupReduce(), the same text as rawCountsLines());
+#   the chunk is written as one string
+#   a chunk that does not parse is written by rawCountsLines()
+#
+def rawCountsChunkLines(rows, ensemblIndex, columnGroups, nGroups):
+
+    for chunk in matrixlib.chunks(rows):
+
+        matrix = matrixlib.cellMatrix(chunk, 2, len(columnGroups))
+        if matrix is None:
+            yield from rawCountsLines(chunk, ensemblIndex, columnGroups, nGroups)
+            continue
+
+        sums, means, sds, counts = matrixlib.groupReduce(matrix, columnGroups, nGroups)
+
+        lines = []
+        for i, tokens in enumerate(chunk):
+            ensemblID = str.strip(tokens[0])
+            markerKey, markerSymbol = ensemblIndex.lookup(ensemblID)
+            values = [ensemblID, str(markerKey), markerSymbol]
+            for total, mean, sd, n in zip(sums[i].tolist(), means[i].tolist(), sds[i].tolist(), counts[i].tolist()):
+                values.append('%r\t%r\t%r\t%s' % (total, mean, sd, int(n)))
+            lines.append('\t'.join(values) + '\n')
+
+        yield ''.join(lines)
+
+# end rawCountsChunkLines()
+
 #
 # input  : DIFF_RAWCOUNTS_LOCAL_FILE_TEMPLATE
 # output : DIFF_RAWCOUNTS_PP_FILE_TEMPLATE
@@ -88,7 +204,12 @@ def loadSamples(expID):
 #   ensembm ID
 #   marker key
 #   marker symbol
-#   each group (g1, g2, etc. value = 3rd value avg QN TPM)
+#   each group (g1, g2, etc.) : 4 columns, the raw counts of the runs
+#	in the group reduced to
+#	g1.sum : sum
+#	g1.mean : mean
+#	g1.sd : sample standard deviation (nan if < 2 runs)
+#	g1.n : number of runs (with a count)
 #
 def ppEAERawCountsFile(expID):
 
@@ -98,7 +219,7 @@ def ppEAERawCountsFile(expID):
     eaeFile = rawcountsTemplate % expID
     print('eaeFile: %s' % eaeFile)
     try:
-        fpEae = open(eaeFile, 'r')
+        fpEae = compresslib.openRead(eaeFile)
     except:
         print('skipping: missing -rawcounts.tsv file: %s' % (expID))
         return 1 # file does not exist
@@ -106,111 +227,70 @@ def ppEAERawCountsFile(expID):
     #  create the output file
     ppFile = rawcountsPPTemplate % expID
     try:
-        fpPP = open(ppFile, 'w')
+        fpPP = compresslib.openWrite(ppFile)
     except:
         return 1 # file does not exist
 
-    ensemblDict = {}
-    results = db.sql('''
-        select a.accid, a._object_key, m.symbol 
-        from acc_accession a, mrk_marker m 
-        where a._logicaldb_key = 60 
-        and a._mgitype_key = 2 
-        and a.preferred = 1
-        and a._object_key = m._marker_key
-        ''', 'auto')
-    for r in results:
-        key = r['accid']
-        value = r
-        if key not in ensemblDict:
-            ensemblDict[key] = []
-        ensemblDict[key].append(value)
+    # Ensembl id -> (marker key, symbol), loaded once per run
+    ensemblIndex = preprocesslib.ensemblIndex()
+    hits, misses = ensemblIndex.counts()
 
     # read the header from fpEae and create header for fpPP
     # each "run" is in its own column
-    # each oolumn belongs to a specific group (runToGroupDict['ERR4873299'][0] = 'g1')
-    # track the column -> group (columnGroup[2] = ['g1'])
+    # each oolumn belongs to a specific group (runIndex.group('ERR4873299') = 'g1')
+    # track the group index of each column (columnGroups[0] = 0 ('g1'))
+    # a run that is not in a group is skipped (columnGroups[n] = -1)
     # 1 group can be in more than 1 column
     # 1 column can only be in 1 group
     headerList = str.split(fpEae.readline(), '\t')
-    col = 2
-    columnGroup = {}
+    columnGroups = []
     groupList = []
     for h in headerList[2:]:
 
         h = str.strip(h)
 
-        if h not in runToGroupDict:
-            print('skipping: run not found in runToGroupDict: %s, %s' % (expID, h))
+        if not runIndex.hasGroup(h):
+            print('skipping: run not found in runIndex: %s, %s' % (expID, h))
+            columnGroups.append(-1)
             continue
 
-        grp = runToGroupDict[h][0]
-
-        columnGroup[col] = []
-        columnGroup[col].append(grp)
+        grp = runIndex.group(h)
 
         if grp not in groupList:
             groupList.append(grp)
 
-        col += 1
+        columnGroups.append(groupList.index(grp))
 
-    fpPP.write('ensembl_id\t_marker_key\tsymbol\t')
-    fpPP.write('\t'.join(groupList) + '\n')
+    header = ['ensembl_id', '_marker_key', 'symbol']
+    for grp in groupList:
+        header.extend([grp + '.sum', grp + '.mean', grp + '.sd', grp + '.n'])
+    fpPP.write('\t'.join(header) + '\n')
     print(headerList)
-    #print(columnGroup)
     print(groupList)
 
-    # iterate thru the fpEae input file
-    for line in fpEae.readlines():
-
-        groupTPM = {}
-
-        tokens = str.split(line[:-1], '\t')
-        ensemblID = str.strip(tokens[0])
-
-        # if ensemblID is not in MGI, then set markerKey = 0
-        # will handle this later during RAWCOUNTS processing
-        if ensemblID in ensemblDict:
-            markerKey = ensemblDict[ensemblID][0]['_object_key']
-            markerSymbol = ensemblDict[ensemblID][0]['symbol']
-        else:
-            markerKey = 0
-            markerSymbol = ''
-
-        fpPP.write('%s\t%s\t%s' % (ensemblID, markerKey, markerSymbol))
-
-        # for each column in this row
-        #   determine the "group" for the column (see columnGroup)
-        #   append the tpm value to the "group" (groupTPM)
-        col = 2
-        for value in tokens[2:]:
-             if col not in columnGroup:
-                #only print for debugging as this returns many rows
-                #print('skipping: column not found in columnGroup: %s, %s' % (expID, col))
-                continue
-             grp = columnGroup[col][0]
-             if grp not in groupTPM:
-                groupTPM[grp] = []
-             groupTPM[grp].append(value)
-             col += 1
-
-        #print(groupTPM)    
-        for grp in groupTPM:
-            fpPP.write('\t' + ','.join(groupTPM[grp]))
-        fpPP.write('\n')
+    # stream the fpEae input file into fpPP
+    rows = rnaseqlib.iterRows(fpEae)
+    if matrixlib.enabled():
+        fpPP.writelines(rawCountsChunkLines(rows, ensemblIndex, columnGroups, len(groupList)))
+    else:
+        fpPP.writelines(rawCountsLines(rows, ensemblIndex, columnGroups, len(groupList)))
 
     fpEae.close();
     fpPP.close();
 
+    print('ensembl ids in MGI: %s, not in MGI (markerKey = 0): %s' % \
+        (ensemblIndex.hits - hits, ensemblIndex.misses - misses))
+
     return 0
 
 # end ppEAERawCountsFile()
 
 #
 # input  : DIFF_SDRF_LOCAL_FILE_TEMPLATE
-# output : runToSampleDict
-#   store all Source Name's per ENA_RUN
-#   E-ERAD-169.sdrf.txt : runToSampleDict['ERS223116'] = ['ERR323395', 'ERR323401']
+# output : runIndex
+#   store the Source Name of each ENA_RUN
+#   E-ERAD-169.sdrf.txt : runIndex.sample('ERR323395') = 'ERS223116'
+#   a run is stored once per experiment; the first sdrf row wins
 #
 # format:
 #   Source Name
@@ -219,11 +299,11 @@ def ppEAERawCountsFile(expID):
 #
 def ppAESSdrfFile(expID, objectKey):
 
-    global rawRunList, runToSampleDict
+    global runIndex
 
     print('in ppAESSdrfFile(expID, object_key): %s,%s' % (expID, objectKey))
 
-    runToSampleDict = {}
+    runIndex = preprocesslib.RunIndex(expID)
 
     #  read the input file
     aesFile = aesTemplate % expID
@@ -263,9 +343,7 @@ def ppAESSdrfFile(expID, objectKey):
         return 1
 
     # iterate thru the fpEae input file
-    for line in fpAes.readlines():
-
-        tokens = str.split(line, '\t')
+    for tokens in rnaseqlib.iterRows(fpAes):
 
         sourceSample = None
         enaSample = None
@@ -282,7 +360,7 @@ def ppAESSdrfFile(expID, objectKey):
             enaRun = str.strip(tokens[enaRunIDX])
 
         # skip if this source is a duplicate; but don't report
-        if enaRun in rawRunList:
+        if enaRun in runIndex:
             #print('skipping: enaRun already processed: %s,%s' % (expID, enaRun))
             continue
 
@@ -296,24 +374,16 @@ def ppAESSdrfFile(expID, objectKey):
         # if sourceSample exists in MGI, is genotype = J:DO (_genotype_key = 90560), 
         #   or Relevance != Yes (_relevance_key != 20475450), 
         # then skip
-        ignoreResults = db.sql('''
-            select * from GXD_HTSample where (_genotype_key = 90560 or _relevance_key != 20475450)
-                and _experiment_key = %s and name = '%s' 
-            ''' % (objectKey, sourceSample), 'auto')
-        if len(ignoreResults) > 0:
+        if sourceSample in sampleExcluded:
             #print('skipping: sample is J:DO or Relevance != Yes')
             continue
 
-        rawRunList.append(enaRun)
-
-        key = enaRun
-        value = sourceSample
-        if key not in runToSampleDict:
-            runToSampleDict[key] = []
-        runToSampleDict[key].append(value)
+        runIndex.addRun(enaRun, sourceSample)
 
     fpAes.close();
 
+    print('runs: %s, duplicate runs: %s' % (len(runIndex), runIndex.duplicateRuns))
+
     return 0
 
 # end ppAESSdrfFile()
@@ -329,12 +399,9 @@ def ppAESSdrfFile(expID, objectKey):
 #   Sample IDs
 #
 def ppEAEGroupFile(expID):
-    global runToGroupDict
 
     print('in ppEAEGroupFile(expID): %s' % expID)
 
-    runToGroupDict = {}
-
     #  read the input file
     try:
         eaeFile = groupTemplate % expID
@@ -362,45 +429,122 @@ def ppEAEGroupFile(expID):
     #            <assay>ERR4193654</assay>
     #            <assay>ERR4193655</assay>
     #        </assay_group>
+    #
+    # the file is streamed and the xxx_yyy groups are skipped as it is
+    # read (see preprocesslib.iterAssayGroups())
 
     print(eaeFile)
-    tree = ET.parse(eaeFile)
-    root = tree.getroot()
-    assay_groups = root.findall('.//assay_group')
-    for ag in assay_groups:
-        id = ag.get('id')
-        if str.find(id, '_') > -1:
-            continue
-        label = ag.get('label')
-        runids = []
-        for child in ag:
-            #print(child.tag, child.text)
-            runID = child.text
-            sampleID = 'missing'
-            if runID not in runToSampleDict:
+    try:
+        for id, label, runID in preprocesslib.iterAssayGroups(eaeFile, skipUnderscore=True):
+            if runID not in runIndex:
                 continue
-            if runID in runToSampleDict:
-                sampleID = runToSampleDict[runID][0]
+            sampleID = runIndex.sample(runID)
 
             # save this to use in ppEAERawCountsFile()
-            if id not in runToGroupDict:
-                runToGroupDict[runID] = []
-            runToGroupDict[runID].append(id)
+            # a run in more than one assay_group keeps the last one
+            runIndex.setGroup(runID, id)
 
             fpPP.write('%s\t%s\t%s\t%s\n' % (id, label, runID, sampleID))
+    except Exception as e:
+        print('skipping: cannot read -configuration.xml: %s, %s' % (expID, e))
+        fpPP.close()
+        return 1
 
     fpPP.close();
-    print(runToGroupDict)
+    print('runs in groups: %s, group conflicts: %s' % (len(runIndex.runToGroup), runIndex.groupConflicts))
 
     return 0
 
 # end ppEAEGroupFile()
  
+#
+# the fingerprint of the inputs of expID
+#   the raw raw-counts, configuration and sdrf files, the Ensembl index
+#   and the samples of the experiment
+#
+def fingerprint(expID):
+
+    return preprocesslib.fingerprint({
+        'version' : FORMAT_VERSION,
+        'raw' : preprocesslib.rawChecksums(expID, {
+            'raw-counts' : rawcountsTemplate % expID,
+            'configuration' : groupTemplate % expID,
+            'sdrf' : aesTemplate % expID,
+            }),
+        'ensembl' : preprocesslib.ensemblIndex().digest(),
+        'samples' : preprocesslib.sampleIndex(setName).digest(expID),
+        })
+
+# end fingerprint()
+
+#
+# True if the pre-processed files of expID exist
+#
+def outputsExist(expID):
+
+    return os.path.exists(groupPPTemplate % expID) and \
+        compresslib.findFile(rawcountsPPTemplate % expID) != None
+
+# end outputsExist()
+
+#
+# remove the pre-processed files of expID
+#
+def removeOutputs(expID):
+
+    files = [groupPPTemplate % expID]
+    for codec in compresslib.suffixes:
+        files.append(compresslib.compressedName(rawcountsPPTemplate % expID, codec))
+    for f in files:
+        if os.path.exists(f):
+            os.remove(f)
+
+# end removeOutputs()
+
+#
+# pre process one experiment
+#   read EAE rawcounts, group and AES sdrf files of expID
+#   generate rawcounts output file, group output file
+#
+# returns 0, or 1 if the experiment is skipped
+#
+def processExperiment(expID, objectKey):
+
+    #
+    # order is important!
+    #
+
+    # process the aes/sdrf file for this expID to create the runIndex
+    rc = ppAESSdrfFile(expID, objectKey)
+    if rc != 0:
+        print('processing AES sdrf file returned rc %s, skipping file for %s' % (rc, expID))
+        return 1
+
+    # process the eae/group file for this expID
+    rc = ppEAEGroupFile(expID)
+    if rc != 0:
+        print('processing EAE group file returned rc %s, skipping file for %s' % (rc, expID))
+        return 1
+
+    # process the eae/rawcounts file for this expID
+    rc = ppEAERawCountsFile(expID)
+    if rc != 0:
+        print('processing EAE rawcounts file returned rc %s, skipping file for %s' % (rc, expID))
+        return 1
+
+    return 0
+
+# end processExperiment()
+
 #
 # pre processing
 #   read EAE rawcounts, group and AES sdrf files
 #   generate rawcounts output file, group output file
 #
+# the experiments are pre-processed by PREPROCESS_WORKERS worker
+# processes (see preprocesslib.runExperiments()); the log of each
+# experiment is printed in set order
+#
 # inputs:
 #	 DIFF_RAWCOUNTS_LOCAL_FILE_TEMPLATE
 #    DIFF_GROUP_LOCAL_FILE_TEMPLATE
@@ -411,48 +555,66 @@ def ppEAEGroupFile(expID):
 #    DIFF_GROUP_PP_FILE_TEMPLATE
 #
 def process():
-    global rawRunList
 
     results = db.sql('''
         select a.accid, a._object_key
         from MGI_Set s, MGI_SetMember m , ACC_Accession a
-        where s.name = 'RNASeq Load Experiments'
+        where s.name = '%s'
         and s._set_key = m._set_key
         and s._mgitype_key = a._mgitype_key
         and m._object_key = a._object_key
         and a._logicaldb_key = 189
         and a.preferred = 1
-        ''', 'auto')
+        ''' % (setName), 'auto')
 
-    #
-    # for each expID in the MGI_Set:
-    #
+    experiments = []
     for r in results:
+        experiments.append((str.strip(r['accid']), r['_object_key']))
 
-        expID = str.strip(r['accid'])
-        objectKey = r['_object_key']
-
-        #
-        # order is important!
-        #
+    #
+    # only the experiments whose inputs changed since they were last
+    # pre-processed (or whose output files are missing) are pre-processed
+    #
+    fingerprints = preprocesslib.Fingerprints(fingerprintFile)
+    digests = {}
+    changed = []
+    unchanged = []
+    for expID, objectKey in experiments:
+        digests[expID] = fingerprint(expID)
+        if fingerprints.current(expID, digests[expID]) and outputsExist(expID):
+            unchanged.append(expID)
+        else:
+            changed.append((expID, objectKey))
 
-        # process the aes/sdrf file for this expID to create the runToSampleDict
-        rc = ppAESSdrfFile(expID, objectKey)
+    #
+    # for each changed expID in the MGI_Set:
+    #
+    skipped = []
+    hits = 0
+    misses = 0
+    for expID, rc, log, counts in preprocesslib.runExperiments(processExperiment, changed):
+        print(log, end='')
         if rc != 0:
-            print('processing AES sdrf file returned rc %s, skipping file for %s' % (rc, expID))
-            continue
+            skipped.append(expID)
+            removeOutputs(expID)
+            fingerprints.drop(expID)
+        else:
+            fingerprints.record(expID, digests[expID])
+        hits += counts[0]
+        misses += counts[1]
 
-        # process the eae/group file for this expID
-        rc = ppEAEGroupFile(expID)
-        if rc != 0:
-            print('processing EAE group file returned rc %s, skipping file for %s' % (rc, expID))
-            continue
+    # experiments no longer in the MGI_Set
+    for expID in fingerprints.experiments():
+        if expID not in digests:
+            removeOutputs(expID)
+            fingerprints.drop(expID)
 
-        # process the eae/rawcounts file for this expID
-        rc = ppEAERawCountsFile(expID)
-        if rc != 0:
-            print('processing EAE rawcounts file returned rc %s, skipping file for %s' % (rc, expID))
-            continue
+    fingerprints.save()
+
+    print('total ensembl ids in MGI: %s, not in MGI (markerKey = 0): %s' % (hits, misses))
+    print('experiments unchanged (not pre-processed): %s' % (len(unchanged)))
+    print('experiments pre-processed: %s, skipped: %s %s' % \
+        (len(changed) - len(skipped), len(skipped), ' '.join(skipped)))
 
     return 0
 
@@ -462,7 +624,8 @@ def process():
 # Main
 #
 
-print('start time: %s' %  mgi_utils.date())
-if process() != 0:
-     exit(1, 'Error in process()\n')
-print('end time: %s' %  mgi_utils.date())
+if __name__ == '__main__':
+    print('start time: %s' %  mgi_utils.date())
+    if process() != 0:
+         exit(1, 'Error in process()\n')
+    print('end time: %s' %  mgi_utils.date())
@@ -0,0 +1,536 @@
+##########################################################################
+#
+# Purpose: Lookups shared by preprocessBaseline.py and preprocessDiff.py
+#
+#   EnsemblIndex : Ensembl gene id -> (marker key, symbol)
+#	loaded once per run (ensemblIndex()) and shared by every experiment
+#
+#   SampleIndex : experiment -> samples in MGI, samples to exclude
+#	loaded with one query per run (sampleIndex()) so that the sdrf
+#	rows are checked in memory
+#
+#   RunIndex : run -> sample -> group of one experiment
+#	built from the sdrf and configuration files; hashed membership
+#
+#   iterAssayGroups() : (group id, label, run) of each assay of a
+#	-configuration.xml, streamed (iterparse)
+#
+#   Fingerprints : the fingerprint of the inputs of each pre-processed
+#	experiment (raw file checksums, Ensembl index, samples, format);
+#	experiments whose fingerprint is unchanged are not pre-processed again
+#
+#   runExperiments() : pre-process the experiments of a set, one at a time
+#	or fanned out over PREPROCESS_WORKERS worker processes
+#
+# Usage:
+#	import preprocesslib
+#	index = preprocesslib.ensemblIndex()
+#	markerKey, markerSymbol = index.lookup(ensemblID)
+#
+#	samples = preprocesslib.sampleIndex(setName)
+#	if sample in samples.inMGI(expID) and sample not in samples.excluded(expID):
+#
+#	runs = preprocesslib.RunIndex(expID)
+#	runs.addRun(enaRun, sourceSample)
+#	runs.setGroup(runID, groupID)
+#	sampleID = runs.sample(runID, 'missing')
+#
+#	for groupID, label, runID in preprocesslib.iterAssayGroups(configFile):
+#
+#	fingerprints = preprocesslib.Fingerprints(path)
+#	digest = preprocesslib.fingerprint({...})
+#	if not fingerprints.current(expID, digest):
+#	    ...
+#	    fingerprints.record(expID, digest)
+#	fingerprints.save()
+#
+#	for expID, rc, log, counts in preprocesslib.runExperiments(processExperiment, experiments):
+#
+###########################################################################
+
+import os
+import sys
+import io
+import json
+import hashlib
+import types
+import contextlib
+import traceback
+import multiprocessing
+import xml.etree.ElementTree as ET
+import db
+import rnaseqlib
+import compresslib
+import downloadlib
+
+# worker processes for runExperiments()
+workers = int(os.getenv('PREPROCESS_WORKERS', '1'))
+
+#
+# Ensembl gene id -> (marker key, symbol)
+#
+#   built once from the acc_accession/mrk_marker rows of _logicaldb_key = 60;
+#   if an Ensembl id is associated with more than one marker, the first
+#   row is kept (as before); these ids are reported by the loaders
+#
+#   the mapping is read-only; hits/misses count the lookups so that the
+#   ids that fall through to markerKey = 0 can be reported
+#
+class EnsemblIndex:
+
+    def __init__(self, results):
+
+        markers = {}
+        for r in results:
+            key = sys.intern(r['accid'])
+            if key not in markers:
+                markers[key] = (r['_object_key'], sys.intern(r['symbol']))
+        self.markers = types.MappingProxyType(markers)
+        self.hits = 0
+        self.misses = 0
+        self._digest = None
+
+    def __len__(self):
+        return len(self.markers)
+
+    #
+    # (marker key, symbol) of ensemblID
+    # (0, '') if ensemblID is not in MGI
+    #
+    def lookup(self, ensemblID):
+
+        value = self.markers.get(ensemblID)
+        if value == None:
+            self.misses += 1
+            return (0, '')
+        self.hits += 1
+        return value
+
+    #
+    # (hits, misses) so far
+    #
+    def counts(self):
+
+        return (self.hits, self.misses)
+
+    #
+    # sha256 of the mapping; changes when any id/marker changes
+    #
+    def digest(self):
+
+        if self._digest == None:
+            h = hashlib.sha256()
+            for key in sorted(self.markers):
+                h.update(('%s\t%s\t%s\n' % (key, self.markers[key][0], self.markers[key][1])).encode('utf-8'))
+            self._digest = h.hexdigest()
+        return self._digest
+
+# end class EnsemblIndex
+
+_ensemblIndex = None
+
+#
+# the EnsemblIndex of this run, loaded on first use
+#
+def ensemblIndex():
+    global _ensemblIndex
+
+    if _ensemblIndex == None:
+        results = db.sql('''
+            select a.accid, a._object_key, m.symbol
+            from acc_accession a, mrk_marker m
+            where a._logicaldb_key = 60
+            and a._mgitype_key = 2
+            and a.preferred = 1
+            and a._object_key = m._marker_key
+            ''', 'auto')
+        _ensemblIndex = EnsemblIndex(results)
+        print('ensembl index: %s ids' % (len(_ensemblIndex)))
+
+    return _ensemblIndex
+
+# end ensemblIndex()
+
+#
+# GXD_HTSample names by experiment (ArrayExpress id)
+#
+#   inMGI : the samples of the experiment
+#   excluded : the samples that are not loaded:
+#	genotype = J:DO (_genotype_key = 90560)
+#	or Relevance != Yes (_relevance_key != 20475450)
+#
+#   names are stripped
+#
+class SampleIndex:
+
+    def __init__(self, results):
+
+        inMGI = {}
+        excluded = {}
+        for r in results:
+            expID = sys.intern(str.strip(r['accid']))
+            name = sys.intern(str.strip(r['name']))
+            if expID not in inMGI:
+                inMGI[expID] = set()
+                excluded[expID] = set()
+            inMGI[expID].add(name)
+            if r['_genotype_key'] == 90560 or \
+                (r['_relevance_key'] != None and r['_relevance_key'] != 20475450):
+                excluded[expID].add(name)
+
+        self.samples = {}
+        for expID in inMGI:
+            self.samples[expID] = (frozenset(inMGI[expID]), frozenset(excluded[expID]))
+
+    def inMGI(self, expID):
+
+        return self.samples.get(expID, (frozenset(), frozenset()))[0]
+
+    def excluded(self, expID):
+
+        return self.samples.get(expID, (frozenset(), frozenset()))[1]
+
+    #
+    # sha256 of the samples of the experiment in MGI and excluded
+    # changes when a sample is added/removed, or its genotype/relevance
+    # moves it in or out of the excluded samples
+    #
+    def digest(self, expID):
+
+        inMGI, excluded = self.samples.get(expID, (frozenset(), frozenset()))
+        h = hashlib.sha256()
+        h.update('\n'.join(sorted(inMGI)).encode('utf-8'))
+        h.update(b'\0')
+        h.update('\n'.join(sorted(excluded)).encode('utf-8'))
+        return h.hexdigest()
+
+# end class SampleIndex
+
+_sampleIndex = {}
+
+#
+# the SampleIndex of the experiments in MGI_Set setName, loaded on first use
+#
+def sampleIndex(setName):
+
+    if setName not in _sampleIndex:
+        results = db.sql('''
+            select a.accid, hts.name, hts._genotype_key, hts._relevance_key
+            from MGI_Set s, MGI_SetMember m, ACC_Accession a, GXD_HTSample hts
+            where s.name = '%s'
+            and s._set_key = m._set_key
+            and s._mgitype_key = a._mgitype_key
+            and m._object_key = a._object_key
+            and a._logicaldb_key = 189
+            and a.preferred = 1
+            and a._object_key = hts._experiment_key
+            ''' % (setName), 'auto')
+        _sampleIndex[setName] = SampleIndex(results)
+
+    return _sampleIndex[setName]
+
+# end sampleIndex()
+
+#
+# run -> sample -> group of one experiment
+#
+#   runs are added from the sdrf rows (addRun()):
+#	a run is only added once per experiment; if the sdrf lists a run
+#	more than once, the first row wins and the duplicates are counted
+#
+#   groups are added from the configuration assay_groups (setGroup()):
+#	if a run is listed in more than one assay_group, the last one
+#	wins (as before) and the conflicts are counted
+#
+#   run, sample and group ids are interned; each run holds a single
+#   sample and a single group
+#
+class RunIndex:
+
+    __slots__ = ('expID', 'runToSample', 'runToGroup', 'duplicateRuns', 'groupConflicts')
+
+    def __init__(self, expID):
+
+        self.expID = expID
+        self.runToSample = {}
+        self.runToGroup = {}
+        self.duplicateRuns = 0
+        self.groupConflicts = 0
+
+    def __len__(self):
+        return len(self.runToSample)
+
+    def __contains__(self, runID):
+        return runID in self.runToSample
+
+    #
+    # add run -> sample
+    # returns False if the run was already added
+    #
+    def addRun(self, runID, sampleID):
+
+        if runID in self.runToSample:
+            self.duplicateRuns += 1
+            return False
+        self.runToSample[sys.intern(runID)] = sys.intern(sampleID)
+        return True
+
+    #
+    # the sample of runID, default if the run is not in the index
+    #
+    def sample(self, runID, default=None):
+
+        return self.runToSample.get(runID, default)
+
+    #
+    # add run -> group
+    #
+    def setGroup(self, runID, groupID):
+
+        old = self.runToGroup.get(runID)
+        if old != None and old != groupID:
+            self.groupConflicts += 1
+        self.runToGroup[sys.intern(runID)] = sys.intern(groupID)
+
+    #
+    # the group of runID, default if the run is not in a group
+    #
+    def group(self, runID, default=None):
+
+        return self.runToGroup.get(runID, default)
+
+    def hasGroup(self, runID):
+
+        return runID in self.runToGroup
+
+# end class RunIndex
+
+#
+# the fingerprint of each pre-processed experiment
+#   path : json file, expID -> fingerprint
+#
+#   an experiment is recorded once it has been pre-processed; an
+#   experiment that fails, or is no longer in the set, is dropped so
+#   that it is pre-processed again
+#
+#   removing the file forces all experiments to be pre-processed
+#
+class Fingerprints:
+
+    def __init__(self, path):
+
+        self.path = path
+        self.fingerprints = {}
+        try:
+            with open(path, 'r') as fp:
+                self.fingerprints = json.load(fp)
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            print('ignoring unreadable fingerprint file: %s' % (path))
+
+    #
+    # True if expID was pre-processed from inputs with this fingerprint
+    #
+    def current(self, expID, digest):
+
+        return self.fingerprints.get(expID) == digest
+
+    #
+    # the fingerprint recorded for expID, None if there is none
+    #
+    def get(self, expID):
+
+        return self.fingerprints.get(expID)
+
+    def record(self, expID, digest):
+
+        self.fingerprints[expID] = digest
+
+    def drop(self, expID):
+
+        self.fingerprints.pop(expID, None)
+
+    def experiments(self):
+
+        return list(self.fingerprints)
+
+    #
+    # write the file; the previous copy is replaced atomically
+    #
+    def save(self):
+
+        tmpFile = self.path + '.tmp'
+        with open(tmpFile, 'w') as fp:
+            json.dump(self.fingerprints, fp, indent=1, sort_keys=True)
+        os.replace(tmpFile, self.path)
+
+# end class Fingerprints
+
+#
+# sha256 of the parts of a fingerprint (json-able values)
+#
+def fingerprint(parts):
+
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+# end fingerprint()
+
+_manifest = None
+
+#
+# the checksum of each raw input file of an experiment
+#   files : kind (tpms, raw-counts, configuration, sdrf) -> local file
+#
+# the checksum is the one recorded by the download (RAWSTORE_DIR
+# download.manifest); a file that is not in the manifest is identified
+# by its size and modification time, a missing file by 'missing'
+#
+def rawChecksums(expID, files):
+    global _manifest
+
+    if _manifest == None:
+        _manifest = downloadlib.Manifest(os.path.join(os.getenv('RAWSTORE_DIR', ''), 'download.manifest'))
+
+    recorded = _manifest.checksums(expID)
+
+    checksums = {}
+    for kind in files:
+        found = compresslib.findFile(files[kind])
+        if found == None:
+            checksums[kind] = 'missing'
+        elif kind in recorded:
+            checksums[kind] = recorded[kind]
+        else:
+            st = os.stat(found)
+            checksums[kind] = 'stat:%s:%s' % (st.st_size, st.st_mtime_ns)
+
+    return checksums
+
+# end rawChecksums()
+
+#
+# (group id, label, run) of each assay of an Expression Atlas
+# -configuration.xml, in file order
+#
+#        <assay_group id="g1" label="brown adipose tissue">
+#            <assay>ERR4193656</assay>
+#            <assay>ERR4193654</assay>
+#        </assay_group>
+#
+#   skipUnderscore : skip the assay_groups whose id contains '_'
+#	(differential: <assay_group id="xxx_yyy" label...)
+#
+#   the file is read with iterparse; each assay_group is cleared and
+#   removed from its parent once it is handled, so only the current
+#   assay_group is held in memory
+#
+#   raises OSError if the file cannot be read, ET.ParseError if it is
+#   not well formed
+#
+def iterAssayGroups(path, skipUnderscore=False):
+
+    stack = []
+    group = None
+    skip = False
+
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+
+        if event == 'start':
+            stack.append(elem)
+            if elem.tag == 'assay_group':
+                group = (elem.get('id'), elem.get('label'))
+                skip = skipUnderscore and str.find(group[0], '_') > -1
+            continue
+
+        stack.pop()
+
+        if elem.tag == 'assay_group':
+            group = None
+            elem.clear()
+            if stack:
+                stack[-1].remove(elem)
+        elif group != None and stack[-1].tag == 'assay_group':
+            if not skip:
+                yield (group[0], group[1], elem.text)
+
+# end iterAssayGroups()
+
+#
+# run func(expID, objectKey) of one experiment in a worker process
+#
+#   the output of the experiment is captured so that the logs of the
+#   experiments are not interleaved; an exception fails the experiment
+#   (rc 1) and its traceback is added to the log
+#
+#   returns (expID, rc, log, counts)
+#
+def _runExperiment(task):
+
+    func, expID, objectKey = task
+
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        rc, counts = _callExperiment(func, expID, objectKey)
+
+    return (expID, rc, log.getvalue(), counts)
+
+# end _runExperiment()
+
+#
+# func(expID, objectKey) and the Ensembl index (hits, misses) of the call
+# prints the peak RSS of the experiment
+#
+def _callExperiment(func, expID, objectKey):
+
+    before = _ensemblIndex.counts() if _ensemblIndex != None else (0, 0)
+    rnaseqlib.resetPeakRSS()
+    try:
+        rc = func(expID, objectKey)
+    except:
+        traceback.print_exc(file=sys.stdout)
+        rc = 1
+    after = _ensemblIndex.counts() if _ensemblIndex != None else (0, 0)
+    print('peak RSS: %s MB, %s' % (rnaseqlib.peakRSS(), expID))
+
+    return (rc, (after[0] - before[0], after[1] - before[1]))
+
+# end _callExperiment()
+
+#
+# pre-process each (expID, objectKey) of experiments with
+# func(expID, objectKey), which returns 0 or 1
+#
+#   workers <= 1 : the experiments are run one at a time in this process
+#   workers > 1  : the experiments are fanned out over a pool of worker
+#	processes; each worker is started fresh ('spawn') and so opens its
+#	own db connection and loads its own Ensembl/sample indexes
+#
+#   func must be a module level function of the calling script, and the
+#   script must guard its Main with if __name__ == '__main__'
+#
+#   yields (expID, rc, log, counts) in the order of experiments,
+#   whichever worker finishes first; log is '' when the experiments are
+#   run in this process (their output is printed as it happens);
+#   counts are the Ensembl index (hits, misses) of the experiment
+#
+def runExperiments(func, experiments, useWorkers=None):
+
+    useWorkers = useWorkers or workers
+    tasks = [(func, expID, objectKey) for expID, objectKey in experiments]
+
+    if useWorkers <= 1 or len(tasks) <= 1:
+        for func, expID, objectKey in tasks:
+            rc, counts = _callExperiment(func, expID, objectKey)
+            yield (expID, rc, '', counts)
+        return
+
+    print('pre-processing %s experiments with %s workers' % (len(tasks), useWorkers))
+    sys.stdout.flush()
+
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(min(useWorkers, len(tasks))) as pool:
+        for result in pool.imap(_runExperiment, tasks):
+            yield result
+
+# end runExperiments()
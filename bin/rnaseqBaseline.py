@@ -18,14 +18,34 @@
 # processCombined():
 #
 # For each Experiment from Baseline RNASeq MGI_Set
-#   group the number of bioreplicates from RNASeqSet, RNASeqSetMember (replicates())
 #   for file in BASELINEINPUTDIR/xxx.tpms.txt
-#       determine avgQnTpm, level, countMember (from replicates())
+#       determine avgQnTpm, level, countMember (from replicates, the
+#       RNASeqSets created by processRNASet())
 #   load into GXD_HTSample_RNASeqCombined
 #
+# processFused() (BASELINE_FUSED=true):
+#
+# For each Experiment from Baseline RNASeq MGI_Set
+#   read the downloaded -tpms.tsv, sdrf and -configuration.xml
+#   (preprocessBaseline.py) and create the RNASeqSet, RNASeqSetMember and
+#   RNASeqCombined rows in one pass; the pre-processed files are not
+#   written (unless BASELINE_FUSED_KEEP=true)
+#
+# The RNASeqSet and RNASeqSetMember rows are loaded before the
+# RNASeqCombined rows that refer to them are created (BASELINE_FUSED:
+# before they are loaded)
+#
+# processDelta() (BASELINE_DELTA=true):
+#
+# only the experiments that were added, removed or changed since the last
+# delta run are loaded again (see processDelta()); the rows of the other
+# experiments, and their keys, are kept. run_rnaseqBaseline.sh does not
+# delete the existing Baseline rows (rnaseqBaselineDelete.sh)
+#
 # Inputs:
 #	MGI_Set = Baseline RNASeq Load Experiments
 #   Pre-Processed Baseline files: BASELINEINPUTDIR/xxx.group.txt, xxx.tpms.txt
+#	or xxx.tpms.bin (see matrixlib.py)
 #
 # Outputs: BASELINEOUTPUTDIR
 #   GXD_HTSample_RNASeqSet
@@ -36,8 +56,18 @@
 
 import os
 import sys
+import subprocess
+import math
 import loadlib
 import db
+import compresslib
+import rnaseqlib
+import matrixlib
+import levellib
+import bcplib
+import keylib
+import preprocesslib
+import preprocessBaseline
 
 db.setTrace(True)
 
@@ -47,7 +77,18 @@ bcpCmdList = []
 
 logDir = os.getenv('LOGDIR')
 inputDir = os.getenv('BASELINEINPUTDIR')
+tpmsBinTemplate = os.getenv('BASELINE_TPMS_BIN_FILE_TEMPLATE')
 outputDir = os.getenv('BASELINEOUTPUTDIR')
+fused = os.getenv('BASELINE_FUSED', 'false') == 'true'
+keepIntermediates = os.getenv('BASELINE_FUSED_KEEP', 'false') == 'true'
+delta = os.getenv('BASELINE_DELTA', 'false') == 'true'
+
+# BASELINE_DELTA : the fingerprint of each experiment as it was last loaded
+loadFingerprintFile = '%s/load.fingerprints' % (outputDir)
+
+# version of the load rows; part of the load fingerprint, so changing it
+# loads every experiment again
+LOAD_VERSION = 1
 
 setTable = 'GXD_HTSample_RNASeqSet'
 memberTable = 'GXD_HTSample_RNASeqSetMember'
@@ -66,6 +107,22 @@ fpErrorResolved = None
 fpErrorUnResolved = None
 fpErrorSamples = None
 
+# errors reported by resolveRNASet(), by experiment
+resolvedError = {}
+unresolvedError = {}
+sampleError = {}
+
+# the RNASeqSets created by resolveRNASet()
+#   (expID, groupSet) -> (_rnaseqset_key, number of bioreplicates (members))
+replicates = {}
+
+# the samples and their attributes (rnaseqlib.SampleAttributes)
+sampleAttributes = None
+
+# errors reported by combineTpms()
+ensemblError = {}
+markerError = {}
+
 provider = 'Expression Atlas'
 
 # Constants
@@ -79,21 +136,22 @@ loaddate = loadlib.loaddate
 # rnaseqload MGI_User
 createdByKey = 1673
 
-setKey = None
-memberKey = None
-combinedKey = None
+# the created by/modified by, creation/modification date that end each bcp row
+auditColumns = (createdByKey, createdByKey, loaddate, loaddate)
+
+# the keys of each table, reserved in blocks (keylib.KeyAllocator)
+setKeys = None
+memberKeys = None
+combinedKeys = None
+
+# keys reserved at a time
+SET_KEY_BLOCK = int(os.getenv('SET_KEY_BLOCK', '1000'))
+MEMBER_KEY_BLOCK = int(os.getenv('MEMBER_KEY_BLOCK', '10000'))
+COMBINED_KEY_BLOCK = int(os.getenv('COMBINED_KEY_BLOCK', '100000'))
 
 ensemblMarkers = {}
 markerEnsembls = {}
 
-#
-# Level bins
-#
-HIGH = 50430889
-MED = 50430890
-LOW = 50430891
-BELOW_CUTOFF = 50430892
-
 #
 # initialize all
 #
@@ -203,10 +261,14 @@ def init():
 #
 def initRNASet():
     global fpSet, fpMember, fpErrorResolved, fpErrorUnresolved, fpErrorSamples
-    global setKey, memberKey
+    global setKeys, memberKeys
+    global resolvedError, unresolvedError, sampleError
+    global sampleAttributes, replicates
 
-    fpSet = open('%s/%s' % (outputDir, setBcp), 'w')
-    fpMember = open('%s/%s' % (outputDir, memberBcp), 'w')
+    # BASELINE_DELTA writes the files of each experiment (openDelta())
+    if not delta:
+        fpSet = bcplib.BcpWriter('%s/%s' % (outputDir, setBcp), 11, auditColumns, setTable)
+        fpMember = bcplib.BcpWriter('%s/%s' % (outputDir, memberBcp), 3, auditColumns, memberTable)
 
     # errors that are not in the diagnostic report
     fpErrorResolved = open('%s/mismatchResolvedBaseline.error' % (logDir), 'w')
@@ -221,11 +283,38 @@ def initRNASet():
     fpErrorSamples.write('col 3: # of relevant samples in HT index\n')
     fpErrorSamples.write('col 4: sample mismatch\n\n')
 
-    results = db.sql('''select nextval('gxd_htsample_rnaseqset_seq') as maxKey ''', 'auto')
-    setKey = results[0]['maxKey']
+    resolvedError = {}
+    unresolvedError = {}
+    sampleError = {}
+    replicates = {}
+
+    db.sql('''
+        select n._object_key as _sample_key, n.note 
+        into temporary table sampleNotes 
+        from mgi_note n
+        where n._notetype_key = 1048 
+        and n._mgitype_key = 43 
+        ''', None)
+
+    db.sql('''create index idx4 on sampleNotes (_sample_key)''', None)
 
-    results = db.sql('''select nextval('gxd_htsample_rnaseqsetmember_seq') as maxKey ''', 'auto')
-    memberKey = results[0]['maxKey']
+    #
+    # the samples and their attributes, read once (see resolveRNASet());
+    # ordered as the former query per group returned them
+    #
+    sampleAttributes = rnaseqlib.SampleAttributes(db.sql('''
+        select distinct s.expID, s.name, s._experiment_key, s._sample_key, s.age,
+            s._organism_key, s._sex_key, s._stage_key, s._emapa_key, s._genotype_key, 
+            n.note 
+        from samples s
+        left outer join sampleNotes n on (s._sample_key = n._sample_key)
+        order by s.expID, s.name, s._experiment_key, s._sample_key, s.age,
+            s._organism_key, s._sex_key, s._stage_key, s._emapa_key, s._genotype_key,
+            n.note
+        ''', 'auto'))
+
+    setKeys = keylib.KeyAllocator('gxd_htsample_rnaseqset_seq', SET_KEY_BLOCK)
+    memberKeys = keylib.KeyAllocator('gxd_htsample_rnaseqsetmember_seq', MEMBER_KEY_BLOCK)
 
     return 0
 
@@ -236,59 +325,206 @@ def initRNASet():
 #
 def initCombined():
     global fpCombined, fpErrorEnsembl, fpErrorMarker
-    global combinedKey
-
-    fpCombined = open('%s/%s' % (outputDir, combinedBcp), 'w')
+    global combinedKeys
+    global ensemblError, markerError
+
+    # bcplib.BcpShards; the rows of each experiment go to one shard
+    # (BASELINE_DELTA writes the files of each experiment, openDelta())
+    # the rows are streamed (BCP_MODE=copy) unless BASELINE_FUSED, which
+    # creates them before the RNASeqSets they refer to are loaded
+    if not delta:
+        fpCombined = bcplib.BcpShards('%s/%s' % (outputDir, combinedBcp), bcplib.combinedShards, \
+            6, auditColumns, combinedTable, stream=not fused)
     fpErrorEnsembl = open('%s/ensemblBaseline.error' % (logDir), 'w')
     fpErrorEnsembl.write('ensemblId associated with > 1 marker OR ensemblId not in MGI\n\n')
     fpErrorMarker = open('%s/markerBaseline.error' % (logDir), 'w')
     fpErrorMarker.write('markers associated with > 1 ensemblId\n\n')
 
-    results = db.sql('''select nextval('gxd_htsample_rnaseqcombined_seq') as maxKey ''', 'auto')
-    combinedKey = results[0]['maxKey']
+    ensemblError = {}
+    markerError = {}
+
+    combinedKeys = keylib.KeyAllocator('gxd_htsample_rnaseqcombined_seq', COMBINED_KEY_BLOCK)
 
     return 0
 
 # end initCombined()
 
 #
-# calculate the level for the avgrage QN TPM
-# returns proper level key for avgQnTpm
+# the groups of an experiment from the rows of its xxx.group.txt
+#   rows : (group, label, run, sample) of each assay
+# returns (groupMeta, sampleMeta)
+#   groupMeta : group (g1, g2, etc.) -> the quoted samples of the group
+#   sampleMeta : the samples of the experiment
 #
-def calcLevel(avgQnTpm):
-    level = None
-    if avgQnTpm < 0.5:	
-        level = BELOW_CUTOFF 
-    elif avgQnTpm >= 0.5 and avgQnTpm <= 10:
-        level = LOW
-    elif avgQnTpm >= 11 and avgQnTpm <= 1000:
-        level = MED
-    else:  # avgQnTpm > 1000:
-        level = HIGH
+def readGroups(rows):
 
-    return  level
-# end calcLevel
+    groupMeta = {}
+    sampleMeta = []
+    prevSample = ''
+
+    # store group/sample
+    # store sample per experiment
+    for tokens in rows:
+        key = tokens[0]
+        value = str.strip(tokens[3])
+        if value != prevSample:
+            if key not in groupMeta:
+                groupMeta[key] = []
+            groupMeta[key].append("'" + value + "'")
+            prevSample = value
+        if value not in sampleMeta:
+            sampleMeta.append(value)
+
+    return (groupMeta, sampleMeta)
+
+# end readGroups()
 
 #
-# create BCP files for RNASeqSet, RNASeqSetMember
+# create the RNASeqSet, RNASeqSetMember bcp rows of one experiment
+#   rows : (group, label, run, sample) of each assay (xxx.group.txt)
 #
-def processRNASet():
-    global fpSet, fpMember, fpErrorResolved, fpErrorUnresolved, fpErrorSamples
-    global setKey, memberKey
+# the new sets are added to replicates
+#
+def resolveRNASet(expID, rows):
 
-    resolvedError = {}
-    unresolvedError = {}
-    sampleError = {}
+    return writeRNASets(expID, resolveGroups(expID, rows))
 
-    db.sql('''
-        select n._object_key as _sample_key, n.note 
-        into temporary table sampleNotes 
-        from mgi_note n
-        where n._notetype_key = 1048 
-        and n._mgitype_key = 43 
-        ''', None)
+# end resolveRNASet()
 
-    db.sql('''create index idx4 on sampleNotes (_sample_key)''', None)
+#
+# resolve the groups of one experiment against the MGI samples
+#   rows : (group, label, run, sample) of each assay (xxx.group.txt)
+#
+# returns the RNASeqSets of the experiment, in group order:
+#   [groupSet, expKey, age, orgKey, sexKey, emapaKey, stageKey, genotypeKey,
+#   note, sample keys]
+# the mismatches are added to resolvedError, unresolvedError, sampleError
+#
+def resolveGroups(expID, rows):
+
+    sampleMGI = []
+    sets = []
+
+    # save samples
+    sampleResults = db.sql(''' select distinct name from samples where expID = '%s' ''' % (expID), 'auto')
+    for s in sampleResults:
+       sampleMGI.append(s['name'])
+
+    groupMeta, sampleMeta = readGroups(rows)
+
+    # just report if MGI samples count != fpGroup count
+    if len(sampleMGI) != len(sampleMeta):
+        diff1 = [item for item in sampleMeta if item not in sampleMGI]
+        diff2 = [item for item in sampleMGI if item not in sampleMeta]
+        sampleError[expID] = []
+        sampleError[expID].append(str(len(sampleMeta)) + '\t' + str(len(sampleMGI)) + '\t' + ','.join(diff1) + ','.join(diff2))
+
+    #
+    # for each group
+    #   select MGI rows for all samples in the group
+    #
+    for groupSet in groupMeta:
+
+        checkAllDict = {}
+        checkNoSexDict = {}
+        sampleKeySet = []
+
+        # the samples of the group (names without the quotes)
+        sampleResults = sampleAttributes.group(expID, [n[1:-1] for n in groupMeta[groupSet]])
+
+        #
+        # compare samples _organism_key, age, _emapa_key, _stage_key, _sex_key, _genotype_key
+        #
+        for s in sampleResults:
+
+            expKey = s['_experiment_key']
+            sample = s['name']
+            age = s['age']
+            orgKey = s['_organism_key']
+            sexKey = s['_sex_key']
+            emapaKey = s['_emapa_key']
+            stageKey = s['_stage_key']
+            genotypeKey = s['_genotype_key']
+
+            note = s['note']
+            if note == None:
+                note = ''
+
+            sampleKey = s['_sample_key']
+            sampleKeySet.append(sampleKey)
+
+            key = '%s|%s|%s|%s|%s|%s|%s|%s' % (expKey, age, orgKey, sexKey, emapaKey, stageKey, genotypeKey, note)
+            if key not in checkAllDict:
+                checkAllDict[key] = []
+            checkAllDict[key].append(sampleKey)
+
+            key = '%s|%s|%s|%s|%s|%s|%s' % (expKey, age, orgKey, emapaKey, stageKey, genotypeKey, note)
+            if key not in checkNoSexDict:
+                checkNoSexDict[key] = []
+            checkNoSexDict[key].append(sampleKey)
+
+        #print('sampleResults:', expID, str(len(sampleResults)))
+        #print(checkAllDict)
+        #print(checkNoSexDict)
+
+        # no mismatch
+        if len(checkAllDict) == 1:
+
+            sets.append([groupSet, expKey, age, orgKey, sexKey, emapaKey, stageKey, genotypeKey, \
+                note, sampleKeySet])
+
+        # only mismatch is due to Sex
+        elif len(checkAllDict) > 1 and len(checkNoSexDict) == 1:
+
+            sexKey = 315166
+
+            sets.append([groupSet, expKey, age, orgKey, sexKey, emapaKey, stageKey, genotypeKey, \
+                note, sampleKeySet])
+
+            if expID not in resolvedError:
+                resolvedError[expID] = []
+            resolvedError[expID].append(groupSet)
+
+        # other mismatch
+        else:
+            if expID not in unresolvedError:
+                unresolvedError[expID] = []
+            unresolvedError[expID].append(groupSet + '|' + ','.join(groupMeta[groupSet]))
+
+    return sets
+
+# end resolveGroups()
+
+#
+# create the RNASeqSet, RNASeqSetMember bcp rows of the sets of one
+# experiment (resolveGroups())
+#
+# the new sets are added to replicates
+#
+def writeRNASets(expID, sets):
+
+    for groupSet, expKey, age, orgKey, sexKey, emapaKey, stageKey, genotypeKey, \
+            note, sampleKeySet in sets:
+
+        setKey = next(setKeys)
+
+        fpSet.addRow(setKey, expKey, provider, groupSet, \
+            age, orgKey, sexKey, emapaKey, stageKey, genotypeKey, note)
+
+        for sKey in sampleKeySet:
+            fpMember.addRow(next(memberKeys), setKey, sKey)
+
+        replicates[(expID, groupSet)] = (setKey, len(sampleKeySet))
+
+    return 0
+
+# end writeRNASets()
+
+#
+# create BCP files for RNASeqSet, RNASeqSetMember
+# the new sets are kept in replicates for processCombined()
+#
+def processRNASet():
 
     #
     # for each expID
@@ -296,153 +532,37 @@ def processRNASet():
     results = db.sql(''' select distinct expID from samples ''', 'auto')
     for r in results:
 
+        expID = r['expID']
+
         #
         # read the "group.txt" file
         # create groupMeta by group (g1, g2, etc.)
         # each group contains the set of samples that belong to that group
         #
-        groupMeta = {}
-        prevSample = ''
-        expID = r['expID']
-
-        sampleMeta = []
-        sampleMGI = []
-
-        # save samples
-        sampleResults = db.sql(''' select distinct name from samples where expID = '%s' ''' % (expID), 'auto')
-        for s in sampleResults:
-           sampleMGI.append(s['name'])
-
         try:
             fpGroup = open('%s/%s.group.txt' % (inputDir, expID), 'r')
         except:
             print('experiment does not exist in %s/%s.group.txt' % (inputDir, expID))
             continue
-        
-        # store group/sample
-        # store sample per experiment
-        for line in fpGroup.readlines():
-            tokens = str.split(line, TAB)
-            key = tokens[0]
-            value = str.strip(tokens[3])
-            if value != prevSample:
-                if key not in groupMeta:
-                    groupMeta[key] = []
-                groupMeta[key].append("'" + value + "'")
-                prevSample = value
-            if value not in sampleMeta:
-                sampleMeta.append(value)
+
+        resolveRNASet(expID, rnaseqlib.iterRows(fpGroup))
         fpGroup.close()
 
-        # just report if MGI samples count != fpGroup count
-        if len(sampleMGI) != len(sampleMeta):
-            diff1 = [item for item in sampleMeta if item not in sampleMGI]
-            diff2 = [item for item in sampleMGI if item not in sampleMeta]
-            sampleError[expID] = []
-            sampleError[expID].append(str(len(sampleMeta)) + '\t' + str(len(sampleMGI)) + '\t' + ','.join(diff1) + ','.join(diff2))
+    closeRNASet()
 
-        #
-        # for each group
-        #   select MGI rows for all samples in the group
-        #
-        for groupSet in groupMeta:
-
-            checkAllDict = {}
-            checkNoSexDict = {}
-            sampleKeySet = []
-
-            byGroup = ','.join(groupMeta[groupSet])
-
-            sampleResults = db.sql('''
-                select distinct s.expID, s.name, s._experiment_key, s._sample_key, s.age,
-                    s._organism_key, s._sex_key, s._stage_key, s._emapa_key, s._genotype_key, 
-                    n.note 
-                from samples s
-                left outer join sampleNotes n on (s._sample_key = n._sample_key)
-                where s.expID = '%s' and rtrim(s.name) in (%s)
-                ''' % (expID, byGroup), 'auto')
-
-            #
-            # compare samples _organism_key, age, _emapa_key, _stage_key, _sex_key, _genotype_key
-            #
-            for s in sampleResults:
-
-                expKey = s['_experiment_key']
-                sample = s['name']
-                age = s['age']
-                orgKey = s['_organism_key']
-                sexKey = s['_sex_key']
-                emapaKey = s['_emapa_key']
-                stageKey = s['_stage_key']
-                genotypeKey = s['_genotype_key']
-
-                note = s['note']
-                if note == None:
-                    note = ''
-
-                sampleKey = s['_sample_key']
-                sampleKeySet.append(sampleKey)
-
-                key = '%s|%s|%s|%s|%s|%s|%s|%s' % (expKey, age, orgKey, sexKey, emapaKey, stageKey, genotypeKey, note)
-                if key not in checkAllDict:
-                    checkAllDict[key] = []
-                checkAllDict[key].append(sampleKey)
-
-                key = '%s|%s|%s|%s|%s|%s|%s' % (expKey, age, orgKey, emapaKey, stageKey, genotypeKey, note)
-                if key not in checkNoSexDict:
-                    checkNoSexDict[key] = []
-                checkNoSexDict[key].append(sampleKey)
-
-            #print('sampleResults:', expID, str(len(sampleResults)))
-            #print(checkAllDict)
-            #print(checkNoSexDict)
-
-            # no mismatch
-            if len(checkAllDict) == 1:
-
-                fpSet.write('%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s' % (\
-                    setKey, TAB, expKey, TAB, provider, TAB, groupSet, TAB, \
-                    age, TAB, orgKey, TAB, sexKey, TAB, \
-                    emapaKey, TAB, stageKey, TAB, genotypeKey, TAB, note, TAB, \
-                    createdByKey, TAB, createdByKey, TAB, loaddate, TAB, loaddate, CRT))
-
-                for sKey in sampleKeySet:
-                    fpMember.write('%s%s%s%s%s%s%s%s%s%s%s%s%s%s' % (\
-                        memberKey, TAB, setKey, TAB, sKey, TAB, createdByKey, TAB, createdByKey, TAB, loaddate, TAB, loaddate, CRT))
-                    memberKey += 1
-
-                setKey += 1
-
-            # only mismatch is due to Sex
-            elif len(checkAllDict) > 1 and len(checkNoSexDict) == 1:
-
-                sexKey = 315166
-
-                fpSet.write('%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s' % (\
-                    setKey, TAB, expKey, TAB, provider, TAB, groupSet, TAB, \
-                    age, TAB, orgKey, TAB, sexKey, TAB, \
-                    emapaKey, TAB, stageKey, TAB, genotypeKey, TAB, note, TAB, \
-                    createdByKey, TAB, createdByKey, TAB, loaddate, TAB, loaddate, CRT))
-
-                for sKey in sampleKeySet:
-                    fpMember.write('%s%s%s%s%s%s%s%s%s%s%s%s%s%s' % (\
-                        memberKey, TAB, setKey, TAB, sKey, TAB, createdByKey, TAB, createdByKey, TAB, loaddate, TAB, loaddate, CRT))
-                    memberKey += 1
-
-                setKey += 1
-
-                if expID not in resolvedError:
-                    resolvedError[expID] = []
-                resolvedError[expID].append(groupSet)
-
-            # other mismatch
-            else:
-                if expID not in unresolvedError:
-                    unresolvedError[expID] = []
-                unresolvedError[expID].append(groupSet + '|' + ','.join(groupMeta[groupSet]))
-
-    fpSet.close()
-    fpMember.close()
+    return 0
+
+# end processRNASet()
+
+#
+# close the RNASeqSet, RNASeqSetMember bcp files and write the error files
+#
+def closeRNASet():
+
+    # BASELINE_DELTA : closed by processDelta(), for each experiment
+    if not delta:
+        fpSet.close()
+        fpMember.close()
 
     for e in sorted(resolvedError):
         fpErrorResolved.write(e + '\t' + '\t'.join(resolvedError[e]) + '\n')
@@ -458,65 +578,78 @@ def processRNASet():
 
     return 0
 
-# end processRNASet()
+# end closeRNASet()
 
 #
-# create BCP files for RNASeqCombined
+# the rows of the pre-processed tpms matrix of expID
+#   (ensemblId, markerKey, markerSymbol, avg QN TPM of each group)
 #
-def processCombined():
-    global fpCombined, fpErrorEnsembl, fpErrorMarker
-    global combinedKey
+# the binary xxx.tpms.bin is memory-mapped if it exists (and numpy is
+# available); otherwise xxx.tpms.txt is streamed. the values are floats;
+# a value that is not a number (NA) is nan
+#
+# returns (groupSet, rows); raises OSError if there is neither file
+#
+def openTpms(expID):
+
+    binFile = tpmsBinTemplate % (expID)
+    if matrixlib.numpy != None and os.path.exists(binFile):
+        matrix = matrixlib.MatrixFile(binFile)
+        return (matrix.groups, matrix.iterRows())
+
+    fpTpms = compresslib.openRead('%s/%s.tpms.txt' % (inputDir, expID))
+
+    # read the header from fpTpms
+    # generate a groupSet
+    headerList = str.split(fpTpms.readline(), '\t')
+    groupSet = []
+    for h in headerList[3:]:
+        groupSet.append(str.strip(h))
+
+    def tpmsRows():
+        for tokens in rnaseqlib.iterRows(fpTpms):
+            values = []
+            for value in tokens[3:]:
+                try:
+                    values.append(float(value))
+                except ValueError:
+                    values.append(float('nan'))
+            yield (tokens[0], int(tokens[1]), tokens[2], values)
+        fpTpms.close()
 
-    ensemblError = {}
-    markerError = {}
+    return (groupSet, tpmsRows())
 
-    #
-    # for each expID
-    #
-    results = db.sql(''' select expID from experiments ''', 'auto')
-    for r in results:
+# end openTpms()
 
-        expID = r['expID']
+#
+# create the RNASeqCombined bcp rows of one experiment
+#   groupSet : the groups of the tpms matrix
+#   tpmsRows : (ensemblId, markerKey, markerSymbol, avg QN TPM of each group)
+# the groups that are not in replicates (not an RNASeqSet) are skipped
+#
+# the rows are read a chunk (MATRIX_CHUNK_ROWS) at a time. with numpy, the
+# cells of a chunk are one array: the levels, the cells to load (not NA,
+# in an RNASeqSet) and the columns of their bcp rows are taken from the
+# array, and the rows are rendered with one BcpWriter.addRows() call
+#
+def combineTpms(expID, groupSet, tpmsRows):
 
-        # number of bioreplicates per experiment by groupSet
-        replicates = {}
-        bioresults = db.sql('''
-                select distinct s.expID, rm._rnaseqset_key, rs.groupset, count(rm._rnaseqsetmember_key) as countMember
-                from samples s, gxd_htsample_rnaseqsetmember rm, gxd_htsample_rnaseqset rs
-                where s._sample_key = rm._sample_key
-                and rm._rnaseqset_key = rs._rnaseqset_key
-                and s.expID = '%s'
-                group by s.expID, rm._rnaseqset_key, rs.groupset
-            ''' % (expID), 'auto')
-        for b in bioresults:
-            key = b['groupset']
-            value = b
-            replicates[key] = []
-            replicates[key].append(value)
+    # the RNASeqCombined shard of the experiment
+    fpShard = fpCombined.writer()
 
-        #
-        # read the "tpms" file
-        #
-        try:
-            fpTpms = open('%s/%s.tpms.txt' % (inputDir, expID), 'r')
-        except:
-            print('skipping: experiment does not exist in %s/%s.tpms.txt' % (inputDir, expID))
-            continue
-
-        # read the header from fpTpms
-        # generate a groupSet
-        headerList = str.split(fpTpms.readline(), '\t')
-        groupSet = []
-        for h in headerList[3:]:
-            groupSet.append(str.strip(h))
+    # the columns of the groups that are an RNASeqSet
+    columns = [g for g in range(len(groupSet)) if (expID, groupSet[g]) in replicates]
+    if levellib.numpy != None:
+        numpy = levellib.numpy
+        columnIndex = numpy.array(columns, dtype=numpy.int64)
+        setKeyColumn = numpy.array([replicates[(expID, groupSet[g])][0] for g in columns], dtype=numpy.int64)
+        countColumn = numpy.array([replicates[(expID, groupSet[g])][1] for g in columns], dtype=numpy.int64)
 
-        for line in fpTpms.readlines():
+    for chunk in matrixlib.chunks(tpmsRows):
 
-            tokens = str.split(line[:-1], TAB)
-            ensemblId = tokens[0]
-            markerKey = int(tokens[1])
-            markerSymbol = tokens[2]
-                
+        rows = []
+        for ensemblId, markerKey, markerSymbol, values in chunk:
+            
             # ensemblId has > 1 marker or ensemblId does not exist in MGI
             if ensemblId in ensemblMarkers or markerKey == 0:
                 if ensemblId not in ensemblError:
@@ -534,26 +667,89 @@ def processCombined():
                         markerError[markerSymbol].append(m['accid'])
                 continue
 
-            for g in range(len(groupSet)):
-                gKey = groupSet[g]
-                # if a mismatch fails, then the groupSet will not be in the RNASeqSet
-                if gKey not in replicates:
+            rows.append((markerKey, values))
+
+        if not rows or not columns:
+            continue
+
+        if levellib.numpy != None:
+
+            # avg QN TPM of each cell of an RNASeqSet group, and its level
+            matrix = numpy.array([values for markerKey, values in rows], dtype=numpy.float64)[:, columnIndex]
+            levels = levellib.calcLevelArray(matrix)
+            markerColumn = numpy.array([markerKey for markerKey, values in rows], dtype=numpy.int64)
+
+            # the cells that are a number (not NA in the -tpms.tsv), row by row
+            r, c = numpy.nonzero(~numpy.isnan(matrix))
+
+            fpShard.addRows(zip(combinedKeys.take(len(r)), setKeyColumn[c].tolist(), \
+                markerColumn[r].tolist(), levels[r, c].tolist(), countColumn[c].tolist(), \
+                matrix[r, c].tolist()))
+            continue
+
+        # the avg QN TPM and level of each cell of the chunk, row by row
+        avgQnTpms = [float(values[g]) for markerKey, values in rows for g in columns]
+        levelKeys = levellib.calcLevels(avgQnTpms)
+
+        cell = 0
+        for markerKey, values in rows:
+            for g in columns:
+                avgQnTpm = avgQnTpms[cell]
+                levelKey = levelKeys[cell]
+                cell += 1
+                # not a number (NA) in the -tpms.tsv
+                if math.isnan(avgQnTpm):
                     continue
-                avgQnTpm = float(tokens[g+3])
-                levelKey = calcLevel(avgQnTpm)
-                countMember = replicates[gKey][0]['countMember']
-                rnaSeqSetKey = replicates[gKey][0]['_rnaseqset_key']
-
-                fpCombined.write('%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s' % (\
-                            combinedKey, TAB, rnaSeqSetKey, TAB, markerKey, TAB, levelKey, TAB, \
-                            countMember, TAB, avgQnTpm, TAB, \
-                            createdByKey, TAB, createdByKey, TAB, loaddate, TAB, loaddate, CRT))
-    
-                combinedKey += 1
+                rnaSeqSetKey, countMember = replicates[(expID, groupSet[g])]
 
-        fpTpms.close()
+                fpShard.addRow(next(combinedKeys), rnaSeqSetKey, markerKey, levelKey, countMember, avgQnTpm)
+
+    return 0
+
+# end combineTpms()
+
+#
+# create BCP files for RNASeqCombined
+#
+def processCombined():
+
+    #
+    # for each expID
+    #
+    results = db.sql(''' select expID from experiments ''', 'auto')
+    for r in results:
+
+        expID = r['expID']
+
+        #
+        # read the "tpms" file
+        # the rows are streamed, not read into memory
+        #
+        rnaseqlib.resetPeakRSS()
+        try:
+            groupSet, tpmsRows = openTpms(expID)
+        except:
+            print('skipping: experiment does not exist in %s/%s.tpms.txt' % (inputDir, expID))
+            continue
+
+        combineTpms(expID, groupSet, tpmsRows)
+
+        print('peak RSS: %s MB, %s' % (rnaseqlib.peakRSS(), expID))
+
+    closeCombined()
+
+    return 0
+
+# end processCombined()
 
-    fpCombined.close()
+#
+# close the RNASeqCombined bcp file and write the error files
+#
+def closeCombined():
+
+    # BASELINE_DELTA : closed by processDelta(), for each experiment
+    if not delta:
+        fpCombined.close()
 
     for e in sorted(ensemblError):
         fpErrorEnsembl.write(e + '\t' + '\t'.join(ensemblError[e]) + '\n')
@@ -565,48 +761,320 @@ def processCombined():
 
     return 0
 
-# end processCombined()
+# end closeCombined()
+
+#
+# BASELINE_FUSED : pre-process and create the RNASeqSet, RNASeqSetMember
+# and RNASeqCombined BCP files in one pass, without the pre-processed
+# xxx.group.txt/xxx.tpms files
+#
+# for each experiment, the raw -tpms.tsv, sdrf and -configuration.xml are
+# read by the preprocessBaseline.py functions and the groups are resolved
+# before the RNASeqCombined rows of the experiment are created
+#
+# BASELINE_FUSED_KEEP=true also writes xxx.group.txt and xxx.tpms.txt
+# (for debugging), the same files as preprocessBaseline.py writes
+#
+def processFused():
+
+    samples = set()
+    for r in db.sql(''' select distinct expID from samples ''', 'auto'):
+        samples.add(r['expID'])
+
+    #
+    # for each expID
+    #
+    results = db.sql(''' select expID, _experiment_key from experiments ''', 'auto')
+    for r in results:
+
+        expID = r['expID']
+
+        rnaseqlib.resetPeakRSS()
+
+        # the -tpms.tsv, streamed (and kept as xxx.tpms.txt)
+        keepFile = None
+        if keepIntermediates:
+            keepFile = preprocessBaseline.tpmsPPTemplate % expID
+        try:
+            groupSet, tpmsRows = preprocessBaseline.tpmsRows(expID, keepFile)
+        except:
+            print('skipping: missing -tpms.tsv file: %s' % (expID))
+            continue
+
+        # the sdrf (run -> sample) and the configuration (group -> runs)
+        if preprocessBaseline.ppAESSdrfFile(expID, r['_experiment_key']) == 0:
+            try:
+                groupRows = list(preprocessBaseline.groupRows(expID))
+            except Exception as e:
+                print('skipping: cannot read -configuration.xml: %s, %s' % (expID, e))
+                groupRows = None
+
+            if groupRows != None:
+                if keepIntermediates:
+                    keepGroups(expID, groupRows)
+                if expID in samples:
+                    resolveRNASet(expID, groupRows)
+
+        combineTpms(expID, groupSet, tpmsRows)
+
+        print('peak RSS: %s MB, %s' % (rnaseqlib.peakRSS(), expID))
+
+    closeRNASet()
+    closeCombined()
+
+    return 0
+
+# end processFused()
+
+#
+# BASELINE_FUSED_KEEP : write the groups of expID to xxx.group.txt
+#
+def keepGroups(expID, groupRows):
+
+    with open(preprocessBaseline.groupPPTemplate % expID, 'w') as fp:
+        for row in groupRows:
+            fp.write('%s\t%s\t%s\t%s\n' % row)
+
+# end keepGroups()
+
+#
+# BASELINE_DELTA : load only the experiments that were added, removed or
+# changed since the last delta run
+#
+# the load fingerprint of an experiment covers its pre-processed inputs
+# (BASELINEINPUTDIR/preprocess.fingerprints), its resolved RNASeqSets
+# (resolveGroups()), the ensembl ids and markers whose rows are skipped,
+# the level bins and LOAD_VERSION; the fingerprints of the loaded
+# experiments are kept in BASELINEOUTPUTDIR/load.fingerprints
+#
+# an experiment whose fingerprint is unchanged is skipped: its rows and
+# their keys are kept. the rows of an added or changed experiment are
+# written to the delta.xxx.bcp files; then, in one transaction, its
+# previous rows are deleted and the new rows are copied
+# (bcplib.transaction()). the rows of the experiments that are no longer
+# in the MGI_Set are deleted in one transaction
+#
+# the keys of an experiment are reserved as its rows are written, and the
+# unused keys are given back after it (keylib.KeyAllocator.release()), so
+# a run uses as many keys as it writes rows
+#
+# the error files report the RNASeqSet mismatches of every experiment, the
+# ensembl id/marker errors of the experiments that were loaded only
+#
+# returns 0 if every added, changed or removed experiment is loaded, else 1
+#
+def processDelta():
+
+    fingerprints = preprocesslib.Fingerprints(loadFingerprintFile)
+    ppFingerprints = preprocesslib.Fingerprints(preprocessBaseline.fingerprintFile)
+
+    # the ensembl ids/markers whose rows are skipped by combineTpms()
+    skipped = preprocesslib.fingerprint({
+        'ensemblMarkers' : sorted(ensemblMarkers),
+        'markerEnsembls' : sorted(markerEnsembls),
+        })
+
+    samples = set()
+    for r in db.sql(''' select distinct expID from samples ''', 'auto'):
+        samples.add(r['expID'])
+
+    experiments = {}
+    unchanged = []
+    loaded = []
+    failed = []
+
+    #
+    # for each expID
+    #
+    results = db.sql(''' select expID, _experiment_key from experiments ''', 'auto')
+    for r in results:
+
+        expID = r['expID']
+        experiments[expID] = r['_experiment_key']
+
+        # the RNASeqSets of the experiment
+        sets = []
+        if expID in samples:
+            try:
+                fpGroup = open('%s/%s.group.txt' % (inputDir, expID), 'r')
+            except:
+                print('experiment does not exist in %s/%s.group.txt' % (inputDir, expID))
+                fpGroup = None
+            if fpGroup != None:
+                sets = resolveGroups(expID, rnaseqlib.iterRows(fpGroup))
+                fpGroup.close()
+
+        # an experiment that was not pre-processed is always loaded
+        ppDigest = ppFingerprints.get(expID)
+        digest = preprocesslib.fingerprint({
+            'version' : LOAD_VERSION,
+            'preprocess' : ppDigest,
+            'sets' : sets,
+            'skipped' : skipped,
+            'levels' : levellib.LEVELS,
+            })
+        if ppDigest != None and fingerprints.current(expID, digest):
+            unchanged.append(expID)
+            continue
+
+        rnaseqlib.resetPeakRSS()
+
+        openDelta()
+        writeRNASets(expID, sets)
+
+        try:
+            groupSet, tpmsRows = openTpms(expID)
+        except:
+            print('skipping: experiment does not exist in %s/%s.tpms.txt' % (inputDir, expID))
+            groupSet, tpmsRows = [], []
+
+        combineTpms(expID, groupSet, tpmsRows)
+
+        fpSet.close()
+        fpMember.close()
+        fpCombined.close()
+
+        setKeys.release()
+        memberKeys.release()
+        combinedKeys.release()
+
+        # replace the rows of the experiment
+        if bcplib.transaction(deleteStatements('s._experiment_key = %s' % (experiments[expID])), \
+                [fpSet, fpMember] + fpCombined.writers) != 0:
+            failed.append(expID)
+            fingerprints.drop(expID)
+            continue
+
+        loaded.append(expID)
+        if ppDigest != None:
+            fingerprints.record(expID, digest)
+
+        print('peak RSS: %s MB, %s' % (rnaseqlib.peakRSS(), expID))
+
+    # the experiments that are no longer in the MGI_Set
+    # (nothing is deleted if the MGI_Set is empty)
+    removed = [e for e in fingerprints.experiments() if e not in experiments]
+    if experiments:
+        condition = 's._experiment_key not in (%s)' % (','.join([str(k) for k in experiments.values()]))
+        if bcplib.transaction(deleteStatements(condition), []) == 0:
+            for expID in removed:
+                fingerprints.drop(expID)
+        else:
+            failed.extend(removed)
+
+    fingerprints.save()
+
+    closeRNASet()
+    closeCombined()
+
+    setKeys.close()
+    memberKeys.close()
+    combinedKeys.close()
+
+    print('experiments unchanged (not loaded): %s' % (len(unchanged)))
+    print('experiments loaded: %s, removed: %s %s' % (len(loaded), len(removed), ' '.join(removed)))
+    print('experiments failed: %s %s' % (len(failed), ' '.join(failed)))
+
+    if failed:
+        return 1
+
+    return 0
+
+# end processDelta()
+
+#
+# BASELINE_DELTA : new RNASeqSet, RNASeqSetMember, RNASeqCombined bcp
+# files (delta.xxx.bcp) for the rows of the next experiment
+#
+def openDelta():
+    global fpSet, fpMember, fpCombined
+
+    fpSet = bcplib.BcpWriter('%s/delta.%s' % (outputDir, setBcp), 11, auditColumns, setTable)
+    fpMember = bcplib.BcpWriter('%s/delta.%s' % (outputDir, memberBcp), 3, auditColumns, memberTable)
+    fpCombined = bcplib.BcpShards('%s/delta.%s' % (outputDir, combinedBcp), 1, \
+        6, auditColumns, combinedTable)
+
+    return 0
+
+# end openDelta()
+
+#
+# the statements that delete the Baseline RNASeqCombined, RNASeqSetMember
+# and RNASeqSet rows of the RNASeqSets (s) that match condition
+#
+def deleteStatements(condition):
+
+    return [
+        '''delete from %s c using %s s where c._rnaseqset_key = s._rnaseqset_key
+            and s._createdby_key = %s and %s''' % (combinedTable, setTable, createdByKey, condition),
+        '''delete from %s m using %s s where m._rnaseqset_key = s._rnaseqset_key
+            and s._createdby_key = %s and %s''' % (memberTable, setTable, createdByKey, condition),
+        '''delete from %s s where s._createdby_key = %s and %s''' % (setTable, createdByKey, condition),
+        ]
+
+# end deleteStatements()
 
 #
 # load the bcp files into the database for Set
+# returns 0 if both files are loaded, else 1
 #
 def execSetBCP():
 
-    bcpCmd = '%s %s %s %s %s %s "\\t" "\\n" mgd' % \
-    (bcpCommand, db.get_sqlServer(), db.get_sqlDatabase(), setTable, outputDir, setBcp)
-    print('%s' % bcpCmd)
-    os.system(bcpCmd)
+    rc = 0
 
-    bcpCmd = '%s %s %s %s %s %s "\\t" "\\n" mgd' % \
-    (bcpCommand, db.get_sqlServer(), db.get_sqlDatabase(), memberTable, outputDir, memberBcp)
-    print('%s' % bcpCmd)
-    os.system(bcpCmd)
+    if bcplib.copyEnabled():
+        if fpSet.load() != 0 or fpMember.load() != 0:
+            rc = 1
+    else:
+        bcpCmd = '%s %s %s %s %s %s "\\t" "\\n" mgd' % \
+        (bcpCommand, db.get_sqlServer(), db.get_sqlDatabase(), setTable, outputDir, setBcp)
+        print('%s' % bcpCmd)
+        if os.system(bcpCmd) != 0:
+            print('bcpin failed: %s' % (setTable))
+            rc = 1
 
-    # reset the primary key sequence
-    db.sql(''' select setval('gxd_htsample_rnaseqset_seq', (select max(_rnaseqset_key) from GXD_HTSample_RNASeqSet)) ''', None)
-    db.commit()
-    db.sql(''' select setval('gxd_htsample_rnaseqsetmember_seq', (select max(_rnaseqsetmember_key) from GXD_HTSample_RNASeqSetMember));
-''', None)
-    db.commit()
+        bcpCmd = '%s %s %s %s %s %s "\\t" "\\n" mgd' % \
+        (bcpCommand, db.get_sqlServer(), db.get_sqlDatabase(), memberTable, outputDir, memberBcp)
+        print('%s' % bcpCmd)
+        if rc == 0 and os.system(bcpCmd) != 0:
+            print('bcpin failed: %s' % (memberTable))
+            rc = 1
 
-    return 0
+    # the keys were reserved from the sequences (keylib); no reset
+    setKeys.close()
+    memberKeys.close()
+
+    return rc
 
 # end execSetBCP()
 
 #
 # load the bcp files into the database for Combined
+# returns 0 if every file is loaded, else 1
 #
 def execCombinedBCP():
 
-    bcpCmd = '%s %s %s %s %s %s "\\t" "\\n" mgd' % \
-    (bcpCommand, db.get_sqlServer(), db.get_sqlDatabase(), combinedTable, outputDir, combinedBcp)
-    print('%s' % bcpCmd)
-    os.system(bcpCmd)
+    rc = 0
 
-    db.sql(''' select setval('gxd_htsample_rnaseqcombined_seq', (select max(_rnaseqcombined_key) from GXD_HTSample_RNASeqCombined)); ''', None)
-    db.commit()
+    if bcplib.copyEnabled():
+        rc = fpCombined.load()
+    else:
+        # the shards are loaded concurrently
+        processes = []
+        for fp in fpCombined.writers:
+            bcpCmd = '%s %s %s %s %s %s "\\t" "\\n" mgd' % \
+            (bcpCommand, db.get_sqlServer(), db.get_sqlDatabase(), combinedTable, outputDir, os.path.basename(fp.path))
+            print('%s' % bcpCmd)
+            processes.append((fp.path, subprocess.Popen(bcpCmd, shell=True)))
+        for path, process in processes:
+            if process.wait() != 0:
+                print('bcpin failed: %s, %s' % (combinedTable, path))
+                rc = 1
 
-    return 0
+    # the keys were reserved from the sequences (keylib); no reset
+    combinedKeys.close()
+
+    return rc
 
 # end execCombinedBCP()
 
@@ -614,11 +1082,38 @@ def execCombinedBCP():
 # Main
 #
 
+# BASELINE_DELTA replaces the rows of an experiment in one transaction
+if delta and (fused or bcplib.psycopg2 == None):
+    print('BASELINE_DELTA=true requires BASELINE_FUSED=false and psycopg2')
+    sys.exit(1)
+
 init()
 initRNASet()
-processRNASet()
-execSetBCP()
-initCombined()
-processCombined()
-execCombinedBCP()
+
+if delta:
+    initCombined()
+    rc = processDelta()
+else:
+    # every row gets a new key; the next delta run loads every experiment
+    if os.path.exists(loadFingerprintFile):
+        os.remove(loadFingerprintFile)
+
+    if fused:
+        initCombined()
+        processFused()
+        rc = execSetBCP()
+    else:
+        processRNASet()
+        rc = execSetBCP()
+        # the RNASeqCombined rows refer to the RNASeqSets: they are created
+        # (and streamed, BCP_MODE=copy) once the RNASeqSets are loaded
+        if rc == 0:
+            initCombined()
+            processCombined()
+
+    # the RNASeqCombined rows are not loaded if the RNASeqSets are not
+    if rc == 0:
+        rc = execCombinedBCP()
+
+sys.exit(rc)
 
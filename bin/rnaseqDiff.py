@@ -34,8 +34,14 @@
 
 import os
 import sys
+import subprocess
 import loadlib
 import db
+import compresslib
+import rnaseqlib
+import levellib
+import bcplib
+import keylib
 
 db.setTrace(True)
 
@@ -67,6 +73,10 @@ fpErrorResolved = None
 fpErrorUnResolved = None
 fpErrorSamples = None
 
+# the RNASeqSets created by processRNASet()
+#   (expID, groupSet) -> (_rnaseqset_key, number of bioreplicates (members))
+replicates = {}
+
 provider = 'Expression Atlas'
 
 # Constants
@@ -80,22 +90,23 @@ loaddate = loadlib.loaddate
 # rnaseqload MGI_User
 createdByKey = 1613
 
-setKey = None
-memberKey = None
-combinedKey = None
-seqey = None
+# the created by/modified by, creation/modification date that end each bcp row
+auditColumns = (createdByKey, createdByKey, loaddate, loaddate)
+
+# the keys of each table, reserved in blocks (keylib.KeyAllocator)
+setKeys = None
+memberKeys = None
+combinedKeys = None
+seqKeys = None
+
+# keys reserved at a time
+SET_KEY_BLOCK = int(os.getenv('SET_KEY_BLOCK', '1000'))
+MEMBER_KEY_BLOCK = int(os.getenv('MEMBER_KEY_BLOCK', '10000'))
+COMBINED_KEY_BLOCK = int(os.getenv('COMBINED_KEY_BLOCK', '100000'))
 
 ensemblMarkers = {}
 markerEnsembls = {}
 
-#
-# Level bins
-#
-HIGH = 50430889
-MED = 50430890
-LOW = 50430891
-BELOW_CUTOFF = 50430892
-
 #
 # initialize all
 #
@@ -206,10 +217,10 @@ def init():
 #
 def initRNASet():
     global fpSet, fpMember, fpErrorResolved, fpErrorUnresolved, fpErrorSamples
-    global setKey, memberKey
+    global setKeys, memberKeys
 
-    fpSet = open('%s/%s' % (outputDir, setBcp), 'w')
-    fpMember = open('%s/%s' % (outputDir, memberBcp), 'w')
+    fpSet = bcplib.BcpWriter('%s/%s' % (outputDir, setBcp), 11, auditColumns, setTable)
+    fpMember = bcplib.BcpWriter('%s/%s' % (outputDir, memberBcp), 3, auditColumns, memberTable)
 
     # errors that are not in the diagnostic report
     fpErrorResolved = open('%s/mismatchResolvedDifferential.error' % (logDir), 'w')
@@ -224,11 +235,8 @@ def initRNASet():
     fpErrorSamples.write('col 3: # of relevant samples in HT index\n')
     fpErrorSamples.write('col 4: sample mismatch\n\n')
 
-    results = db.sql('''select nextval('gxd_htsample_rnaseqset_seq') as maxKey ''', 'auto')
-    setKey = results[0]['maxKey']
-
-    results = db.sql('''select nextval('gxd_htsample_rnaseqsetmember_seq') as maxKey ''', 'auto')
-    memberKey = results[0]['maxKey']
+    setKeys = keylib.KeyAllocator('gxd_htsample_rnaseqset_seq', SET_KEY_BLOCK)
+    memberKeys = keylib.KeyAllocator('gxd_htsample_rnaseqsetmember_seq', MEMBER_KEY_BLOCK)
 
     return 0
 
@@ -239,53 +247,37 @@ def initRNASet():
 #
 def initCombined():
     global fpCombined, fpSeq, fpErrorEnsembl, fpErrorMarker
-    global combinedKey, seqKey
+    global combinedKeys, seqKeys
 
-    fpCombined = open('%s/%s' % (outputDir, combinedBcp), 'w')
-    fpSeq = open('%s/%s' % (outputDir, seqBcp), 'w')
+    # bcplib.BcpShards; the rows of each experiment go to one shard
+    fpCombined = bcplib.BcpShards('%s/%s' % (outputDir, combinedBcp), bcplib.combinedShards, \
+        6, auditColumns, combinedTable, stream=True)
+    # no RNASeq rows are created yet; the (empty) bcp file is still loaded
+    fpSeq = bcplib.BcpWriter('%s/%s' % (outputDir, seqBcp), 0, auditColumns, seqTable)
     fpErrorEnsembl = open('%s/ensemblDifferential.error' % (logDir), 'w')
     fpErrorEnsembl.write('ensemblId associated with > 1 marker OR ensemblId not in MGI\n\n')
     fpErrorMarker = open('%s/markerDifferential.error' % (logDir), 'w')
     fpErrorMarker.write('markers associated with > 1 ensemblId\n\n')
 
-    results = db.sql('''select nextval('gxd_htsample_rnaseqcombined_seq') as maxKey ''', 'auto')
-    combinedKey = results[0]['maxKey']
-
-    results = db.sql('''select nextval('gxd_htsample_rnaseq_seq') as maxKey ''', 'auto')
-    seqKey = results[0]['maxKey']
+    combinedKeys = keylib.KeyAllocator('gxd_htsample_rnaseqcombined_seq', COMBINED_KEY_BLOCK)
+    seqKeys = keylib.KeyAllocator('gxd_htsample_rnaseq_seq', COMBINED_KEY_BLOCK)
 
     return 0
 
 # end initCombined()
 
-#
-# calculate the level for the avgrage QN TPM
-# returns proper level key for avgQnTpm
-#
-def calcLevel(avgQnTpm):
-    level = None
-    if avgQnTpm < 0.5:	
-        level = BELOW_CUTOFF 
-    elif avgQnTpm >= 0.5 and avgQnTpm <= 10:
-        level = LOW
-    elif avgQnTpm >= 11 and avgQnTpm <= 1000:
-        level = MED
-    else:  # avgQnTpm > 1000:
-        level = HIGH
-
-    return  level
-# end calcLevel
-
 #
 # create BCP files for RNASeqSet, RNASeqSetMember
+# the new sets are kept in replicates for processCombined()
 #
 def processRNASet():
     global fpSet, fpMember, fpErrorResolved, fpErrorUnresolved, fpErrorSamples
-    global setKey, memberKey
+    global replicates
 
     resolvedError = {}
     unresolvedError = {}
     sampleError = {}
+    replicates = {}
 
     db.sql('''
         select n._object_key as _sample_key, n.note 
@@ -297,6 +289,21 @@ def processRNASet():
 
     db.sql('''create index idx4 on sampleNotes (_sample_key)''', None)
 
+    #
+    # the samples and their attributes, read once for the group checks
+    # below; ordered as the former query per group returned them
+    #
+    sampleAttributes = rnaseqlib.SampleAttributes(db.sql('''
+        select distinct s.expID, s.name, s._experiment_key, s._sample_key, s.age,
+            s._organism_key, s._sex_key, s._stage_key, s._emapa_key, s._genotype_key, 
+            n.note 
+        from samples s
+        left outer join sampleNotes n on (s._sample_key = n._sample_key)
+        order by s.expID, s.name, s._experiment_key, s._sample_key, s.age,
+            s._organism_key, s._sex_key, s._stage_key, s._emapa_key, s._genotype_key,
+            n.note
+        ''', 'auto'))
+
     #
     # for each expID
     #
@@ -328,8 +335,7 @@ def processRNASet():
         
         # store group/sample
         # store sample per experiment
-        for line in fpGroup.readlines():
-            tokens = str.split(line, TAB)
+        for tokens in rnaseqlib.iterRows(fpGroup):
             key = tokens[0]
             value = str.strip(tokens[3])
             if value != prevSample:
@@ -359,16 +365,8 @@ def processRNASet():
             checkNoSexDict = {}
             sampleKeySet = []
 
-            byGroup = ','.join(groupMeta[groupSet])
-
-            sampleResults = db.sql('''
-                select distinct s.expID, s.name, s._experiment_key, s._sample_key, s.age,
-                    s._organism_key, s._sex_key, s._stage_key, s._emapa_key, s._genotype_key, 
-                    n.note 
-                from samples s
-                left outer join sampleNotes n on (s._sample_key = n._sample_key)
-                where s.expID = '%s' and rtrim(s.name) in (%s)
-                ''' % (expID, byGroup), 'auto')
+            # the samples of the group (names without the quotes)
+            sampleResults = sampleAttributes.group(expID, [n[1:-1] for n in groupMeta[groupSet]])
 
             #
             # compare samples _organism_key, age, _emapa_key, _stage_key, _sex_key, _genotype_key
@@ -409,36 +407,30 @@ def processRNASet():
             # no mismatch
             if len(checkAllDict) == 1:
 
-                fpSet.write('%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s' % (\
-                    setKey, TAB, expKey, TAB, provider, TAB, groupSet, TAB, \
-                    age, TAB, orgKey, TAB, sexKey, TAB, \
-                    emapaKey, TAB, stageKey, TAB, genotypeKey, TAB, note, TAB, \
-                    createdByKey, TAB, createdByKey, TAB, loaddate, TAB, loaddate, CRT))
+                setKey = next(setKeys)
+
+                fpSet.addRow(setKey, expKey, provider, groupSet, \
+                    age, orgKey, sexKey, emapaKey, stageKey, genotypeKey, note)
 
                 for sKey in sampleKeySet:
-                    fpMember.write('%s%s%s%s%s%s%s%s%s%s%s%s%s%s' % (\
-                        memberKey, TAB, setKey, TAB, sKey, TAB, createdByKey, TAB, createdByKey, TAB, loaddate, TAB, loaddate, CRT))
-                    memberKey += 1
+                    fpMember.addRow(next(memberKeys), setKey, sKey)
 
-                setKey += 1
+                replicates[(expID, groupSet)] = (setKey, len(sampleKeySet))
 
             # only mismatch is due to Sex
             elif len(checkAllDict) > 1 and len(checkNoSexDict) == 1:
 
                 sexKey = 315166
 
-                fpSet.write('%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s' % (\
-                    setKey, TAB, expKey, TAB, provider, TAB, groupSet, TAB, \
-                    age, TAB, orgKey, TAB, sexKey, TAB, \
-                    emapaKey, TAB, stageKey, TAB, genotypeKey, TAB, note, TAB, \
-                    createdByKey, TAB, createdByKey, TAB, loaddate, TAB, loaddate, CRT))
+                setKey = next(setKeys)
+
+                fpSet.addRow(setKey, expKey, provider, groupSet, \
+                    age, orgKey, sexKey, emapaKey, stageKey, genotypeKey, note)
 
                 for sKey in sampleKeySet:
-                    fpMember.write('%s%s%s%s%s%s%s%s%s%s%s%s%s%s' % (\
-                        memberKey, TAB, setKey, TAB, sKey, TAB, createdByKey, TAB, createdByKey, TAB, loaddate, TAB, loaddate, CRT))
-                    memberKey += 1
+                    fpMember.addRow(next(memberKeys), setKey, sKey)
 
-                setKey += 1
+                replicates[(expID, groupSet)] = (setKey, len(sampleKeySet))
 
                 if expID not in resolvedError:
                     resolvedError[expID] = []
@@ -474,7 +466,6 @@ def processRNASet():
 #
 def processCombined():
     global fpCombined, fpSeq, fpErrorEnsembl, fpErrorMarker
-    global combinedKey, seqKey
 
     ensemblError = {}
     markerError = {}
@@ -487,27 +478,13 @@ def processCombined():
 
         expID = r['expID']
 
-        # number of bioreplicates per experiment by groupSet
-        replicates = {}
-        bioresults = db.sql('''
-                select distinct s.expID, rm._rnaseqset_key, rs.groupset, count(rm._rnaseqsetmember_key) as countMember
-                from samples s, gxd_htsample_rnaseqsetmember rm, gxd_htsample_rnaseqset rs
-                where s._sample_key = rm._sample_key
-                and rm._rnaseqset_key = rs._rnaseqset_key
-                and s.expID = '%s'
-                group by s.expID, rm._rnaseqset_key, rs.groupset
-            ''' % (expID), 'auto')
-        for b in bioresults:
-            key = b['groupset']
-            value = b
-            replicates[key] = []
-            replicates[key].append(value)
-
         #
         # read the "tpms" file
+        # the rows are streamed, not read into memory
         #
+        rnaseqlib.resetPeakRSS()
         try:
-            fpTpms = open('%s/%s.tpms.txt' % (inputDir, expID), 'r')
+            fpTpms = compresslib.openRead('%s/%s.tpms.txt' % (inputDir, expID))
         except:
             print('skipping: experiment does not exist in %s/%s.tpms.txt' % (inputDir, expID))
             continue
@@ -519,9 +496,11 @@ def processCombined():
         for h in headerList[3:]:
             groupSet.append(str.strip(h))
 
-        for line in fpTpms.readlines():
+        # the RNASeqCombined shard of the experiment
+        fpShard = fpCombined.writer()
+
+        for tokens in rnaseqlib.iterRows(fpTpms):
 
-            tokens = str.split(line[:-1], TAB)
             ensemblId = tokens[0]
             markerKey = int(tokens[1])
             markerSymbol = tokens[2]
@@ -546,21 +525,16 @@ def processCombined():
             for g in range(len(groupSet)):
                 gKey = groupSet[g]
                 # if a mismatch fails, then the groupSet will not be in the RNASeqSet
-                if gKey not in replicates:
+                if (expID, gKey) not in replicates:
                     continue
                 avgQnTpm = float(tokens[g+3])
-                levelKey = calcLevel(avgQnTpm)
-                countMember = replicates[gKey][0]['countMember']
-                rnaSeqSetKey = replicates[gKey][0]['_rnaseqset_key']
+                levelKey = levellib.calcLevel(avgQnTpm)
+                rnaSeqSetKey, countMember = replicates[(expID, gKey)]
 
-                fpCombined.write('%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s%s' % (\
-                            combinedKey, TAB, rnaSeqSetKey, TAB, markerKey, TAB, levelKey, TAB, \
-                            countMember, TAB, avgQnTpm, TAB, \
-                            createdByKey, TAB, createdByKey, TAB, loaddate, TAB, loaddate, CRT))
-    
-                combinedKey += 1
+                fpShard.addRow(next(combinedKeys), rnaSeqSetKey, markerKey, levelKey, countMember, avgQnTpm)
 
         fpTpms.close()
+        print('peak RSS: %s MB, %s' % (rnaseqlib.peakRSS(), expID))
 
     fpCombined.close()
     fpSeq.close()
@@ -579,52 +553,74 @@ def processCombined():
 
 #
 # load the bcp files into the database for Set
+# returns 0 if both files are loaded, else 1
 #
 def execSetBCP():
 
-    bcpCmd = '%s %s %s %s %s %s "\\t" "\\n" mgd' % \
-    (bcpCommand, db.get_sqlServer(), db.get_sqlDatabase(), setTable, outputDir, setBcp)
-    print('%s' % bcpCmd)
-    os.system(bcpCmd)
+    rc = 0
 
-    bcpCmd = '%s %s %s %s %s %s "\\t" "\\n" mgd' % \
-    (bcpCommand, db.get_sqlServer(), db.get_sqlDatabase(), memberTable, outputDir, memberBcp)
-    print('%s' % bcpCmd)
-    os.system(bcpCmd)
+    if bcplib.copyEnabled():
+        if fpSet.load() != 0 or fpMember.load() != 0:
+            rc = 1
+    else:
+        bcpCmd = '%s %s %s %s %s %s "\\t" "\\n" mgd' % \
+        (bcpCommand, db.get_sqlServer(), db.get_sqlDatabase(), setTable, outputDir, setBcp)
+        print('%s' % bcpCmd)
+        if os.system(bcpCmd) != 0:
+            print('bcpin failed: %s' % (setTable))
+            rc = 1
 
-    # reset the primary key sequence
-    db.sql(''' select setval('gxd_htsample_rnaseqset_seq', (select max(_rnaseqset_key) from GXD_HTSample_RNASeqSet)) ''', None)
-    db.commit()
-    db.sql(''' select setval('gxd_htsample_rnaseqsetmember_seq', (select max(_rnaseqsetmember_key) from GXD_HTSample_RNASeqSetMember));
-''', None)
-    db.commit()
+        bcpCmd = '%s %s %s %s %s %s "\\t" "\\n" mgd' % \
+        (bcpCommand, db.get_sqlServer(), db.get_sqlDatabase(), memberTable, outputDir, memberBcp)
+        print('%s' % bcpCmd)
+        if rc == 0 and os.system(bcpCmd) != 0:
+            print('bcpin failed: %s' % (memberTable))
+            rc = 1
 
-    return 0
+    # the keys were reserved from the sequences (keylib); no reset
+    setKeys.close()
+    memberKeys.close()
+
+    return rc
 
 # end execSetBCP()
 
 #
 # load the bcp files into the database for Combined
+# returns 0 if every file is loaded, else 1
 #
 def execCombinedBCP():
 
-    bcpCmd = '%s %s %s %s %s %s "\\t" "\\n" mgd' % \
-    (bcpCommand, db.get_sqlServer(), db.get_sqlDatabase(), seqTable, outputDir, seqBcp)
-    print('%s' % bcpCmd)
-    os.system(bcpCmd)
-
-    bcpCmd = '%s %s %s %s %s %s "\\t" "\\n" mgd' % \
-    (bcpCommand, db.get_sqlServer(), db.get_sqlDatabase(), combinedTable, outputDir, combinedBcp)
-    print('%s' % bcpCmd)
-    os.system(bcpCmd)
-
-    db.sql(''' select setval('gxd_htsample_rnaseq_seq', (select max(_rnaseq_key) from GXD_HTSample_RNASeq)); ''', None)
-    db.commit()
-
-    db.sql(''' select setval('gxd_htsample_rnaseqcombined_seq', (select max(_rnaseqcombined_key) from GXD_HTSample_RNASeqCombined)); ''', None)
-    db.commit()
-
-    return 0
+    rc = 0
+
+    if bcplib.copyEnabled():
+        if fpSeq.load() != 0 or fpCombined.load() != 0:
+            rc = 1
+    else:
+        bcpCmd = '%s %s %s %s %s %s "\\t" "\\n" mgd' % \
+        (bcpCommand, db.get_sqlServer(), db.get_sqlDatabase(), seqTable, outputDir, seqBcp)
+        print('%s' % bcpCmd)
+        if os.system(bcpCmd) != 0:
+            print('bcpin failed: %s' % (seqTable))
+            rc = 1
+
+        # the shards are loaded concurrently
+        processes = []
+        for fp in fpCombined.writers:
+            bcpCmd = '%s %s %s %s %s %s "\\t" "\\n" mgd' % \
+            (bcpCommand, db.get_sqlServer(), db.get_sqlDatabase(), combinedTable, outputDir, os.path.basename(fp.path))
+            print('%s' % bcpCmd)
+            processes.append((fp.path, subprocess.Popen(bcpCmd, shell=True)))
+        for path, process in processes:
+            if process.wait() != 0:
+                print('bcpin failed: %s, %s' % (combinedTable, path))
+                rc = 1
+
+    # the keys were reserved from the sequences (keylib); no reset
+    seqKeys.close()
+    combinedKeys.close()
+
+    return rc
 
 # end execCombinedBCP()
 
@@ -635,8 +631,13 @@ def execCombinedBCP():
 init()
 initRNASet()
 processRNASet()
-execSetBCP()
-#initCombined()
-#processCombined()
-#execCombinedBCP()
+rc = execSetBCP()
+# the RNASeqCombined rows refer to the RNASeqSets: they are created once
+# the RNASeqSets are loaded
+#if rc == 0:
+#    initCombined()
+#    processCombined()
+#    rc = execCombinedBCP()
+
+sys.exit(rc)
 
@@ -0,0 +1,108 @@
+##########################################################################
+#
+# Purpose: Helpers shared by the pre-processing and load scripts
+#
+#   iterRows() : stream the rows of a tab-delimited file
+#	the files are read one line at a time, never as one list of lines,
+#	so memory is bounded by the longest row rather than the file
+#
+#   resetPeakRSS()/peakRSS() : peak resident memory of the process,
+#	reported per experiment
+#
+#   SampleAttributes : the samples and their attributes, by experiment and
+#	sample name (the group consistency checks of processRNASet())
+#
+# Usage:
+#	import rnaseqlib
+#	rnaseqlib.resetPeakRSS()
+#	for tokens in rnaseqlib.iterRows(fp):
+#	print('peak RSS: %s MB' % (rnaseqlib.peakRSS()))
+#	samples = rnaseqlib.SampleAttributes(db.sql(..., 'auto'))
+#	for s in samples.group(expID, names):
+#
+###########################################################################
+
+import resource
+
+#
+# the tokens of each remaining line of fp, split on sep
+# the line terminator is removed from the last token
+#
+def iterRows(fp, sep='\t'):
+
+    for line in fp:
+        yield str.split(str.rstrip(line, '\n'), sep)
+
+# end iterRows()
+
+#
+# reset the peak resident memory (VmHWM) of this process to its current
+# resident memory, so that peakRSS() reports the peak of what follows
+# (linux /proc/self/clear_refs); elsewhere the peak is never reset
+#
+def resetPeakRSS():
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+    except:
+        pass
+
+# end resetPeakRSS()
+
+#
+# peak resident memory of this process in MB
+# since the last resetPeakRSS(), or since the process started
+#
+def peakRSS():
+
+    try:
+        with open('/proc/self/status', 'r') as fp:
+            for line in fp:
+                if str.startswith(line, 'VmHWM:'):
+                    return round(int(str.split(line)[1]) / 1024, 1)
+    except:
+        pass
+
+    # ru_maxrss is in KB on linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+# end peakRSS()
+
+#
+# the samples of the experiments and their attributes
+#   rows : the distinct (expID, name, _experiment_key, _sample_key, age,
+#	_organism_key, _sex_key, _stage_key, _emapa_key, _genotype_key, note)
+#	rows of the samples (one row per note of a sample)
+#
+# the rows are indexed by (expID, name without trailing blanks) so that the
+# samples of a group are found without a query per group
+#
+class SampleAttributes:
+
+    def __init__(self, rows):
+
+        self.samples = {}
+        for seq, r in enumerate(rows):
+            key = (r['expID'], str.rstrip(r['name'], ' '))
+            if key not in self.samples:
+                self.samples[key] = []
+            self.samples[key].append((seq, r))
+
+    def __len__(self):
+        return len(self.samples)
+
+    #
+    # the rows of the samples of expID named in names, in the order of the
+    # rows given to the index
+    #
+    def group(self, expID, names):
+
+        found = []
+        for name in set(names):
+            found.extend(self.samples.get((expID, name), []))
+        found.sort(key=lambda s: s[0])
+
+        return [r for seq, r in found]
+
+# end class SampleAttributes
@@ -31,7 +31,8 @@ fi
 date | tee -a ${BASELINELOG_DOWNLOAD}
 
 echo "Downloading input files" 
-rm -rf ${BASELINERAW_INPUTDIR}/*
+# files from previous runs are kept, only files changed upstream are
+# downloaded again (see RAWSTORE_DIR)
 ${PYTHON} ${RNASEQLOAD}/bin/downloadBaselineFiles.py >> ${BASELINELOG_DOWNLOAD} 2>&1
 
 touch ${LASTRUN_FILE}
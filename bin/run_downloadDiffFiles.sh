@@ -36,7 +36,8 @@ date | tee -a ${DIFFLOG_DOWNLOAD}
 
 echo "Downloading input files" 
 rm -rf ${DIFFLOG_DOWNLOAD}
-rm -rf ${DIFFRAW_INPUTDIR}/*
+# files from previous runs are kept, only files changed upstream are
+# downloaded again (see RAWSTORE_DIR)
 ${PYTHON} ${RNASEQLOAD}/bin/downloadDiffFiles.py >> ${DIFFLOG_DOWNLOAD} 2>&1
 #STAT=$?
 
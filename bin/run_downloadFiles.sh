@@ -0,0 +1,31 @@
+#!/bin/sh
+#
+# Purpose:
+#	Download Raw Baseline and Differential files in one pass
+#
+
+cd `dirname $0`
+
+CONFIG_LOAD=../rnaseqload.config
+
+#
+# Make sure the common configuration file exists and source it.
+#
+if [ -f ${CONFIG_LOAD} ]
+then
+    . ${CONFIG_LOAD}
+else
+    echo "Missing configuration file: ${CONFIG_LOAD}"
+    exit 1
+fi
+
+rm -rf ${LOG_DOWNLOAD}
+
+date | tee -a ${LOG_DOWNLOAD}
+
+echo "Downloading input files" 
+# files from previous runs are kept, only files changed upstream are
+# downloaded again (see RAWSTORE_DIR)
+${PYTHON} ${RNASEQLOAD}/bin/downloadFiles.py >> ${LOG_DOWNLOAD} 2>&1
+
+date | tee -a ${LOG_DOWNLOAD}
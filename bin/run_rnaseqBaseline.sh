@@ -6,7 +6,7 @@
 # Step 1: run baseline MGI_Set, MGI_SetMember
 # Step 2: run baseline download (raw_input_baseline)
 # Step 3: run baseline pre processing (input_baseline)
-# Step 4: delete existing Baseline RNASeqSet data
+# Step 4: delete existing Baseline RNASeqSet data (not if BASELINE_DELTA=true)
 # Step 5: run baseline: RNASeqSet, RNASeq_SetMember, RNASeqCombined
 #
 # MGI_Set = Baseline RNASeq Experiments
@@ -45,19 +45,50 @@ ${RNASEQLOAD}/bin/run_downloadBaselineFiles.sh >> ${BASELINELOG} 2>&1
 
 date >> ${BASELINELOG} 2>&1
 echo "Step 3: run baseline pre processing (input_baseline)" >> ${BASELINELOG} 2>&1
-rm -rf ${BASELINEINPUTDIR}/*
-${PYTHON} ${RNASEQLOAD}/bin/preprocessBaseline.py >> ${BASELINELOG} 2>&1
+# only experiments whose inputs changed are pre-processed again
+# (see ${BASELINEINPUTDIR}/preprocess.fingerprints; remove it to rebuild all)
+# BASELINE_FUSED=true : rnaseqBaseline.py (Step 5) reads the downloaded files
+if [ "${BASELINE_FUSED}" = "true" ]
+then
+    echo "BASELINE_FUSED=true - skipping pre processing" >> ${BASELINELOG} 2>&1
+else
+    ${PYTHON} ${RNASEQLOAD}/bin/preprocessBaseline.py >> ${BASELINELOG} 2>&1
+fi
 
-date >> ${BASELINELOG} 2>&1
-echo "Step 4: delete existing Baseline RNASeqSet data" >> ${BASELINELOG} 2>&1
-${RNASEQLOAD}/bin/rnaseqBaselineDelete.sh >> ${BASELINELOG} 2>&1
+# BASELINE_DELTA=true : rnaseqBaseline.py (Step 5) replaces the rows of
+# the added/changed/removed experiments only; the existing data is kept,
+# and so are the RNASeqCombined keys/indexes (used by its deletes)
+# (see ${BASELINEOUTPUTDIR}/load.fingerprints; remove it to reload all)
+if [ "${BASELINE_DELTA}" = "true" ]
+then
+    date >> ${BASELINELOG} 2>&1
+    echo "BASELINE_DELTA=true - skipping delete of existing Baseline RNASeqSet data" >> ${BASELINELOG} 2>&1
 
-date >> ${BASELINELOG} 2>&1
-echo "Step 5: run baseline: RNASeqSet, RNASeq_SetMember, RNASeqCombined" >> ${BASELINELOG} 2>&1
-${MGD_DBSCHEMADIR}/index/GXD_HTSample_RNASeqCombined_drop.object >> ${BASELINELOG} 2>&1
-${MGD_DBSCHEMADIR}/key/GXD_HTSample_RNASeqCombined_drop.object >> ${BASELINELOG} 2>&1
-${PYTHON} ${RNASEQLOAD}/bin/rnaseqBaseline.py >> ${BASELINELOG} 2>&1
-${MGD_DBSCHEMADIR}/key/GXD_HTSample_RNASeqCombined_create.object >> ${BASELINELOG} 2>&1
-${MGD_DBSCHEMADIR}/index/GXD_HTSample_RNASeqCombined_create.object >> ${BASELINELOG} 2>&1
+    date >> ${BASELINELOG} 2>&1
+    echo "Step 5: run baseline (delta): RNASeqSet, RNASeq_SetMember, RNASeqCombined" >> ${BASELINELOG} 2>&1
+    ${PYTHON} ${RNASEQLOAD}/bin/rnaseqBaseline.py >> ${BASELINELOG} 2>&1
+    STAT=$?
+else
+    date >> ${BASELINELOG} 2>&1
+    echo "Step 4: delete existing Baseline RNASeqSet data" >> ${BASELINELOG} 2>&1
+    ${RNASEQLOAD}/bin/rnaseqBaselineDelete.sh >> ${BASELINELOG} 2>&1
+
+    date >> ${BASELINELOG} 2>&1
+    echo "Step 5: run baseline: RNASeqSet, RNASeq_SetMember, RNASeqCombined" >> ${BASELINELOG} 2>&1
+    ${MGD_DBSCHEMADIR}/index/GXD_HTSample_RNASeqCombined_drop.object >> ${BASELINELOG} 2>&1
+    ${MGD_DBSCHEMADIR}/key/GXD_HTSample_RNASeqCombined_drop.object >> ${BASELINELOG} 2>&1
+    ${PYTHON} ${RNASEQLOAD}/bin/rnaseqBaseline.py >> ${BASELINELOG} 2>&1
+    STAT=$?
+    ${MGD_DBSCHEMADIR}/key/GXD_HTSample_RNASeqCombined_create.object >> ${BASELINELOG} 2>&1
+    ${MGD_DBSCHEMADIR}/index/GXD_HTSample_RNASeqCombined_create.object >> ${BASELINELOG} 2>&1
+fi
+
+# the load failed (a bcp file was not loaded)
+if [ ${STAT} -ne 0 ]
+then
+    echo "rnaseqBaseline.py failed" >> ${BASELINELOG} 2>&1
+    date >> ${BASELINELOG} 2>&1
+    exit 1
+fi
 
 date >> ${BASELINELOG} 2>&1
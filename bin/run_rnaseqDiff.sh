@@ -47,7 +47,8 @@ ${RNASEQLOAD}/bin/rnaseqDiffDelete.sh >> ${DIFFLOG} 2>&1
 
 date >> ${DIFFLOG} 2>&1
 echo "Step 5: run differential pre processing (input_differential)" >> ${DIFFLOG} 2>&1
-rm -rf ${DIFFINPUTDIR}/*
+# only experiments whose inputs changed are pre-processed again
+# (see ${DIFFINPUTDIR}/preprocess.fingerprints; remove it to rebuild all)
 ${PYTHON} ${RNASEQLOAD}/bin/preprocessDiff.py >> ${DIFFLOG} 2>&1
 
 date >> ${DIFFLOG} 2>&1
@@ -55,7 +56,16 @@ echo "Step 6: run differential: RNASeqSet, RNASeq_SetMember, RNASeqCombined" >>
 ${MGD_DBSCHEMADIR}/index/GXD_HTSample_RNASeqCombined_drop.object >> ${DIFFLOG} 2>&1
 ${MGD_DBSCHEMADIR}/key/GXD_HTSample_RNASeqCombined_drop.object >> ${DIFFLOG} 2>&1
 ${PYTHON} ${RNASEQLOAD}/bin/rnaseqDiff.py >> ${DIFFLOG} 2>&1
+STAT=$?
 ${MGD_DBSCHEMADIR}/key/GXD_HTSample_RNASeqCombined_create.object >> ${DIFFLOG} 2>&1
 ${MGD_DBSCHEMADIR}/index/GXD_HTSample_RNASeqCombined_create.object >> ${DIFFLOG} 2>&1
 
+# the load failed (a bcp file was not loaded)
+if [ ${STAT} -ne 0 ]
+then
+    echo "rnaseqDiff.py failed" >> ${DIFFLOG} 2>&1
+    date >> ${DIFFLOG} 2>&1
+    exit 1
+fi
+
 date >> ${DIFFLOG} 2>&1